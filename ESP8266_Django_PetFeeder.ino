@@ -51,9 +51,20 @@ int currentMicrostepMode = 16; // Default to 1/16 microstepping
 ESP8266WebServer server(80);
 unsigned long lastHeartbeat = 0;
 const unsigned long HEARTBEAT_INTERVAL = 10000; // 10 seconds
-const unsigned long STATUS_CHECK_INTERVAL = 5000; // 5 seconds
-unsigned long lastStatusCheck = 0;
+const unsigned long STATUS_CHECK_INTERVAL = 5000; // 5 seconds, between polls the server did not hold
+const int COMMAND_WAIT = 20; // Seconds the server may hold a command poll open
+String commandsETag = ""; // Lets the server answer 304 when no new commands were queued
+
+// The command poll runs alongside the loop: the request is sent, and the
+// answer is read whenever it arrives, so the button, heartbeats and the
+// local web server keep working while the server holds the poll open.
+WiFiClient commandClient;
+bool commandPollOpen = false;
+unsigned long commandPollStarted = 0;
+unsigned long nextCommandPoll = 0;
+String commandsRedirect = ""; // Owner node's poll URL after a redirect
 bool isFeeding = false;
+bool useMsgPack = true; // Smaller than JSON; switched off if the server answers 415
 
 // ------------------------
 // Setup Functions
@@ -141,11 +152,8 @@ void loop() {
     lastHeartbeat = millis();
   }
   
-  // Check for pending commands from Django server
-  if (millis() - lastStatusCheck >= STATUS_CHECK_INTERVAL) {
-    checkForPendingCommands();
-    lastStatusCheck = millis();
-  }
+  // Long-poll the Django server for pending commands
+  serviceCommandPoll();
 }
 
 // ------------------------
@@ -339,6 +347,25 @@ void handleSetConfig() {
 // ------------------------
 // Django Communication Functions
 // ------------------------
+// Send a document as MessagePack, or as JSON to servers without it
+int postDocument(HTTPClient& http, JsonDocument& doc) {
+  if (useMsgPack) {
+    uint8_t body[256];
+    size_t length = serializeMsgPack(doc, body, sizeof(body));
+    http.addHeader("Content-Type", "application/msgpack");
+    int httpResponseCode = http.POST(body, length);
+    if (httpResponseCode != 415) {
+      return httpResponseCode;
+    }
+    Serial.println("Server does not accept MessagePack, using JSON");
+    useMsgPack = false;
+  }
+  String jsonBody;
+  serializeJson(doc, jsonBody);
+  http.addHeader("Content-Type", "application/json");
+  return http.POST(jsonBody);
+}
+
 void registerWithDjangoServer() {
   // Only attempt to register if we have a server IP
   if (djangoServerIP == "") {
@@ -359,7 +386,6 @@ void registerWithDjangoServer() {
   url += djangoAPIEndpoint;
   
   http.begin(client, url);
-  http.addHeader("Content-Type", "application/json");
   
   // Prepare the registration data
   DynamicJsonDocument doc(256);
@@ -368,11 +394,8 @@ void registerWithDjangoServer() {
   doc["port"] = 80;
   doc["is_active"] = true;
   
-  String jsonBody;
-  serializeJson(doc, jsonBody);
-  
   // Send the POST request
-  int httpResponseCode = http.POST(jsonBody);
+  int httpResponseCode = postDocument(http, doc);
   
   if (httpResponseCode > 0) {
     String response = http.getString();
@@ -402,7 +425,8 @@ void sendHeartbeatToDjango() {
   url += djangoAPIEndpoint + "heartbeat/";
   
   http.begin(client, url);
-  http.addHeader("Content-Type", "application/json");
+  // With several servers, the one that owns this feeder may answer instead
+  http.setFollowRedirects(HTTPC_FORCE_FOLLOW_REDIRECTS);
   
   // Prepare the heartbeat data
   DynamicJsonDocument doc(256);
@@ -411,11 +435,8 @@ void sendHeartbeatToDjango() {
   doc["status"] = "online";
   doc["timestamp"] = millis();
   
-  String jsonBody;
-  serializeJson(doc, jsonBody);
-  
   // Send the POST request
-  int httpResponseCode = http.POST(jsonBody);
+  int httpResponseCode = postDocument(http, doc);
   
   // We don't need to process the response for heartbeats
   http.end();
@@ -438,7 +459,8 @@ void notifyManualFeedToDjango() {
   url += djangoAPIEndpoint + "feed/";
   
   http.begin(client, url);
-  http.addHeader("Content-Type", "application/json");
+  // With several servers, the one that owns this feeder may answer instead
+  http.setFollowRedirects(HTTPC_FORCE_FOLLOW_REDIRECTS);
   
   // Prepare the feed notification data
   DynamicJsonDocument doc(256);
@@ -447,11 +469,8 @@ void notifyManualFeedToDjango() {
   doc["type"] = "manual";
   doc["timestamp"] = millis();
   
-  String jsonBody;
-  serializeJson(doc, jsonBody);
-  
   // Send the POST request
-  int httpResponseCode = http.POST(jsonBody);
+  int httpResponseCode = postDocument(http, doc);
   
   if (httpResponseCode > 0) {
     String response = http.getString();
@@ -461,59 +480,165 @@ void notifyManualFeedToDjango() {
   http.end();
 }
 
-void checkForPendingCommands() {
-  // Only attempt to check if we have a server IP
+// Split "http://host[:port]/path" into its parts
+bool parseURL(const String& url, String& host, int& port, String& path) {
+  if (!url.startsWith("http://")) {
+    return false;
+  }
+  int slash = url.indexOf('/', 7);
+  String hostPort = slash < 0 ? url.substring(7) : url.substring(7, slash);
+  path = slash < 0 ? "/" : url.substring(slash);
+  int colon = hostPort.indexOf(':');
+  host = colon < 0 ? hostPort : hostPort.substring(0, colon);
+  port = colon < 0 ? 80 : hostPort.substring(colon + 1).toInt();
+  return host != "" && port > 0;
+}
+
+void startCommandPoll() {
+  // Only attempt to poll if we have a server IP
   if (djangoServerIP == "") {
+    nextCommandPoll = millis() + STATUS_CHECK_INTERVAL;
     return;
   }
   
-  WiFiClient client;
-  HTTPClient http;
+  String host = djangoServerIP;
+  int port = djangoServerPort;
+  String path = djangoAPIEndpoint + "commands/?device_id=" + deviceID + "&wait=" + String(COMMAND_WAIT);
+  if (commandsRedirect != "" && !parseURL(commandsRedirect, host, port, path)) {
+    commandsRedirect = "";
+    host = djangoServerIP;
+    port = djangoServerPort;
+  }
   
-  // Construct the URL for the Django API endpoint
-  String url = "http://" + djangoServerIP;
-  if (djangoServerPort != 80) {
-    url += ":" + String(djangoServerPort);
+  if (!commandClient.connect(host.c_str(), port)) {
+    // Go back to the configured server in case the owner node went away
+    commandsRedirect = "";
+    nextCommandPoll = millis() + STATUS_CHECK_INTERVAL;
+    return;
   }
-  url += djangoAPIEndpoint + "commands/?device_id=" + deviceID;
   
-  http.begin(client, url);
+  // HTTP/1.0 keeps the body unchunked, so it can be parsed straight from the socket.
+  // The last ETag lets the server answer 304 when the queue did not change.
+  String request = "GET " + path + " HTTP/1.0\r\n";
+  request += "Host: " + host + ":" + String(port) + "\r\n";
+  if (commandsETag != "") {
+    request += "If-None-Match: " + commandsETag + "\r\n";
+  }
+  request += "Accept: " + String(useMsgPack ? "application/msgpack" : "application/json") + "\r\n";
+  request += "Connection: close\r\n\r\n";
+  commandClient.print(request);
   
-  // Send the GET request
-  int httpResponseCode = http.GET();
+  commandPollOpen = true;
+  commandPollStarted = millis();
+}
+
+void serviceCommandPoll() {
+  if (!commandPollOpen) {
+    if ((long)(millis() - nextCommandPoll) >= 0) {
+      startCommandPoll();
+    }
+    return;
+  }
   
+  if (commandClient.available()) {
+    readCommandResponse();
+    return;
+  }
+  
+  // Connection dropped, or the server held the poll far longer than asked
+  if (!commandClient.connected() || millis() - commandPollStarted > (COMMAND_WAIT + 10) * 1000UL) {
+    commandClient.stop();
+    commandPollOpen = false;
+    nextCommandPoll = millis() + STATUS_CHECK_INTERVAL;
+  }
+}
+
+void readCommandResponse() {
+  commandClient.setTimeout(2000);
+  
+  // Status line, e.g. "HTTP/1.1 200 OK"
+  String statusLine = commandClient.readStringUntil('\n');
+  int httpResponseCode = statusLine.substring(9, 12).toInt();
+  
+  String contentType = "";
+  String location = "";
+  while (commandClient.connected() || commandClient.available()) {
+    String line = commandClient.readStringUntil('\n');
+    line.trim();
+    if (line.length() == 0) {
+      break; // End of the headers
+    }
+    int colon = line.indexOf(':');
+    if (colon < 0) {
+      continue;
+    }
+    String name = line.substring(0, colon);
+    name.toLowerCase();
+    String value = line.substring(colon + 1);
+    value.trim();
+    if (name == "etag") {
+      commandsETag = value;
+    } else if (name == "content-type") {
+      contentType = value;
+    } else if (name == "location") {
+      location = value;
+    }
+  }
+  
+  DynamicJsonDocument doc(1024);
+  bool parsed = false;
   if (httpResponseCode == 200) {
-    String response = http.getString();
-    
-    // Parse the JSON response
-    DynamicJsonDocument doc(1024);
-    DeserializationError error = deserializeJson(doc, response);
+    // Parse the body in whichever format the server chose
+    DeserializationError error = contentType.startsWith("application/msgpack")
+      ? deserializeMsgPack(doc, commandClient)
+      : deserializeJson(doc, commandClient);
+    parsed = !error;
+  }
+  commandClient.stop();
+  commandPollOpen = false;
+  
+  bool heldOpen = millis() - commandPollStarted >= 1000;
+  if (httpResponseCode == 307 || httpResponseCode == 302) {
+    // Another server owns this feeder; poll it from now on
+    commandsRedirect = location;
+    nextCommandPoll = millis();
+  } else if (httpResponseCode == 200 || httpResponseCode == 304) {
+    // Poll again at once after a held poll; a server that answers
+    // straight away (no long-poll support) is polled at the old interval
+    nextCommandPoll = heldOpen ? millis() : millis() + STATUS_CHECK_INTERVAL;
+  } else {
+    commandsRedirect = "";
+    nextCommandPoll = millis() + STATUS_CHECK_INTERVAL;
+  }
+  
+  if (parsed) {
+    runCommands(doc);
+    // Commands were handed out, so more may be waiting
+    nextCommandPoll = millis();
+  }
+}
+
+void runCommands(JsonDocument& doc) {
+  // Check if there are any pending commands
+  if (doc.containsKey("commands") && doc["commands"].is<JsonArray>()) {
+    JsonArray commands = doc["commands"];
     
-    if (!error) {
-      // Check if there are any pending commands
-      if (doc.containsKey("commands") && doc["commands"].is<JsonArray>()) {
-        JsonArray commands = doc["commands"];
+    for (JsonObject command : commands) {
+      if (command.containsKey("type") && command["type"] == "feed") {
+        // Execute feed command
+        int portion = command["portion"] | 1; // Default to 1 if not specified
         
-        for (JsonObject command : commands) {
-          if (command.containsKey("type") && command["type"] == "feed") {
-            // Execute feed command
-            int portion = command["portion"] | 1; // Default to 1 if not specified
-            
-            Serial.println("Executing feed command from Django. Portion: " + String(portion));
-            
-            isFeeding = true;
-            moveStepper(STEPS_PER_PORTION * portion, true);
-            isFeeding = false;
-            
-            // Acknowledge the command
-            acknowledgeCommand(command["id"]);
-          }
-        }
+        Serial.println("Executing feed command from Django. Portion: " + String(portion));
+        
+        isFeeding = true;
+        moveStepper(STEPS_PER_PORTION * portion, true);
+        isFeeding = false;
+        
+        // Acknowledge the command
+        acknowledgeCommand(command["id"]);
       }
     }
   }
-  
-  http.end();
 }
 
 void acknowledgeCommand(const String& commandId) {
@@ -528,7 +653,8 @@ void acknowledgeCommand(const String& commandId) {
   url += djangoAPIEndpoint + "acknowledge/";
   
   http.begin(client, url);
-  http.addHeader("Content-Type", "application/json");
+  // With several servers, the one that owns this feeder may answer instead
+  http.setFollowRedirects(HTTPC_FORCE_FOLLOW_REDIRECTS);
   
   // Prepare the acknowledgment data
   DynamicJsonDocument doc(256);
@@ -537,10 +663,7 @@ void acknowledgeCommand(const String& commandId) {
   doc["status"] = "completed";
   doc["timestamp"] = millis();
   
-  String jsonBody;
-  serializeJson(doc, jsonBody);
-  
   // Send the POST request
-  http.POST(jsonBody);
+  postDocument(http, doc);
   http.end();
 }
\ No newline at end of file
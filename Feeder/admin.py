@@ -1,8 +1,9 @@
 from django.contrib import admin
-from .models import FeedingSchedule, ESP8266Device, FeedingHistory, DeviceCommand
+from .models import FeedingSchedule, ESP8266Device, FeedingHistory, DeviceCommand, DailyConsumption
 
 # Register your models here.
 admin.site.register(FeedingSchedule)
 admin.site.register(ESP8266Device)
 admin.site.register(FeedingHistory)
 admin.site.register(DeviceCommand)
+admin.site.register(DailyConsumption)
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class FeederConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'Feeder'
+
+    def ready(self):
+        # Connect the signal handlers that keep the device cache, the
+        # per-device command versions, the list caches and the daily
+        # rollups coherent, the live event stream, and the device-call
+        # hooks behind the circuit breaker and /metrics
+        from . import commands, devices, events, health, listcache, metrics, rollups  # noqa: F401
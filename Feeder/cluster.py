@@ -0,0 +1,341 @@
+"""Consistent-hash ownership of feeders across several server nodes.
+
+By default the server is a single node and owns every device. Setting
+``FEEDER_CLUSTER_DIR`` turns on multi-node mode. Each node then announces
+itself (``FEEDER_NODE_ID``, ``FEEDER_NODE_URL``) in the shared membership
+state, and all nodes hash the live members onto the same ring. Each
+``device_id`` is owned by the first node clockwise from its hash. Every
+node has ``FEEDER_CLUSTER_REPLICAS`` points on the ring, so load evens out.
+When a node joins or leaves, only the devices on the arcs it gains or
+loses change owner, about 1/N of the fleet.
+
+A node only does the per-device work for the devices it owns:
+
+- Heartbeats, feed notifications, acknowledgements, command polls and
+  event batches for another node's device get ``307 Temporary Redirect``
+  to that node (see ``misrouted``). A batch mixing several devices has
+  the other nodes' events rejected instead. Push channel sockets are sent
+  a ``moved`` frame and closed. Each device's presence is therefore
+  buffered in exactly one process.
+- Outbox workers claim only commands for owned devices.
+- The stale sweep only looks at owned devices.
+- The feed scheduler fires schedules for owned devices only. It passes
+  ``filter_owned`` as its ``device_filter``.
+
+Everything the nodes must agree on lives in the database: commands,
+history, command versions, list generations and live events. Per-node
+state is either scoped to owned devices (the heartbeat buffer, push
+sockets) or only an optimisation checked against the database (the device
+resolver, drained-queue markers, throttle buckets, breakers).
+
+``FileMembership`` is the shared membership state: one small file per
+live node in a directory, refreshed every
+``FEEDER_CLUSTER_HEARTBEAT_INTERVAL`` seconds. A node whose file is older
+than ``FEEDER_CLUSTER_NODE_TTL`` counts as gone. On one machine a local
+directory is enough, which lets several processes on different ports
+make up a test cluster. Across machines it needs a shared mount, or a
+store with the same three methods.
+"""
+import atexit
+import bisect
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+
+from .devices import registry_generation
+from .models import ESP8266Device
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPLICAS = 100  # ring points per node
+DEFAULT_HEARTBEAT_INTERVAL = 5  # seconds between membership refreshes
+DEFAULT_NODE_TTL = 15  # seconds without a refresh before a node is dropped
+
+# Added to redirect targets so a request is served by the node it was sent
+# to, even if the two nodes briefly disagree about the ring
+ROUTED_PARAM = 'routed'
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Immutable consistent-hash ring over a set of node ids."""
+
+    def __init__(self, nodes=(), replicas=DEFAULT_REPLICAS):
+        self.nodes = frozenset(nodes)
+        points = sorted(
+            (_hash(f'{node}#{replica}'), node) for node in self.nodes for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key):
+        """The node owning ``key``, or None for an empty ring."""
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+
+class FileMembership:
+    """Membership kept as one JSON file per node in a shared directory."""
+
+    def __init__(self, directory, ttl=DEFAULT_NODE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, node_id):
+        return os.path.join(self.directory, f'{node_id}.json')
+
+    def announce(self, node_id, url):
+        """Record ``node_id`` as alive now; written atomically."""
+        temporary = f'{self._path(node_id)}.{os.getpid()}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump({'node_id': node_id, 'url': url, 'seen': time.time()}, f)
+        os.replace(temporary, self._path(node_id))
+
+    def withdraw(self, node_id):
+        try:
+            os.remove(self._path(node_id))
+        except FileNotFoundError:
+            pass
+
+    def members(self):
+        """Return ``{node_id: url}`` for every node seen within the TTL."""
+        cutoff = time.time() - self.ttl
+        members = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue  # Being replaced or removed right now
+            if entry.get('seen', 0) >= cutoff:
+                members[entry['node_id']] = entry.get('url') or ''
+        return members
+
+
+class Cluster:
+    """This node's view of the ring, refreshed from the membership store."""
+
+    def __init__(self, node_id=None, url=None, membership=None, heartbeat_interval=None, replicas=None):
+        self._node_id = node_id
+        self._url = url
+        self._membership = membership
+        self._heartbeat_interval = heartbeat_interval
+        self._replicas = replicas
+        self._configured = membership is not None
+        self._lock = threading.Lock()
+        self._members = {}
+        self._ring = None
+        self._owned = (None, frozenset())  # ((ring version, registry generation), device pks)
+        self._listeners = []
+        self._heartbeat = None
+        self._stop = threading.Event()
+        self.version = 0
+        self.rebalances = 0
+
+    def _configure(self):
+        if self._configured:
+            return
+        with self._lock:
+            if self._configured:
+                return
+            directory = getattr(settings, 'FEEDER_CLUSTER_DIR', '')
+            if directory:
+                self._membership = FileMembership(
+                    directory, getattr(settings, 'FEEDER_CLUSTER_NODE_TTL', DEFAULT_NODE_TTL)
+                )
+            self._configured = True
+
+    @property
+    def enabled(self):
+        self._configure()
+        return self._membership is not None
+
+    @property
+    def node_id(self):
+        if self._node_id is None:
+            self._node_id = getattr(settings, 'FEEDER_NODE_ID', '') or f'{socket.gethostname()}-{os.getpid()}'
+        return self._node_id
+
+    @property
+    def url(self):
+        if self._url is None:
+            self._url = getattr(settings, 'FEEDER_NODE_URL', '')
+        return self._url
+
+    @property
+    def heartbeat_interval(self):
+        if self._heartbeat_interval is not None:
+            return self._heartbeat_interval
+        return getattr(settings, 'FEEDER_CLUSTER_HEARTBEAT_INTERVAL', DEFAULT_HEARTBEAT_INTERVAL)
+
+    @property
+    def replicas(self):
+        if self._replicas is not None:
+            return self._replicas
+        return getattr(settings, 'FEEDER_CLUSTER_REPLICAS', DEFAULT_REPLICAS)
+
+    def live_members(self):
+        """``{node_id: url}`` as the membership store reports it, without joining."""
+        if not self.enabled:
+            return {self.node_id: self.url}
+        return self._membership.members()
+
+    def start(self):
+        """Join the cluster and keep this node's membership fresh; a no-op in single-node mode."""
+        if not self.enabled:
+            return
+        if self._heartbeat is not None and self._heartbeat.is_alive():
+            return
+        with self._lock:
+            if self._heartbeat is not None and self._heartbeat.is_alive():
+                return
+            self._stop.clear()
+            self._membership.announce(self.node_id, self.url)
+            self._heartbeat = threading.Thread(target=self._run_heartbeat, name='cluster-heartbeat', daemon=True)
+            self._heartbeat.start()
+        self.refresh()
+
+    def stop(self):
+        """Leave the cluster; the other nodes take over this node's devices at their next refresh."""
+        if self._heartbeat is None:
+            return
+        self._stop.set()
+        self._heartbeat.join()
+        self._heartbeat = None
+        self._membership.withdraw(self.node_id)
+
+    def _run_heartbeat(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                self._membership.announce(self.node_id, self.url)
+                self.refresh()
+            except Exception:
+                logger.exception("Cluster membership refresh failed")
+
+    def refresh(self):
+        """Rebuild the ring if membership changed; returns True if it did."""
+        members = self._membership.members()
+        members.setdefault(self.node_id, self.url)  # Whatever the store says, this node is alive
+        with self._lock:
+            if self._ring is not None and members.keys() == self._members.keys():
+                self._members = members
+                return False
+            previous = self._ring
+            self._ring = HashRing(members, self.replicas)
+            self._members = members
+            self.version += 1
+            listeners = list(self._listeners)
+        if previous is not None:
+            self.rebalances += 1
+            logger.info("Cluster ring now has %d nodes: %s", len(members), ', '.join(sorted(members)))
+        for listener in listeners:
+            try:
+                listener()
+            except Exception:
+                logger.exception("Cluster ring listener %r failed", listener)
+        return True
+
+    def _current_ring(self):
+        if self._ring is None:
+            self.start()
+        return self._ring
+
+    def owner(self, device_id):
+        """The node owning ``device_id``; this node when not clustered."""
+        if not self.enabled:
+            return self.node_id
+        return self._current_ring().owner(str(device_id))
+
+    def owns(self, device_id):
+        return not self.enabled or self.owner(device_id) == self.node_id
+
+    def url_of(self, node_id):
+        return self._members.get(node_id, '')
+
+    def owned_device_pks(self):
+        """Primary keys of the devices this node owns, cached until the ring or device registry changes.
+
+        Keyed on the registry generation, which device saves and deletes
+        move and heartbeat flushes do not, so a steady fleet is scanned
+        once per ring change.
+        """
+        self._current_ring()
+        key = (self.version, registry_generation())
+        cached_key, pks = self._owned
+        if cached_key != key:
+            pks = frozenset(
+                pk for pk, device_id in ESP8266Device.objects.values_list('pk', 'device_id') if self.owns(device_id)
+            )
+            self._owned = (key, pks)
+        return pks
+
+    def filter_owned(self, queryset):
+        """Narrow a device queryset to owned devices; usable as ``FeedScheduler(device_filter=...)``."""
+        if not self.enabled:
+            return queryset
+        return queryset.filter(pk__in=self.owned_device_pks())
+
+    def add_listener(self, callback):
+        """Call ``callback()`` whenever the ring changes (a node joined or left)."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def stats(self):
+        return {
+            'enabled': self.enabled,
+            'node_id': self.node_id,
+            'members': sorted(self._members) if self.enabled else [self.node_id],
+            'ring_version': self.version,
+            'rebalances': self.rebalances,
+        }
+
+
+cluster = Cluster()
+atexit.register(cluster.stop)
+
+
+def redirect_location(device_id, path, query=''):
+    """URL on the node owning ``device_id`` to send a request for ``path`` to, or None to serve it here.
+
+    Requests that were already redirected once are served here either way.
+    """
+    if not cluster.enabled or cluster.owns(device_id):
+        return None
+    if f'{ROUTED_PARAM}=1' in query.split('&'):
+        return None
+    base = cluster.url_of(cluster.owner(device_id))
+    if not base:
+        return None  # The owner cannot be reached over HTTP; better served here than not at all
+    return f"{base.rstrip('/')}{path}?{query + '&' if query else ''}{ROUTED_PARAM}=1"
+
+
+def misrouted(request, device_id):
+    """A 307 to the node owning ``device_id``, or None if this node should serve the request."""
+    location = redirect_location(device_id, request.path, request.META.get('QUERY_STRING', ''))
+    if location is None:
+        return None
+    return Response({
+        'status': 'redirect',
+        'message': f'Device {device_id} is served by node {cluster.owner(device_id)}'
+    }, status=status.HTTP_307_TEMPORARY_REDIRECT, headers={'Location': location})
@@ -0,0 +1,297 @@
+"""Delivery helpers for DeviceCommand rows polled by the firmware.
+
+Besides claiming commands, this module keeps a per-device command version
+in a change counter (see ``counters``). The version is bumped in the same
+transaction that makes a command pending for a device, so every process
+sees it: web workers, outbox workers, the scheduler, other nodes. A poll
+that finds the device's queue empty remembers the version in Django's
+cache. Until the version moves, the commands endpoint answers "nothing
+changed" (or holds a long-poll open) without a query. The "drained"
+marker may stay local to the process because it is keyed by the shared
+version.
+
+Each process keeps the versions it has read in memory. A commit in this
+process that queues commands drops the devices' entries and wakes the
+long-polls at once. Commands queued by other processes are noticed when
+an entry is older than ``FEEDER_COMMAND_VERSION_MAX_AGE`` seconds, and a
+long-poll re-reads the counter once when its wait runs out.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import counters
+from .db import retry_on_locked
+from .events import publish_command_status, publish_transitions
+from .models import DeviceCommand, FeedingHistory
+
+DEFAULT_COMMAND_BATCH_SIZE = 10
+DEFAULT_LONG_POLL_TIMEOUT = 25  # seconds
+DEFAULT_DRAINED_TTL = 60  # seconds
+DEFAULT_VERSION_MAX_AGE = DEFAULT_LONG_POLL_TIMEOUT  # seconds a version read is trusted
+
+# Notified, and the devices' versions dropped, when a commit in this
+# process queues commands
+_commands_queued = threading.Condition()
+_versions = {}  # device pk -> (version, monotonic time it was read)
+_queued_commits = 0  # commits that dropped versions; guards reads racing them
+
+# Callables run with the set of device pks whenever commands are queued,
+# e.g. to push them over an open device connection
+_queue_listeners = []
+
+
+def add_queue_listener(listener):
+    if listener not in _queue_listeners:
+        _queue_listeners.append(listener)
+
+
+def remove_queue_listener(listener):
+    if listener in _queue_listeners:
+        _queue_listeners.remove(listener)
+
+
+def command_batch_size():
+    """Maximum number of commands handed to a device in a single poll."""
+    return getattr(settings, 'FEEDER_COMMAND_BATCH_SIZE', DEFAULT_COMMAND_BATCH_SIZE)
+
+
+@retry_on_locked
+def claim_pending_commands(device, limit=None):
+    """Atomically move up to ``limit`` pending commands for a device to 'sent'.
+
+    The oldest pending commands are selected and flipped with one guarded
+    UPDATE, so overlapping polls (and the outbox workers) never deliver the
+    same command twice. Expired commands are skipped. Returns the claimed
+    commands, oldest first.
+    """
+    limit = limit or command_batch_size()
+    with transaction.atomic():
+        pending = (
+            DeviceCommand.objects.filter(device=device, status='pending')
+            .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()))
+            .order_by('created_at')
+        )
+        if connection.features.has_select_for_update_skip_locked:
+            pending = pending.select_for_update(skip_locked=True)
+        commands = list(pending.only('id', 'command_type', 'parameters', 'created_at')[:limit])
+        if not commands:
+            return []
+
+        claimed_at = timezone.now()
+        ids = [command.id for command in commands]
+        claimed = DeviceCommand.objects.filter(id__in=ids, status='pending').update(
+            status='sent', updated_at=claimed_at
+        )
+        if claimed != len(commands):
+            # A concurrent poll claimed some of these rows first; keep only
+            # the ones stamped by this claim.
+            commands = list(
+                DeviceCommand.objects.filter(id__in=ids, status='sent', updated_at=claimed_at)
+                .only('id', 'command_type', 'parameters', 'created_at')
+                .order_by('created_at')
+            )
+    for command in commands:
+        command.status = 'sent'
+        command.updated_at = claimed_at
+    publish_command_status(commands, device_pk=device.pk)
+    return commands
+
+
+def claim_for_delivery(device, limit, version):
+    """Claim commands for one delivery and remember when the queue ran dry at ``version``."""
+    commands = claim_pending_commands(device, limit=limit)
+    if len(commands) < limit:
+        mark_drained(device.pk, version)
+    return commands
+
+
+def ack_status(reported_status):
+    """Map the status reported by the firmware to the command's final status."""
+    return 'completed' if reported_status == 'completed' else 'failed'
+
+
+def apply_acknowledgements(transitions):
+    """Move 'sent' commands to their acknowledged status.
+
+    ``transitions`` is a list of ``(command, new_status)`` for commands that
+    were read as 'sent'. Each status group is flipped with one UPDATE
+    guarded on status='sent', so only the first ack of a command takes
+    effect; feed history is written only for commands that actually
+    completed here. Returns the ids that transitioned. Call inside a
+    transaction.
+    """
+    now = timezone.now()
+    by_status = {}
+    for command, new_status in transitions:
+        by_status.setdefault(new_status, []).append(command)
+
+    transitioned = set()
+    for new_status, commands in by_status.items():
+        ids = [command.id for command in commands]
+        updated = DeviceCommand.objects.filter(id__in=ids, status='sent').update(status=new_status, updated_at=now)
+        if updated == len(ids):
+            transitioned.update(ids)
+        elif updated:
+            # A concurrent ack won some rows; keep only those stamped here
+            transitioned.update(
+                DeviceCommand.objects.filter(id__in=ids, status=new_status, updated_at=now).values_list('id', flat=True)
+            )
+
+    publish_transitions(
+        (command.id, command.device_id, new_status, command.command_type)
+        for command, new_status in transitions if command.id in transitioned
+    )
+
+    FeedingHistory.objects.bulk_create([
+        FeedingHistory(device_id=command.device_id, portion=command.parameters.get('portion', 1), feed_type='scheduled')
+        for command, new_status in transitions
+        if command.id in transitioned and command.command_type == 'feed' and new_status == 'completed'
+    ])
+    return transitioned
+
+
+@retry_on_locked
+def acknowledge_command(device, command_id, reported_status):
+    """Apply one acknowledgement idempotently.
+
+    Returns ``(command, transitioned)``; ``command`` is None if the device
+    has no such command. A repeated ack costs the single lookup query.
+    """
+    command = (
+        DeviceCommand.objects.filter(id=command_id, device=device)
+        .only('id', 'device_id', 'status', 'command_type', 'parameters')
+        .first()
+    )
+    if command is None or command.status != 'sent':
+        return command, False
+    with transaction.atomic():
+        transitioned = apply_acknowledgements([(command, ack_status(reported_status))])
+    return command, command.id in transitioned
+
+
+def format_command(command):
+    """Shape a command the way the firmware expects it."""
+    return {
+        'id': str(command.id),
+        'type': command.command_type,
+        **command.parameters
+    }
+
+
+def long_poll_timeout():
+    """Upper bound, in seconds, for how long a command poll may be held open."""
+    return getattr(settings, 'FEEDER_COMMAND_LONG_POLL_TIMEOUT', DEFAULT_LONG_POLL_TIMEOUT)
+
+
+def _version_key(device_pk):
+    return f'commands:{device_pk}'
+
+
+def _drained_key(device_pk):
+    return f'feeder:commands:drained:{device_pk}'
+
+
+def version_max_age():
+    return getattr(settings, 'FEEDER_COMMAND_VERSION_MAX_AGE', DEFAULT_VERSION_MAX_AGE)
+
+
+def command_version(device_pk, max_age=None):
+    """Return the command version for a device.
+
+    Served from memory unless the version was read more than ``max_age``
+    seconds ago (``FEEDER_COMMAND_VERSION_MAX_AGE`` by default) or commands
+    were queued for the device in this process since.
+    """
+    entry = _versions.get(device_pk)
+    if entry is not None and time.monotonic() - entry[1] < (version_max_age() if max_age is None else max_age):
+        return entry[0]
+    return _read_version(device_pk)
+
+
+def _read_version(device_pk):
+    commits = _queued_commits
+    read_at = time.monotonic()
+    version = counters.read(_version_key(device_pk))
+    with _commands_queued:
+        # A read that overlapped a local commit may predate it; don't keep it
+        if commits == _queued_commits:
+            _versions[device_pk] = (version, read_at)
+    return version
+
+
+def forget_versions():
+    """Drop every version this process remembers."""
+    with _commands_queued:
+        _versions.clear()
+
+
+def command_etag(device_pk, version):
+    return f'"{device_pk}-{version}"'
+
+
+def notify_commands_queued(device_pks):
+    """Bump the command version of each device and wake waiting long-polls.
+
+    Must be called whenever commands become pending without model signals
+    (``bulk_create``, ``QuerySet.update``), in the same transaction as the
+    write; ``save()`` is covered by a post_save handler. Long-polls, workers
+    and sockets in this process are woken once the transaction commits.
+    """
+    device_pks = set(device_pks)
+    counters.bump(_version_key(device_pk) for device_pk in device_pks)
+
+    def wake():
+        global _queued_commits
+        with _commands_queued:
+            _queued_commits += 1
+            for device_pk in device_pks:
+                _versions.pop(device_pk, None)
+            _commands_queued.notify_all()
+        for listener in _queue_listeners:
+            listener(device_pks)
+    transaction.on_commit(wake)
+
+
+def mark_drained(device_pk, version):
+    """Remember that the device had no pending commands left at ``version``."""
+    drained_ttl = getattr(settings, 'FEEDER_COMMAND_DRAINED_TTL', DEFAULT_DRAINED_TTL)
+    cache.set(_drained_key(device_pk), version, timeout=drained_ttl)
+
+
+def is_drained(device_pk, version):
+    """True if the device is known to have no pending commands at ``version``."""
+    return cache.get(_drained_key(device_pk)) == version
+
+
+def wait_for_commands(device_pk, version, timeout):
+    """Block until the device's command version moves past ``version``.
+
+    Returns True if new commands were queued, False if the timeout expired.
+    Only commits in this process end the wait early; the counter is read
+    once, when the wait runs out, for commands queued elsewhere.
+    """
+    deadline = time.monotonic() + timeout
+    with _commands_queued:
+        while True:
+            entry = _versions.get(device_pk)
+            if entry is None or entry[0] != version:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            _commands_queued.wait(remaining)
+    return _read_version(device_pk) != version
+
+
+@receiver(post_save, sender=DeviceCommand)
+def _command_saved(sender, instance, **kwargs):
+    if instance.status == 'pending':
+        notify_commands_queued([instance.device_id])
@@ -0,0 +1,42 @@
+"""Change counters shared by every process through the database.
+
+The caches in this app live in process memory. The web workers, the
+outbox workers, the feed scheduler and the nodes of a cluster each keep
+their own copy. A change counter is one row that a writer bumps whenever
+it changes the data a cache was built from. The bump happens in the same
+transaction as the change, so any process that reads the counter
+afterwards knows its copy is out of date. A process may keep whatever it
+derived from the data for as long as the counter has not moved. Reading a
+counter is one primary-key lookup.
+
+A counter can also hold a time: ``advance`` moves it forward to a given
+value and never back, which is how the live event stream records until
+when some process has listeners.
+"""
+from django.db.models import F
+
+from .models import ChangeCounter
+
+
+def read(name):
+    """Current value of counter ``name``; 0 until it is first bumped."""
+    return ChangeCounter.objects.filter(name=name).values_list('value', flat=True).first() or 0
+
+
+def bump(names):
+    """Increment each counter in ``names`` once, inside the current transaction."""
+    names = set(names)
+    if not names:
+        return
+    counters = ChangeCounter.objects.filter(name__in=names)
+    if counters.update(value=F('value') + 1) < len(names):
+        # Some counters do not exist yet: create them and bump them all again.
+        # A counter only has to move, so bumping some of them twice is harmless
+        ChangeCounter.objects.bulk_create([ChangeCounter(name=name) for name in names], ignore_conflicts=True)
+        counters.update(value=F('value') + 1)
+
+
+def advance(name, value):
+    """Move counter ``name`` forward to ``value``; it never moves back."""
+    if not ChangeCounter.objects.filter(name=name, value__lt=value).update(value=value):
+        ChangeCounter.objects.get_or_create(name=name, defaults={'value': value})
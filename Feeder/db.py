@@ -0,0 +1,47 @@
+"""Database helpers shared by the write-heavy firmware paths."""
+import functools
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError, connection
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WRITE_RETRIES = 5
+RETRY_BASE_DELAY = 0.05  # seconds, doubled on every attempt
+
+
+def is_lock_error(error):
+    """True for transient lock contention errors (SQLite "database is locked")."""
+    message = str(error).lower()
+    return 'database is locked' in message or 'database table is locked' in message
+
+
+def retry_on_locked(func=None, attempts=None, base_delay=RETRY_BASE_DELAY):
+    """Retry a database write when it fails on lock contention.
+
+    Retries use exponential backoff with jitter. Inside an enclosing
+    ``atomic()`` block the error is re-raised immediately, since only the
+    outermost transaction can be safely replayed.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            tries = attempts or getattr(settings, 'FEEDER_DB_WRITE_RETRIES', DEFAULT_WRITE_RETRIES)
+            for attempt in range(1, tries + 1):
+                try:
+                    return fn(*args, **kwargs)
+                except OperationalError as e:
+                    if attempt == tries or not is_lock_error(e) or connection.in_atomic_block:
+                        raise
+                    delay = base_delay * (2 ** (attempt - 1))
+                    logger.warning("%s hit a locked database (attempt %d/%d), retrying in %.2fs",
+                                   fn.__qualname__, attempt, tries, delay)
+                    time.sleep(delay + random.uniform(0, delay))
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
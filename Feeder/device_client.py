@@ -0,0 +1,327 @@
+"""Outbound HTTP calls from the server to ESP8266 feeders.
+
+Two clients share one interface:
+
+* ``send_motor_command`` is used by the regular (WSGI) views and goes through
+  a process-wide ``requests.Session`` so connections to a device are reused.
+* ``send_motor_command_async`` is used by the async views under ASGI. It keeps
+  a small pool of keep-alive connections per device on the running event
+  loop, so a burst of commands to many feeders runs concurrently without
+  tying up worker threads. The pools are closed on ASGI lifespan shutdown
+  and, failing that, at interpreter exit.
+
+The async client speaks just enough HTTP/1.1 for the firmware's web server
+(JSON bodies, Content-Length or chunked responses) and needs no extra
+dependency.
+"""
+import asyncio
+import atexit
+import json
+import threading
+import time
+import weakref
+
+import requests
+
+DEFAULT_TIMEOUT = 5  # seconds
+MAX_CONNECTIONS_PER_DEVICE = 2
+
+
+class DeviceResponse:
+    """Minimal response object with the parts of ``requests.Response`` the views use."""
+
+    def __init__(self, status_code, body, headers=None, elapsed=0.0):
+        self.status_code = status_code
+        self.content = body
+        self.headers = headers or {}
+        self.elapsed = elapsed
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class DeviceConnectionError(requests.exceptions.ConnectionError):
+    """Raised when a feeder cannot be reached or returns a malformed response.
+
+    ``request_sent`` is True when the connection failed after the request
+    was written, so the device may already have acted on it.
+    """
+
+    def __init__(self, *args, request_sent=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.request_sent = request_sent
+
+
+def motor_url(device):
+    return f"http://{device.ip_address}:{device.port}/motor"
+
+
+def device_address(device):
+    return (device.ip_address, int(device.port))
+
+
+# Callables run after every outbound device request as
+# ``hook(method, address, status_code, elapsed, error)`` where ``address`` is
+# ``(host, port)``. ``status_code`` is None
+# and ``error`` is the exception when the device could not be reached.
+_request_hooks = []
+
+
+def add_request_hook(hook):
+    if hook not in _request_hooks:
+        _request_hooks.append(hook)
+
+
+def remove_request_hook(hook):
+    if hook in _request_hooks:
+        _request_hooks.remove(hook)
+
+
+def _notify_hooks(method, address, status_code, elapsed, error=None):
+    for hook in _request_hooks:
+        hook(method, address, status_code, elapsed, error)
+
+
+# ------------------------
+# Synchronous client
+# ------------------------
+
+_session_local = threading.local()
+
+
+def _session():
+    # requests.Session is not guaranteed thread-safe, so each worker thread
+    # keeps its own pooled session.
+    session = getattr(_session_local, 'session', None)
+    if session is None:
+        session = _session_local.session = requests.Session()
+    return session
+
+
+def send_motor_command(device, data, timeout=DEFAULT_TIMEOUT):
+    """POST a motor command to a device and return the ``requests`` response."""
+    started = time.perf_counter()
+    try:
+        response = _session().post(motor_url(device), json=data, timeout=timeout)
+    except requests.exceptions.RequestException as e:
+        _notify_hooks('POST', device_address(device), None, time.perf_counter() - started, e)
+        raise
+    _notify_hooks('POST', device_address(device), response.status_code, time.perf_counter() - started)
+    return response
+
+
+# ------------------------
+# Asynchronous client
+# ------------------------
+
+class _Progress:
+    __slots__ = ('request_sent',)
+
+    def __init__(self):
+        self.request_sent = False
+
+
+class _Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncDevicePool:
+    """Keep-alive HTTP/1.1 connection pool keyed by device address.
+
+    Requests are reported to the request hooks unless ``observed`` is False
+    (for pools that talk to something other than a feeder).
+    """
+
+    def __init__(self, max_per_device=MAX_CONNECTIONS_PER_DEVICE, observed=True):
+        self.max_per_device = max_per_device
+        self.observed = observed
+        self._idle = {}        # (host, port) -> [_Connection]
+        self._semaphores = {}  # (host, port) -> asyncio.Semaphore
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+    async def request(self, method, host, port, path, payload=None, timeout=DEFAULT_TIMEOUT, headers=None):
+        """Send a request and return a ``DeviceResponse``.
+
+        Raises ``DeviceConnectionError`` (a ``requests`` ConnectionError) or
+        a ``requests`` ConnectTimeout/ReadTimeout, depending on whether the
+        request had been written, so callers can keep their existing
+        ``except requests.exceptions.RequestException`` handling.
+        """
+        key = (host, int(port))
+        semaphore = self._semaphores.setdefault(key, asyncio.Semaphore(self.max_per_device))
+        body = b'' if payload is None else json.dumps(payload).encode()
+        started = time.perf_counter()
+        progress = _Progress()
+        async with semaphore:
+            try:
+                response = await asyncio.wait_for(
+                    self._send(key, method, path, body, started, headers, progress), timeout
+                )
+            except asyncio.TimeoutError:
+                if progress.request_sent:
+                    error = requests.exceptions.ReadTimeout(f"Timed out waiting for {host}:{port} to answer")
+                else:
+                    error = requests.exceptions.ConnectTimeout(f"Timed out connecting to {host}:{port}")
+                if self.observed:
+                    _notify_hooks(method, key, None, time.perf_counter() - started, error)
+                raise error
+            except requests.exceptions.RequestException as e:
+                if self.observed:
+                    _notify_hooks(method, key, None, time.perf_counter() - started, e)
+                raise
+        if self.observed:
+            _notify_hooks(method, key, response.status_code, response.elapsed)
+        return response
+
+    async def post_json(self, host, port, path, payload, timeout=DEFAULT_TIMEOUT):
+        return await self.request('POST', host, port, path, payload, timeout)
+
+    async def _send(self, key, method, path, body, started, extra_headers=None, progress=None):
+        progress = progress or _Progress()
+        # A pooled connection may have been closed by the device while idle;
+        # retry once on a fresh connection in that case.
+        for attempt in range(2):
+            progress.request_sent = False
+            conn, reused = await self._acquire(key)
+            try:
+                status_code, headers, content = await self._roundtrip(
+                    conn, key, method, path, body, extra_headers, progress
+                )
+            except (ConnectionError, asyncio.IncompleteReadError, OSError) as e:
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise DeviceConnectionError(f"Failed to reach {key[0]}:{key[1]}: {e}",
+                                            request_sent=progress.request_sent)
+            except BaseException:
+                conn.close()
+                raise
+            if headers.get('connection', '').lower() == 'close':
+                conn.close()
+            else:
+                self._idle.setdefault(key, []).append(conn)
+            self.requests_sent += 1
+            return DeviceResponse(status_code, content, headers, time.perf_counter() - started)
+
+    async def _acquire(self, key):
+        idle = self._idle.get(key)
+        while idle:
+            conn = idle.pop()
+            if not conn.writer.is_closing() and not conn.reader.at_eof():
+                return conn, True
+        try:
+            reader, writer = await asyncio.open_connection(*key)
+        except OSError as e:
+            raise DeviceConnectionError(f"Failed to connect to {key[0]}:{key[1]}: {e}")
+        self.connections_opened += 1
+        return _Connection(reader, writer), False
+
+    async def _roundtrip(self, conn, key, method, path, body, extra_headers=None, progress=None):
+        head = (
+            f"{method} {path} HTTP/1.1\r\n"
+            f"Host: {key[0]}:{key[1]}\r\n"
+            "Connection: keep-alive\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+        )
+        for name, value in (extra_headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        head += "\r\n"
+        if progress is not None:
+            progress.request_sent = True  # From here on the device may act on it
+        conn.writer.write(head.encode('latin-1') + body)
+        await conn.writer.drain()
+
+        status_line = await conn.reader.readuntil(b'\r\n')
+        parts = status_line.decode('latin-1').split(' ', 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ConnectionError(f"Malformed status line {status_line!r}")
+        status_code = int(parts[1])
+
+        headers = {}
+        while True:
+            line = await conn.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = await self._read_chunked(conn.reader)
+        elif 'content-length' in headers:
+            content = await conn.reader.readexactly(int(headers['content-length']))
+        else:
+            # No framing: the body runs until the device closes the socket
+            content = await conn.reader.read()
+            headers['connection'] = 'close'
+        return status_code, headers, content
+
+    @staticmethod
+    async def _read_chunked(reader):
+        chunks = []
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            if size == 0:
+                await reader.readuntil(b'\r\n')
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+    async def close(self):
+        for connections in self._idle.values():
+            for conn in connections:
+                conn.close()
+        self._idle.clear()
+
+
+# One pool per event loop: connections cannot be shared across loops.
+_pools = weakref.WeakKeyDictionary()
+
+
+def get_async_pool():
+    """Return the connection pool bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = AsyncDevicePool()
+    return pool
+
+
+async def close_async_pool():
+    """Close the pool bound to the running event loop, if there is one."""
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.close()
+
+
+def close_async_pools(timeout=1):
+    """Close every event loop's pool; registered to run at interpreter exit."""
+    for loop, pool in list(_pools.items()):
+        _pools.pop(loop, None)
+        if loop.is_closed():
+            continue  # Its transports cannot be closed any more; the process exit releases them
+        try:
+            if loop.is_running():
+                asyncio.run_coroutine_threadsafe(pool.close(), loop).result(timeout)
+            else:
+                loop.run_until_complete(pool.close())
+        except Exception:
+            pass  # Best effort during shutdown
+
+
+atexit.register(close_async_pools)
+
+
+async def send_motor_command_async(device, data, timeout=DEFAULT_TIMEOUT):
+    """POST a motor command to a device over the pooled async client."""
+    return await get_async_pool().post_json(device.ip_address, device.port, '/motor', data, timeout)
@@ -0,0 +1,136 @@
+"""Process-local cache resolving firmware device_ids to devices.
+
+Firmware endpoints identify the caller by ``device_id`` on every request.
+The resolver keeps device_id -> ESP8266Device in memory so the hot path
+does not query the database. Entries are dropped when a device is saved or
+deleted in this process and after the bulk writes of the heartbeat flush
+and the stale sweep. Saves and deletes made by other processes are noticed
+through the ``devices:registry`` change counter, which model saves and
+deletes bump and which is read at most once every
+``FEEDER_DEVICE_CACHE_CHECK_INTERVAL`` seconds; entries cached under an
+older registry generation are not served. Presence writes (heartbeat
+flushes, the stale sweep) do not bump it, so they never empty the cache of
+other processes. Cached instances are shared between threads and must be
+treated as read-only.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from . import counters
+from .heartbeat import heartbeat_buffer
+from .models import ESP8266Device
+
+DEFAULT_CACHE_TTL = 60  # seconds
+DEFAULT_CHECK_INTERVAL = 1  # seconds between reads of the registry generation
+REGISTRY_COUNTER = 'devices:registry'
+
+
+def registry_generation():
+    """Generation of the device registry: moves when a device is saved or deleted, not on presence updates."""
+    return counters.read(REGISTRY_COUNTER)
+
+
+class DeviceResolver:
+    """Resolves device_id strings to ESP8266Device instances with caching."""
+
+    def __init__(self, ttl=None, check_interval=None):
+        self._ttl = ttl
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._by_device_id = {}  # device_id -> (device, cached_at, generation)
+        self._device_ids = {}    # device pk -> device_id
+        self._generation = None
+        self._checked_at = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def ttl(self):
+        if self._ttl is not None:
+            return self._ttl
+        return getattr(settings, 'FEEDER_DEVICE_CACHE_TTL', DEFAULT_CACHE_TTL)
+
+    @property
+    def check_interval(self):
+        if self._check_interval is not None:
+            return self._check_interval
+        return getattr(settings, 'FEEDER_DEVICE_CACHE_CHECK_INTERVAL', DEFAULT_CHECK_INTERVAL)
+
+    def _current_generation(self, now):
+        """Return the registry generation, re-reading it once per check interval."""
+        if self._checked_at is None or now - self._checked_at >= self.check_interval:
+            current = registry_generation()
+            with self._lock:
+                if current != self._generation:
+                    self._by_device_id.clear()
+                    self._device_ids.clear()
+                    self._generation = current
+                self._checked_at = now
+        return self._generation
+
+    def get(self, device_id):
+        """Return the device registered under device_id, or None."""
+        if not device_id:
+            return None
+        now = time.monotonic()
+        current = self._current_generation(now)
+        entry = self._by_device_id.get(device_id)
+        if entry is not None and now - entry[1] < self.ttl and entry[2] == current:
+            self.hits += 1
+            return entry[0]
+
+        self.misses += 1
+        device = ESP8266Device.objects.filter(device_id=device_id).first()
+        if device is not None:
+            with self._lock:
+                self._by_device_id[device_id] = (device, now, current)
+                self._device_ids[device.pk] = device_id
+        return device
+
+    def invalidate(self, device):
+        """Forget a device under both its current and any previous device_id."""
+        with self._lock:
+            previous = self._device_ids.pop(device.pk, None)
+            for device_id in (previous, device.device_id):
+                if device_id is not None:
+                    self._by_device_id.pop(device_id, None)
+
+    def invalidate_pks(self, device_pks):
+        """Forget devices by pk, after a bulk write that bypassed the model signals."""
+        with self._lock:
+            for device_pk in device_pks:
+                device_id = self._device_ids.pop(device_pk, None)
+                if device_id is not None:
+                    self._by_device_id.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._by_device_id.clear()
+            self._device_ids.clear()
+            self._generation = self._checked_at = None
+
+
+device_resolver = DeviceResolver()
+
+
+def get_device(device_id):
+    """Shortcut for resolving a firmware device_id through the shared resolver."""
+    return device_resolver.get(device_id)
+
+
+@receiver(post_save, sender=ESP8266Device)
+def _device_saved(sender, instance, raw=False, **kwargs):
+    device_resolver.invalidate(instance)
+    if not raw:
+        counters.bump([REGISTRY_COUNTER])
+
+
+@receiver(post_delete, sender=ESP8266Device)
+def _device_deleted(sender, instance, **kwargs):
+    device_resolver.invalidate(instance)
+    heartbeat_buffer.forget(instance.pk)
+    counters.bump([REGISTRY_COUNTER])
@@ -0,0 +1,163 @@
+"""Concurrent fan-out of feed commands to many feeders.
+
+Used by the bulk feed endpoint: commands for every selected device are
+written with one ``bulk_create`` and pushed to the devices concurrently
+through the async client, bounded by ``FEEDER_DISPATCH_CONCURRENCY``.
+
+Requests go through the keep-alive pool of the running event loop. WSGI
+views have no loop of their own, and ``async_to_sync`` would start a new
+one (and so a new pool) for every call, so they use
+``dispatch_motor_commands_sync``: it runs the dispatch on one background
+loop per process, whose pool lives as long as the process does.
+"""
+import asyncio
+import atexit
+import re
+import threading
+import time
+
+import requests
+from django.conf import settings
+
+from .device_client import close_async_pool, device_address, get_async_pool
+from .health import device_breaker, is_connect_failure
+from .models import ESP8266Device
+
+DEFAULT_DISPATCH_CONCURRENCY = 50
+DEFAULT_DISPATCH_TIMEOUT = 5  # seconds
+STEPS_PER_PORTION = 200  # Same conversion feed_control uses
+
+
+def dispatch_concurrency():
+    return getattr(settings, 'FEEDER_DISPATCH_CONCURRENCY', DEFAULT_DISPATCH_CONCURRENCY)
+
+
+def glob_to_regex(pattern):
+    """Translate a shell-style name pattern ('Kennel *', 'Feeder-?') to an anchored regex."""
+    parts = []
+    for char in pattern:
+        if char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(char))
+    return '^' + ''.join(parts) + '$'
+
+
+def select_devices(all_active=False, device_ids=None, name_pattern=None):
+    """Return the devices matching every selector that was given."""
+    devices = ESP8266Device.objects.all()
+    if all_active:
+        devices = devices.filter(is_active=True)
+    if device_ids:
+        devices = devices.filter(device_id__in=device_ids)
+    if name_pattern:
+        devices = devices.filter(name__iregex=glob_to_regex(name_pattern))
+    return devices.order_by('pk')
+
+
+class DispatchResult:
+    """Outcome of pushing one command to one device."""
+
+    def __init__(self, device, command, http_status=None, error=None, latency=None, connect_failed=False):
+        self.device = device
+        self.command = command
+        self.http_status = http_status
+        self.error = error
+        self.latency = latency
+        self.connect_failed = connect_failed
+
+    @property
+    def delivered(self):
+        return self.http_status == 200
+
+    @property
+    def unreachable(self):
+        """The request never reached the device, so it is safe to hand the command to a poll."""
+        return self.http_status is None and self.connect_failed
+
+    def as_dict(self):
+        if self.delivered:
+            outcome = 'completed'
+        elif self.unreachable:
+            outcome = 'queued'
+        else:
+            outcome = 'failed'
+        return {
+            'device_id': self.device.device_id,
+            'name': self.device.name,
+            'command_id': str(self.command.id),
+            'status': outcome,
+            'http_status': self.http_status,
+            'latency_ms': None if self.latency is None else round(self.latency * 1000, 1),
+            'error': self.error,
+        }
+
+
+async def dispatch_motor_commands(jobs, concurrency=None, timeout=DEFAULT_DISPATCH_TIMEOUT):
+    """Send ``(device, command, motor_data)`` jobs concurrently and return DispatchResults.
+
+    At most ``concurrency`` requests are in flight at once, over the
+    running loop's pool. Devices whose circuit breaker is open are not
+    contacted and come back as unreachable. A read timeout is not
+    unreachable: the device may have acted on the command, so it comes back
+    failed.
+    """
+    pool = get_async_pool()
+    semaphore = asyncio.Semaphore(concurrency or dispatch_concurrency())
+
+    async def send(device, command, data):
+        if not device_breaker.allow(device_address(device)):
+            # Known-unreachable: report it as such without tying up a slot
+            return DispatchResult(device, command, error='Circuit open after repeated connect failures',
+                                  connect_failed=True)
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await pool.post_json(device.ip_address, device.port, '/motor', data, timeout)
+            except requests.exceptions.RequestException as e:
+                return DispatchResult(device, command, error=str(e), latency=time.perf_counter() - started,
+                                      connect_failed=is_connect_failure(e))
+            error = None if response.status_code == 200 else response.text[:200]
+            return DispatchResult(device, command, response.status_code, error, time.perf_counter() - started)
+
+    return await asyncio.gather(*(send(*job) for job in jobs))
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _dispatch_loop():
+    """The process's background dispatch loop, started on first use."""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='device-dispatch', daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+def dispatch_motor_commands_sync(jobs, concurrency=None, timeout=DEFAULT_DISPATCH_TIMEOUT):
+    """Blocking ``dispatch_motor_commands`` for sync code, run on the background dispatch loop."""
+    future = asyncio.run_coroutine_threadsafe(dispatch_motor_commands(jobs, concurrency, timeout), _dispatch_loop())
+    return future.result()
+
+
+def stop_dispatch_loop(timeout=1):
+    """Close the dispatch loop's pool and stop the loop; registered to run at interpreter exit."""
+    global _loop
+    with _loop_lock:
+        loop, _loop = _loop, None
+    if loop is None:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(close_async_pool(), loop).result(timeout)
+    except Exception:
+        pass  # Best effort during shutdown
+    loop.call_soon_threadsafe(loop.stop)
+
+
+atexit.register(stop_dispatch_loop)
@@ -0,0 +1,438 @@
+"""Shared event log behind the live dashboard stream.
+
+Writers publish small JSON-ready events: ``device`` (presence and
+configuration changes), ``history`` (new FeedingHistory rows) and
+``command`` (DeviceCommand status changes). While anyone is listening,
+each event is a ``LiveEvent`` row written in the same transaction as the
+change it describes. Events from the outbox workers, the scheduler, other
+web workers and other nodes therefore reach every dashboard, and a
+rolled-back change publishes nothing.
+
+With no dashboard open anywhere, publishing writes nothing. A process
+with open streams holds a lease: the ``events:listeners`` change counter
+stores until when it has subscribers, and it renews the lease while they
+stay. Publishers read the lease at most every ``LEASE_CHECK_INTERVAL``
+seconds, so a stream opened in another process is noticed within that
+time.
+
+Each process with open streams runs one relay thread. It reads new rows
+every ``FEEDER_EVENT_POLL_INTERVAL`` seconds and fans them out to its
+subscribers. Commits in the same process wake it at once. Each dashboard
+connected to ``/api/events/`` holds one subscription, so an open page
+costs an in-memory append per event rather than a list query of its own.
+
+Roughly the last ``FEEDER_EVENT_HISTORY`` events are kept, so a
+reconnecting ``EventSource`` can resume from its ``Last-Event-ID`` on any
+worker. Event ids are the row ids. Subscribers that fall too far behind
+lose their oldest events, and the stream then tells the page to reload.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import counters
+from .models import DeviceCommand, ESP8266Device, FeedingHistory, LiveEvent
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EVENT_HISTORY = 500
+DEFAULT_POLL_INTERVAL = 1.0  # seconds between reads of the event log
+TRIM_EVERY = 100  # events this process publishes between trims of the log
+LEASE_COUNTER = 'events:listeners'
+LEASE_DURATION = 30  # seconds a process's streams keep publishers logging
+LEASE_CHECK_INTERVAL = 5  # seconds between publishers' reads of the lease
+DEFAULT_STREAM_DURATION = 300  # seconds before the browser is asked to reconnect
+SUBSCRIBER_BACKLOG = 1000
+KEEPALIVE_INTERVAL = 15  # seconds, below common proxy idle timeouts
+RECONNECT_DELAY_MS = 2000
+
+# Sent when events were lost (history gap or a slow consumer); pages reload
+RESET = 'event: reset\ndata: {}\n\n'
+
+EVENT_KINDS = ('device', 'history', 'command')
+
+
+class Event:
+    __slots__ = ('id', 'kind', 'data')
+
+    def __init__(self, id, kind, data):
+        self.id = id
+        self.kind = kind
+        self.data = data
+
+    def encode(self):
+        """Server-Sent Events wire format."""
+        return f"id: {self.id}\nevent: {self.kind}\ndata: {json.dumps(self.data, separators=(',', ':'))}\n\n"
+
+
+class Subscription:
+    """Queue of events for one consumer, readable from threads or an event loop."""
+
+    def __init__(self, kinds=None, device_pk=None):
+        self.kinds = set(kinds or EVENT_KINDS)
+        self.device_pk = device_pk
+        self.overflowed = False
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._loop = None
+        self._ready = None
+
+    def bind_loop(self):
+        """Let ``aget`` wait on the running event loop."""
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+
+    def wants(self, event):
+        if event.kind not in self.kinds:
+            return False
+        return self.device_pk is None or event.data.get('device') == self.device_pk
+
+    def push(self, event):
+        with self._condition:
+            if len(self._queue) >= SUBSCRIBER_BACKLOG:
+                self._queue.popleft()
+                self.overflowed = True
+            self._queue.append(event)
+            self._condition.notify()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    def _drain(self):
+        events = list(self._queue)
+        self._queue.clear()
+        return events
+
+    def get(self, timeout):
+        """Block up to ``timeout`` seconds and return the queued events (possibly none)."""
+        with self._condition:
+            if not self._queue:
+                self._condition.wait(timeout)
+            return self._drain()
+
+    async def aget(self, timeout):
+        if not self._queue:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        with self._condition:
+            return self._drain()
+
+
+class EventBus:
+    """Publish/subscribe fan-out through the ``LiveEvent`` log."""
+
+    def __init__(self, history=None, poll_interval=None):
+        self._history = history
+        self._poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._last_id = None  # newest event handed to this process's subscribers
+        self._relay = None
+        self._wakeup = threading.Event()
+        self._since_trim = 0
+        self._lease_until = 0  # epoch seconds until which some process has listeners
+        self._lease_checked = None
+        self._lease_renewed = None
+        self.published = 0
+        self.skipped = 0
+
+    @property
+    def history(self):
+        if self._history is not None:
+            return self._history
+        return getattr(settings, 'FEEDER_EVENT_HISTORY', DEFAULT_EVENT_HISTORY)
+
+    @property
+    def poll_interval(self):
+        if self._poll_interval is not None:
+            return self._poll_interval
+        return getattr(settings, 'FEEDER_EVENT_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+
+    def listening(self):
+        """Whether any process has open streams, so events are worth logging."""
+        with self._lock:
+            if self._subscribers:
+                return True
+            now = time.monotonic()
+            if self._lease_checked is not None and now - self._lease_checked < LEASE_CHECK_INTERVAL:
+                return time.time() < self._lease_until
+            self._lease_checked = now
+        until = counters.read(LEASE_COUNTER)
+        with self._lock:
+            self._lease_until = until
+        return time.time() < until
+
+    def renew_lease(self):
+        """Keep other processes logging events for this process's subscribers."""
+        until = int(time.time()) + LEASE_DURATION
+        counters.advance(LEASE_COUNTER, until)
+        with self._lock:
+            self._lease_until = max(self._lease_until, until)
+            self._lease_renewed = time.monotonic()
+
+    def _lease_due(self):
+        with self._lock:
+            return self._lease_renewed is None or time.monotonic() - self._lease_renewed >= LEASE_DURATION / 3
+
+    def publish(self, kind, items):
+        """Log one event per item in the current transaction, if anyone listens.
+
+        Every process sees the events once the transaction commits; this
+        process's relay is woken then rather than at its next poll.
+        """
+        if not self.listening():
+            with self._lock:
+                self.skipped += 1
+            return
+        created = LiveEvent.objects.bulk_create([LiveEvent(kind=kind, data=item) for item in items])
+        if not created:
+            return
+        with self._lock:
+            self.published += len(created)
+            self._since_trim += len(created)
+            trim = self._since_trim >= TRIM_EVERY
+            if trim:
+                self._since_trim = 0
+        transaction.on_commit(self._wakeup.set)
+        if trim:
+            self.trim()
+
+    def trim(self):
+        """Delete all but the newest ``history`` events."""
+        cutoff = LiveEvent.objects.order_by('-id').values_list('id', flat=True)[self.history:self.history + 1].first()
+        if cutoff is not None:
+            LiveEvent.objects.filter(id__lte=cutoff).delete()
+
+    def newest_id(self):
+        return LiveEvent.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+    def subscribe(self, subscription, last_event_id=None):
+        """Start delivering to ``subscription``; returns False if the replay gap is too large.
+
+        With ``last_event_id`` the missed events still in the log are queued
+        first, so a reconnecting client sees nothing twice and misses nothing
+        that is still remembered.
+        """
+        with self._lock:
+            if self._relay is None:
+                self._last_id = self.newest_id()
+                self._relay = threading.Thread(target=self._run_relay, name='event-relay', daemon=True)
+                self._relay.start()
+            self._subscribers.add(subscription)
+            # The relay delivers everything after this; the replay covers the rest
+            replay_until = self._last_id
+        if self._lease_due():
+            self.renew_lease()
+        if last_event_id is None:
+            return True
+        missed = list(
+            LiveEvent.objects.filter(id__gt=last_event_id, id__lte=replay_until).order_by('id')[:self.history + 1]
+        )
+        # Trimming removes the oldest events first: nothing the client missed
+        # is gone if the log still reaches back to its last event
+        oldest = LiveEvent.objects.order_by('id').values_list('id', flat=True).first()
+        if (oldest is not None and oldest > last_event_id + 1) or len(missed) > self.history:
+            return False
+        for row in missed:
+            event = Event(row.id, row.kind, row.data)
+            if subscription.wants(event):
+                subscription.push(event)
+        return True
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def relay_once(self):
+        """Hand the events logged since the last call to the subscribers; returns how many."""
+        with self._lock:
+            after = self._last_id
+        if after is None:
+            return 0
+        rows = list(LiveEvent.objects.filter(id__gt=after).order_by('id')[:SUBSCRIBER_BACKLOG])
+        with self._lock:
+            events = [Event(row.id, row.kind, row.data) for row in rows if row.id > self._last_id]
+            if events:
+                self._last_id = events[-1].id
+            subscribers = list(self._subscribers)
+        for event in events:
+            for subscription in subscribers:
+                if subscription.wants(event):
+                    subscription.push(event)
+        return len(events)
+
+    def _run_relay(self):
+        try:
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        self._relay = None
+                        return
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                try:
+                    if self._lease_due():
+                        self.renew_lease()
+                    while self.relay_once() >= SUBSCRIBER_BACKLOG:
+                        pass
+                except Exception:
+                    logger.exception("Event relay failed")
+        finally:
+            connection.close()
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': len(self._subscribers), 'published': self.published, 'skipped': self.skipped}
+
+
+event_bus = EventBus()
+
+
+def stream_duration():
+    return getattr(settings, 'FEEDER_SSE_MAX_DURATION', DEFAULT_STREAM_DURATION)
+
+
+def stream(subscription, last_event_id=None):
+    """Yield one ``text/event-stream`` response body, for WSGI workers.
+
+    The stream ends after ``FEEDER_SSE_MAX_DURATION`` seconds; EventSource
+    reconnects on its own and resumes from the last id it saw.
+    """
+    complete = event_bus.subscribe(subscription, last_event_id)
+    try:
+        yield f'retry: {RECONNECT_DELAY_MS}\n\n'
+        if not complete:
+            yield RESET
+            return
+        deadline = time.monotonic() + stream_duration()
+        while time.monotonic() < deadline:
+            events = subscription.get(min(KEEPALIVE_INTERVAL, max(deadline - time.monotonic(), 0)))
+            if subscription.overflowed:
+                yield RESET
+                return
+            yield ''.join(event.encode() for event in events) if events else ': ping\n\n'
+    finally:
+        event_bus.unsubscribe(subscription)
+
+
+async def astream(subscription, last_event_id=None):
+    """``stream`` for ASGI servers: waiting costs no thread."""
+    subscription.bind_loop()
+    complete = await sync_to_async(event_bus.subscribe)(subscription, last_event_id)
+    try:
+        yield f'retry: {RECONNECT_DELAY_MS}\n\n'
+        if not complete:
+            yield RESET
+            return
+        deadline = time.monotonic() + stream_duration()
+        while time.monotonic() < deadline:
+            events = await subscription.aget(min(KEEPALIVE_INTERVAL, max(deadline - time.monotonic(), 0)))
+            if subscription.overflowed:
+                yield RESET
+                return
+            yield ''.join(event.encode() for event in events) if events else ': ping\n\n'
+    finally:
+        event_bus.unsubscribe(subscription)
+
+
+# ------------------------
+# Event payloads
+# ------------------------
+
+def device_event(device, online=None):
+    return {
+        'device': device.pk,
+        'device_id': device.device_id,
+        'name': device.name,
+        'ip_address': device.ip_address,
+        'is_active': device.is_active if online is None else online,
+        'last_connected': device.last_connected.isoformat() if device.last_connected else None,
+    }
+
+
+def history_event(entry):
+    labels = dict(FeedingHistory.FEED_TYPES)
+    # Only use a device the caller already loaded; no query per event
+    device = entry.device if FeedingHistory.device.is_cached(entry) else None
+    return {
+        'id': entry.pk,
+        'device': entry.device_id,
+        'device_name': device.name if device is not None else None,
+        # Same fields the history page renders, plus the local day the rollups use
+        'date': entry.timestamp.strftime('%Y-%m-%d'),
+        'time': entry.timestamp.strftime('%H:%M'),
+        'day': timezone.localtime(entry.timestamp).date().isoformat() if timezone.is_aware(entry.timestamp)
+        else entry.timestamp.date().isoformat(),
+        'portion': entry.portion,
+        'feed_type': entry.feed_type,
+        'type': labels.get(entry.feed_type, entry.feed_type),
+    }
+
+
+def command_event(command_id, device_pk, status, command_type=None):
+    return {'id': str(command_id), 'device': device_pk, 'status': status, 'command_type': command_type}
+
+
+def publish_history(entries):
+    event_bus.publish('history', (history_event(entry) for entry in entries))
+
+
+def publish_command_status(commands, status=None, device_pk=None):
+    """Publish status changes for commands updated without ``save()``.
+
+    ``status`` overrides the status stored on the instances, for callers
+    that moved rows with ``QuerySet.update``; ``device_pk`` saves loading
+    the device column of commands fetched with ``only()``.
+    """
+    event_bus.publish('command', (
+        command_event(command.pk, device_pk or command.device_id, status or command.status, command.command_type)
+        for command in commands
+    ))
+
+
+def publish_transitions(entries):
+    """Publish ``(command_id, device_pk, status, command_type)`` status changes."""
+    event_bus.publish('command', (command_event(*entry) for entry in entries))
+
+
+def publish_presence(entries):
+    """Publish ``(device_pk, ip_address, seen_at, online)`` presence changes."""
+    event_bus.publish('device', (
+        {
+            'device': device_pk,
+            'ip_address': ip_address,
+            'is_active': online,
+            'last_connected': seen_at.isoformat() if seen_at else None,
+        }
+        for device_pk, ip_address, seen_at, online in entries
+    ))
+
+
+@receiver(post_save, sender=FeedingHistory)
+def _history_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        publish_history([instance])
+
+
+@receiver(post_save, sender=DeviceCommand)
+def _command_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        publish_command_status([instance])
+
+
+@receiver(post_save, sender=ESP8266Device)
+def _device_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        event_bus.publish('device', [device_event(instance)])
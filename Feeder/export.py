@@ -0,0 +1,118 @@
+"""Streaming CSV/NDJSON export of feeding history and device commands.
+
+Rows are read with ``QuerySet.iterator()`` (a server-side cursor where the
+database supports it) and encoded chunk by chunk, so memory use stays flat
+no matter how large the table is. Output can be gzip-compressed on the fly.
+"""
+import csv
+import json
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import DeviceCommand, FeedingHistory
+
+DEFAULT_CHUNK_SIZE = 2000
+FORMATS = ('csv', 'ndjson')
+
+# name -> (queryset factory, exported columns, column holding the timestamp)
+EXPORTS = {
+    'history': (
+        lambda: FeedingHistory.objects.order_by('timestamp', 'id'),
+        ['id', 'device__device_id', 'device__name', 'timestamp', 'portion', 'feed_type'],
+        'timestamp',
+    ),
+    'commands': (
+        lambda: DeviceCommand.objects.order_by('created_at'),
+        ['id', 'device__device_id', 'command_type', 'status', 'parameters', 'created_at', 'updated_at'],
+        'created_at',
+    ),
+}
+
+
+def export_queryset(name, device_id=None, since=None, until=None):
+    """Return ``(queryset, columns)`` for a named export with optional filters."""
+    factory, columns, time_field = EXPORTS[name]
+    queryset = factory()
+    if device_id:
+        queryset = queryset.filter(device__device_id=device_id)
+    if since:
+        queryset = queryset.filter(**{f'{time_field}__gte': since})
+    if until:
+        queryset = queryset.filter(**{f'{time_field}__lt': until})
+    return queryset.values_list(*columns), columns
+
+
+def parse_bound(value):
+    """Parse an ISO 8601 datetime filter, treating naive values as local time."""
+    if not value:
+        return None
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(f'Invalid datetime: {value}')
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+class _Echo:
+    """File-like object whose write() hands the line back to the caller."""
+
+    def write(self, value):
+        return value
+
+
+def _header(column):
+    return column.replace('__', '_')
+
+
+def _cell(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def iter_csv(rows, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([_header(column) for column in columns])
+    lines = []
+    for row in rows:
+        lines.append(writer.writerow([_cell(value) for value in row]))
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+def iter_ndjson(rows, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+    encoder = DjangoJSONEncoder(separators=(',', ':'))
+    keys = [_header(column) for column in columns]
+    lines = []
+    for row in rows:
+        lines.append(encoder.encode(dict(zip(keys, row))) + '\n')
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+
+def iter_gzip(chunks):
+    """Gzip a stream of text chunks incrementally."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream_export(name, fmt='csv', compress=False, chunk_size=DEFAULT_CHUNK_SIZE, **filters):
+    """Yield the encoded export (str chunks, or bytes when compressed)."""
+    queryset, columns = export_queryset(name, **filters)
+    rows = queryset.iterator(chunk_size=chunk_size)
+    chunks = iter_csv(rows, columns, chunk_size) if fmt == 'csv' else iter_ndjson(rows, columns, chunk_size)
+    return iter_gzip(chunks) if compress else chunks
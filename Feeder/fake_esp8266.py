@@ -0,0 +1,115 @@
+"""Local stand-in for the ESP8266 firmware's web server.
+
+Serves the same ``GET /``, ``GET /status`` and ``POST /motor`` routes as
+``ESP8266_Django_PetFeeder.ino`` with configurable latency and failure
+rate, so device dispatch can be exercised and benchmarked offline.
+"""
+import asyncio
+import json
+import random
+
+
+class FakeESP8266:
+    """One simulated feeder listening on a local port."""
+
+    def __init__(self, device_id, host='127.0.0.1', port=0, latency=0.0, failure_rate=0.0):
+        self.device_id = device_id
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.microstepping = 16
+        self.motor_commands = []
+        self.connections = 0
+        self._server = None
+        self._writers = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Drop kept-alive client connections too, like a feeder going offline
+            for writer in list(self._writers):
+                writer.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                status_code, payload = self._route(method, path, body)
+                content = json.dumps(payload).encode()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                writer.write((
+                    f"HTTP/1.1 {status_code} {'OK' if status_code == 200 else 'Error'}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(content)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                ).encode('latin-1') + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    def _route(self, method, path, body):
+        path = path.split('?', 1)[0]
+        if method == 'GET' and path == '/':
+            return 200, {'device': 'ESP8266 Pet Feeder', 'device_id': self.device_id}
+        if method == 'GET' and path == '/status':
+            return 200, {
+                'status': 'running',
+                'device_id': self.device_id,
+                'ip': self.host,
+                'microstepping': self.microstepping,
+                'motor_enabled': False,
+                'is_feeding': False,
+            }
+        if method == 'POST' and path == '/motor':
+            if self.failure_rate and random.random() < self.failure_rate:
+                return 500, {'status': 'error', 'message': 'Simulated motor fault'}
+            try:
+                data = json.loads(body or b'{}')
+            except ValueError:
+                return 400, {'status': 'error', 'message': 'Invalid JSON'}
+            self.motor_commands.append(data)
+            self.microstepping = int(data.get('microstepping', self.microstepping))
+            return 200, {'status': 'success', 'message': 'Motor command executed', 'steps': data.get('steps')}
+        return 404, {'status': 'error', 'message': 'Not found'}
+
+
+async def start_fleet(count, host='127.0.0.1', base_port=0, latency=0.0, failure_rate=0.0, prefix='FakeFeeder'):
+    """Start ``count`` fake feeders; ports are consecutive from base_port or random if 0."""
+    fleet = []
+    for i in range(count):
+        port = base_port + i if base_port else 0
+        feeder = FakeESP8266(f'{prefix}{i + 1}', host, port, latency, failure_rate)
+        fleet.append(await feeder.start())
+    return fleet
+
+
+async def stop_fleet(fleet):
+    await asyncio.gather(*(feeder.stop() for feeder in fleet))
@@ -0,0 +1,243 @@
+"""Lightweight request path for the high-frequency firmware endpoints.
+
+Heartbeats, feed notifications and acknowledgements arrive from every
+feeder every few seconds. Under ``@api_view`` each one wraps the request,
+negotiates content, runs the authenticators, permission and throttle
+checks, and builds a serializer with a dozen field and validator objects.
+The serializer alone costs more than the rest of the request.
+
+``FastValidator`` compiles a serializer's fields once into plain checks.
+These checks only accept values that the serializer would accept
+unchanged, and return the same validated data. For anything else,
+including every invalid request, the serializer itself runs, so error
+responses are exactly the serializer's.
+
+``firmware_endpoint`` builds the usual DRF view around a handler, with a
+fast path in front of it. A POST with a JSON, MessagePack or CBOR body,
+no credentials or cookies, an ``Accept`` the request's own encoding
+satisfies, and data the precompiled checks accept skips DRF entirely.
+Every other request takes the full DRF view. Compare the two with
+``manage.py bench_firmware_path``.
+"""
+import io
+import re
+import uuid
+from functools import wraps
+
+from rest_framework import serializers, status
+from rest_framework.decorators import api_view
+from rest_framework.exceptions import ParseError, Throttled
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from .cluster import misrouted
+from .serializers import CommandAcknowledgmentSerializer, FeedNotificationSerializer, HeartbeatSerializer
+from .throttle import FIRMWARE, request_limiter, throttled_response
+from .wire import FIRMWARE_PARSERS, FIRMWARE_RENDERERS, firmware_wire_format
+
+_MISSING = object()  # "let the serializer decide", from a check or for an absent key
+
+_IPV4_OCTET = r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+_IPV4 = re.compile(rf'{_IPV4_OCTET}(?:\.{_IPV4_OCTET}){{3}}')
+
+
+def _string_check(field):
+    """Already-clean ASCII strings, which CharField returns unchanged."""
+    min_length = max(field.min_length or 0, 1)
+    max_length = field.max_length
+
+    def check(value):
+        if (type(value) is str and min_length <= len(value) and (max_length is None or len(value) <= max_length)
+                and value.isascii() and '\x00' not in value and value.strip() == value):
+            return value
+        return _MISSING
+    return check
+
+
+def _ip_address_check(field):
+    """Dotted-quad IPv4 addresses; IPv6 goes through the serializer."""
+    if field.protocol not in ('both', 'ipv4'):
+        return lambda value: _MISSING
+    as_string = _string_check(field)
+
+    def check(value):
+        value = as_string(value)
+        if value is not _MISSING and _IPV4.fullmatch(value):
+            return value
+        return _MISSING
+    return check
+
+
+def _integer_check(field):
+    """Real ints within the field's bounds; numeric strings go through the serializer."""
+    # Past 64 bits (CBOR bignums) str() can hit the digit limit DRF trips over
+    min_value = -2 ** 63 if field.min_value is None else max(field.min_value, -2 ** 63)
+    max_value = 2 ** 64 if field.max_value is None else min(field.max_value, 2 ** 64)
+
+    def check(value):
+        if type(value) is int and min_value <= value <= max_value:
+            return value
+        return _MISSING
+    return check
+
+
+def _uuid_check(field):
+    def check(value):
+        if type(value) is str:
+            try:
+                return uuid.UUID(hex=value)
+            except ValueError:
+                pass
+        return _MISSING
+    return check
+
+
+# Most specific first: IPAddressField is a CharField
+_CHECKS = (
+    (serializers.IPAddressField, _ip_address_check),
+    (serializers.UUIDField, _uuid_check),
+    (serializers.IntegerField, _integer_check),
+    (serializers.CharField, _string_check),
+)
+_PLAIN_STRINGS = (serializers.CharField, serializers.IPAddressField)
+
+
+class FastValidator:
+    """Validates request data against a serializer's fields without instantiating it."""
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        serializer = serializer_class()
+        if (type(serializer).validate is not serializers.Serializer.validate or serializer.get_validators()
+                or isinstance(serializer, serializers.ModelSerializer)):
+            raise TypeError(f"{serializer_class.__name__} has validation beyond its fields")
+        checks = []
+        for name, field in serializer.fields.items():
+            if field.read_only:
+                continue
+            if (field.source != name or 'validators' in field._kwargs or hasattr(serializer, f'validate_{name}')
+                    or (isinstance(field, serializers.CharField) and type(field) not in _PLAIN_STRINGS)):
+                raise TypeError(f"{serializer_class.__name__}.{name} cannot be checked without the serializer")
+            for field_class, build in _CHECKS:
+                if isinstance(field, field_class):
+                    checks.append((name, build(field)))
+                    break
+            else:
+                raise TypeError(f"No fast check for {type(field).__name__} ({serializer_class.__name__}.{name})")
+        self._checks = tuple(checks)
+
+    def validate(self, data):
+        """Return the validated data, or None if only the serializer can decide."""
+        if type(data) is not dict:
+            return None
+        validated = {}
+        for name, check in self._checks:
+            value = data.get(name, _MISSING)
+            if value is _MISSING:
+                return None
+            value = check(value)
+            if value is _MISSING:
+                return None
+            validated[name] = value
+        return validated
+
+    def run(self, data):
+        """Return ``(validated_data, errors)``, exactly as the serializer would decide."""
+        validated = self.validate(data)
+        if validated is not None:
+            return validated, None
+        serializer = self.serializer_class(data=data)
+        if serializer.is_valid():
+            return serializer.validated_data, None
+        return None, serializer.errors
+
+
+heartbeat_validator = FastValidator(HeartbeatSerializer)
+feed_notification_validator = FastValidator(FeedNotificationSerializer)
+acknowledgment_validator = FastValidator(CommandAcknowledgmentSerializer)
+
+# Encodings the fast path can read and answer in: parser and renderer per media type
+_RENDERERS = {renderer.media_type: renderer for renderer in FIRMWARE_RENDERERS}
+_CODECS = {
+    parser.media_type: (parser(), _RENDERERS[parser.media_type]())
+    for parser in FIRMWARE_PARSERS if parser.media_type in _RENDERERS
+}
+
+
+def _fast_codec(request):
+    """Return ``(parser, renderer)`` if DRF would do nothing but parse and render."""
+    meta = request.META
+    if request.method != 'POST' or meta.get('HTTP_AUTHORIZATION') or meta.get('HTTP_COOKIE'):
+        # Credentials mean the authenticators have to run
+        return None
+    codec = _CODECS.get(request.content_type)
+    if codec is None:
+        return None
+    charset = request.content_params.get('charset')
+    if charset and charset.lower() not in ('utf-8', 'utf8'):
+        return None
+    if meta.get('HTTP_ACCEPT', '').strip() not in ('', '*/*', request.content_type):
+        return None
+    if meta.get('QUERY_STRING') and api_settings.URL_FORMAT_OVERRIDE in request.GET:
+        return None
+    return codec
+
+
+def firmware_endpoint(validator, scope=FIRMWARE):
+    """Turn ``handler(validated_data) -> Response`` into a firmware POST endpoint.
+
+    The result is an ``@api_view(['POST'])`` view with the firmware wire
+    formats that answers 400 with the serializer's errors, fronted by the
+    fast path described in the module docstring. Valid requests for a
+    device another node owns are redirected there; the rest draw on the
+    ``scope`` throttle bucket of their ``device_id``.
+    """
+    def decorator(handler):
+        @firmware_wire_format
+        @api_view(['POST'])
+        @wraps(handler)
+        def view(request):
+            data, errors = validator.run(request.data)
+            if errors is not None:
+                return Response(errors, status=status.HTTP_400_BAD_REQUEST)
+            misroute = misrouted(request, data['device_id'])
+            if misroute is not None:
+                return misroute
+            wait = request_limiter.acquire(scope, f"device:{data['device_id']}")
+            if wait:
+                raise Throttled(wait)
+            return handler(data)
+
+        view_class = view.cls
+        if view_class.throttle_classes or any(p is not AllowAny for p in view_class.permission_classes):
+            # Throttles and permissions have to see every request
+            return view
+        # The headers APIView.finalize_response adds
+        headers = {'Allow': ', '.join(view_class().allowed_methods), 'Vary': 'Accept'}
+
+        @wraps(view)
+        def fast_view(request):
+            codec = _fast_codec(request)
+            if codec is None:
+                return view(request)
+            parser, renderer = codec
+            try:
+                data = parser.parse(io.BytesIO(request.body), parser.media_type, {})
+            except ParseError:
+                return view(request)
+            data = validator.validate(data)
+            if data is None:
+                return view(request)
+            response = misrouted(request, data['device_id'])
+            if response is None:
+                wait = request_limiter.acquire(scope, f"device:{data['device_id']}")
+                response = throttled_response(wait) if wait else handler(data)
+            response.accepted_renderer = renderer
+            response.accepted_media_type = renderer.media_type
+            response.renderer_context = {}
+            for key, value in headers.items():
+                response[key] = value
+            return response
+        return fast_view
+    return decorator
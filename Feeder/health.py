@@ -0,0 +1,185 @@
+"""Device health: stale detection and a circuit breaker for direct calls.
+
+Heartbeats keep ``is_active`` True. ``sweep_stale_devices`` clears it for
+devices that have not been heard from for ``FEEDER_DEVICE_STALE_AFTER``
+seconds; the heartbeat flusher runs the sweep after every flush, and the
+next heartbeat from the device sets the flag again. In a cluster each node
+sweeps only the devices it owns, whose heartbeats it buffers.
+
+``device_breaker`` tracks connect failures per device address (host and
+port) through the ``device_client`` request hook. After
+``FEEDER_BREAKER_FAILURE_THRESHOLD`` consecutive failures the breaker opens
+and views stop calling the device directly for ``FEEDER_BREAKER_COOLDOWN``
+seconds, queueing feed commands for the device to pull instead. Once the cooldown has passed one request
+is let through as a probe; a success closes the breaker, a failure keeps
+it open for another cooldown.
+"""
+import datetime
+import logging
+import threading
+import time
+
+import requests
+import urllib3
+from django.conf import settings
+from django.utils import timezone
+
+from . import device_client
+from .cluster import cluster
+from .device_client import device_address
+from .devices import device_resolver
+from .events import publish_presence
+from .heartbeat import heartbeat_buffer
+from .listcache import DEVICES, bump_generation
+from .models import ESP8266Device
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STALE_AFTER = 90  # seconds, several missed firmware heartbeats
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_COOLDOWN = 60  # seconds
+
+
+def stale_after():
+    return getattr(settings, 'FEEDER_DEVICE_STALE_AFTER', DEFAULT_STALE_AFTER)
+
+
+def sweep_stale_devices(now=None):
+    """Mark active devices without a recent heartbeat inactive; returns how many were marked."""
+    now = now or timezone.now()
+    cutoff = now - datetime.timedelta(seconds=stale_after())
+    # Heartbeats still waiting in this process's buffer count as seen
+    recent = heartbeat_buffer.seen_since(cutoff)
+    stale = cluster.filter_owned(
+        ESP8266Device.objects.filter(is_active=True, last_connected__lt=cutoff).exclude(pk__in=recent)
+    )
+    rows = list(stale.values_list('pk', 'ip_address', 'last_connected'))
+    if not rows:
+        return 0
+    marked = ESP8266Device.objects.filter(pk__in=[pk for pk, _, _ in rows], is_active=True).update(is_active=False)
+    if marked:
+        logger.info("Marked %d devices stale (no heartbeat since %s)", marked, cutoff.isoformat())
+        device_resolver.invalidate_pks([pk for pk, _, _ in rows])
+        bump_generation(DEVICES)
+        publish_presence((pk, ip_address, last_connected, False) for pk, ip_address, last_connected in rows)
+    return marked
+
+
+class CircuitBreaker:
+    """Per-address consecutive-failure breaker."""
+
+    def __init__(self, failure_threshold=None, cooldown=None):
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = {}   # (host, port) -> consecutive connect failures
+        self._opened_at = {}  # (host, port) -> monotonic time the breaker (re)opened
+        self.rejected = 0
+
+    @property
+    def failure_threshold(self):
+        if self._failure_threshold is not None:
+            return self._failure_threshold
+        return getattr(settings, 'FEEDER_BREAKER_FAILURE_THRESHOLD', DEFAULT_FAILURE_THRESHOLD)
+
+    @property
+    def cooldown(self):
+        if self._cooldown is not None:
+            return self._cooldown
+        return getattr(settings, 'FEEDER_BREAKER_COOLDOWN', DEFAULT_COOLDOWN)
+
+    def allow(self, address):
+        """Return True if a direct request to ``address`` may be attempted now."""
+        if address not in self._opened_at:
+            return True
+        with self._lock:
+            opened_at = self._opened_at.get(address)
+            if opened_at is None:
+                return True
+            if time.monotonic() - opened_at >= self.cooldown:
+                # Half-open: let this caller probe and hold the others back
+                self._opened_at[address] = time.monotonic()
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_after(self, address):
+        """Seconds until the breaker for ``address`` lets a probe through (0 if closed)."""
+        opened_at = self._opened_at.get(address)
+        if opened_at is None:
+            return 0
+        return max(self.cooldown - (time.monotonic() - opened_at), 0)
+
+    def is_open(self, address):
+        return address in self._opened_at
+
+    def record_success(self, address):
+        if address in self._failures:
+            with self._lock:
+                self._failures.pop(address, None)
+                if self._opened_at.pop(address, None) is not None:
+                    logger.info("Circuit closed for device %s:%s", *address)
+
+    def record_failure(self, address):
+        with self._lock:
+            failures = self._failures[address] = self._failures.get(address, 0) + 1
+            if failures >= self.failure_threshold:
+                if address not in self._opened_at:
+                    logger.warning("Circuit opened for device %s:%s after %d connect failures", *address, failures)
+                self._opened_at[address] = time.monotonic()
+
+    def observe(self, method, address, status_code, elapsed, error=None):
+        """``device_client`` request hook: any HTTP answer counts as reachable."""
+        if error is None:
+            self.record_success(address)
+        elif isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+            self.record_failure(address)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'open': [f'{host}:{port}' for host, port in sorted(self._opened_at)],
+                'failing': len(self._failures),
+                'rejected': self.rejected,
+                'failure_threshold': self.failure_threshold,
+                'cooldown': self.cooldown,
+            }
+
+
+device_breaker = CircuitBreaker()
+device_client.add_request_hook(device_breaker.observe)
+
+
+def is_connect_failure(error):
+    """True when the request never reached the device, so sending it again cannot act twice.
+
+    Refused connections and connect timeouts qualify. Read timeouts and
+    connections dropped after the request was written do not: the device
+    may already be feeding.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    if getattr(error, 'request_sent', False):
+        return False
+    # requests reports a connection reset mid-exchange as ConnectionError(ProtocolError(...))
+    reason = error.args[0] if error.args else None
+    return not isinstance(reason, urllib3.exceptions.ProtocolError)
+
+
+def feeder_device():
+    """Device the single-feeder views talk to.
+
+    The first active device, or else the most recently seen one: a feeder
+    that went stale should still receive its commands by polling.
+    """
+    device = ESP8266Device.objects.filter(is_active=True).first()
+    if device is None:
+        device = ESP8266Device.objects.filter(last_connected__isnull=False).order_by('-last_connected').first()
+    return device
+
+
+def can_call_directly(device):
+    """Whether a view should push to ``device`` now rather than queue for pull delivery."""
+    return bool(device.is_active and device.ip_address) and device_breaker.allow(device_address(device))
@@ -0,0 +1,181 @@
+"""In-memory heartbeat buffer that coalesces device presence writes.
+
+Every feeder sends a heartbeat every few seconds. Instead of saving the
+device row on each call, heartbeats are kept in memory and the latest
+``ip_address``/``last_connected``/``is_active`` per device are written to
+the database in one bulk update per flush interval. The flusher thread
+also marks devices whose heartbeats stopped as stale (see ``health``).
+Serving processes call ``start`` at startup so the sweep runs even when
+no heartbeat arrives at all; otherwise the first heartbeat starts it.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.utils import timezone
+
+from .db import retry_on_locked
+from .events import publish_presence
+from .listcache import DEVICES, bump_generation
+from .models import ESP8266Device
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 30  # seconds
+DEFAULT_FLUSH_BATCH_SIZE = 500
+
+
+class HeartbeatBuffer:
+    """Collects device heartbeats and flushes them to the database in bulk."""
+
+    def __init__(self, flush_interval=None, batch_size=None):
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pending = {}   # device pk -> (ip_address, seen_at), not yet written
+        self._presence = {}  # device pk -> (ip_address, seen_at), live view
+        self._last_flush = time.monotonic()
+        self._flusher = None
+        self.received = 0
+        self.written = 0
+        self.flushes = 0
+
+    @property
+    def flush_interval(self):
+        if self._flush_interval is not None:
+            return self._flush_interval
+        return getattr(settings, 'FEEDER_HEARTBEAT_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL)
+
+    @property
+    def batch_size(self):
+        if self._batch_size is not None:
+            return self._batch_size
+        return getattr(settings, 'FEEDER_HEARTBEAT_FLUSH_BATCH_SIZE', DEFAULT_FLUSH_BATCH_SIZE)
+
+    def record(self, device_pk, ip_address):
+        """Record a heartbeat for a device and return the time it was seen."""
+        seen_at = timezone.now()
+        with self._lock:
+            self._pending[device_pk] = (ip_address, seen_at)
+            self._presence[device_pk] = (ip_address, seen_at)
+            self.received += 1
+            due = time.monotonic() - self._last_flush >= self.flush_interval
+        self._ensure_flusher()
+        if due:
+            self.flush()
+        return seen_at
+
+    def last_seen(self, device_pk):
+        """Return the last time a heartbeat was received from a device, or None."""
+        entry = self._presence.get(device_pk)
+        return entry[1] if entry else None
+
+    def seen_since(self, since):
+        """Return the pks of devices heard from at or after ``since``."""
+        with self._lock:
+            return [pk for pk, (_, seen_at) in self._presence.items() if seen_at >= since]
+
+    def overlay(self, devices):
+        """Apply buffered presence to device instances loaded from the database."""
+        for device in devices:
+            entry = self._presence.get(device.pk)
+            if entry and (device.last_connected is None or entry[1] > device.last_connected):
+                device.ip_address, device.last_connected = entry
+                device.is_active = True
+        return devices
+
+    def flush(self):
+        """Write all buffered heartbeats to the database and return the row count."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+
+        devices = [
+            ESP8266Device(pk=pk, ip_address=ip_address, last_connected=seen_at, is_active=True)
+            for pk, (ip_address, seen_at) in pending.items()
+        ]
+        try:
+            retry_on_locked(ESP8266Device.objects.bulk_update)(
+                devices, ['ip_address', 'last_connected', 'is_active'], batch_size=self.batch_size
+            )
+        except Exception:
+            # Put the entries back so the next flush retries them, unless a
+            # newer heartbeat for the same device arrived in the meantime.
+            with self._lock:
+                for pk, entry in pending.items():
+                    self._pending.setdefault(pk, entry)
+            logger.exception("Failed to flush %d buffered heartbeats", len(pending))
+            return 0
+
+        # Imported here: the device resolver builds on this module
+        from .devices import device_resolver
+
+        with self._lock:
+            self.written += len(devices)
+            self.flushes += 1
+        device_resolver.invalidate_pks(pending)
+        # One bump per flush, however many devices came online or moved
+        bump_generation(DEVICES)
+        # Skipped without a database write when no dashboard is open
+        publish_presence((pk, ip_address, seen_at, True) for pk, (ip_address, seen_at) in pending.items())
+        return len(devices)
+
+    def forget(self, device_pk):
+        """Drop any buffered state for a device (e.g. after it was deleted)."""
+        with self._lock:
+            self._pending.pop(device_pk, None)
+            self._presence.pop(device_pk, None)
+
+    def clear(self):
+        """Drop all buffered and tracked state without writing it."""
+        with self._lock:
+            self._pending.clear()
+            self._presence.clear()
+
+    def stats(self):
+        """Return counters describing how many writes the buffer absorbed."""
+        with self._lock:
+            pending = len(self._pending)
+            return {
+                'received': self.received,
+                'written': self.written,
+                'pending': pending,
+                'coalesced': self.received - self.written - pending,
+                'flushes': self.flushes,
+                'tracked_devices': len(self._presence),
+                'flush_interval': self.flush_interval,
+            }
+
+    def start(self):
+        """Start the flusher (and with it the stale sweep) without waiting for a heartbeat."""
+        self._ensure_flusher()
+
+    def _ensure_flusher(self):
+        """Start the background thread that flushes when heartbeats stop arriving."""
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name='heartbeat-flusher', daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        # Imported here: health builds on this module
+        from .health import sweep_stale_devices
+
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                sweep_stale_devices()
+            except Exception:
+                logger.exception("Heartbeat flusher iteration failed")
+
+
+heartbeat_buffer = HeartbeatBuffer()
+atexit.register(heartbeat_buffer.flush)
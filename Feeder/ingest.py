@@ -0,0 +1,99 @@
+"""Batched ingestion of firmware events.
+
+A device that was offline can replay its buffered feed notifications,
+heartbeats and command acknowledgements in one request. Each kind of event
+is validated with the precompiled checks of its regular serializer, which
+runs itself only for items the checks cannot vouch for, and all database
+writes for the batch happen in a single transaction.
+"""
+from django.db import transaction
+
+from .commands import ack_status, apply_acknowledgements
+from .db import retry_on_locked
+from .devices import get_device
+from .fastpath import acknowledgment_validator, feed_notification_validator, heartbeat_validator
+from .heartbeat import heartbeat_buffer
+from .models import DeviceCommand, FeedingHistory
+
+EVENT_VALIDATORS = {
+    'feed': feed_notification_validator,
+    'heartbeat': heartbeat_validator,
+    'ack': acknowledgment_validator,
+}
+
+
+def validate_events(items):
+    """Validate a list of events.
+
+    Returns ``(valid, errors)`` where ``valid`` maps item index to
+    ``(kind, validated_data)`` and ``errors`` maps item index to the
+    serializer errors for that item.
+    """
+    valid = {}
+    errors = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[index] = {'non_field_errors': ['Expected an object.']}
+        elif item.get('event') not in EVENT_VALIDATORS:
+            errors[index] = {'event': [f"\"{item.get('event')}\" is not a valid choice."]}
+        else:
+            data, item_errors = EVENT_VALIDATORS[item['event']].run(item)
+            if item_errors is None:
+                valid[index] = (item['event'], data)
+            else:
+                errors[index] = item_errors
+    return valid, errors
+
+
+@retry_on_locked
+def ingest_events(items):
+    """Validate and store a batch of events; return ``(accepted, rejected)``.
+
+    ``accepted`` is the sorted list of item indexes that were stored and
+    ``rejected`` maps the remaining indexes to their errors.
+    """
+    valid, rejected = validate_events(items)
+
+    history = []
+    heartbeats = []
+    acks = {}  # command id -> ([indexes], device, status); retried acks share one entry
+    for index in sorted(valid):
+        kind, data = valid[index]
+        device = get_device(data['device_id'])
+        if device is None:
+            rejected[index] = {'device_id': ['Device not found']}
+        elif kind == 'feed':
+            history.append((index, FeedingHistory(device=device, portion=data['portion'], feed_type=data['type'])))
+        elif kind == 'heartbeat':
+            heartbeats.append((index, device, data['ip_address']))
+        elif data['command_id'] in acks:
+            acks[data['command_id']][0].append(index)
+        else:
+            acks[data['command_id']] = ([index], device, data['status'])
+
+    accepted = [index for index, _ in history] + [index for index, _, _ in heartbeats]
+    with transaction.atomic():
+        if acks:
+            commands = DeviceCommand.objects.filter(id__in=acks.keys()).only(
+                'id', 'device_id', 'status', 'command_type', 'parameters'
+            )
+            found = {command.id: command for command in commands}
+            transitions = []
+            for command_id, (indexes, device, reported_status) in acks.items():
+                command = found.get(command_id)
+                if command is None or command.device_id != device.pk:
+                    rejected.update((index, {'command_id': ['Command not found']}) for index in indexes)
+                    continue
+                accepted.extend(indexes)
+                # Commands that are no longer 'sent' were acknowledged before
+                if command.status == 'sent':
+                    transitions.append((command, ack_status(reported_status)))
+            if transitions:
+                apply_acknowledgements(transitions)
+        if history:
+            FeedingHistory.objects.bulk_create([entry for _, entry in history])
+
+    # Presence lives in the heartbeat buffer and is flushed on its own schedule
+    for _, device, ip_address in heartbeats:
+        heartbeat_buffer.record(device.pk, ip_address)
+    return sorted(accepted), rejected
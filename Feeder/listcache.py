@@ -0,0 +1,98 @@
+"""Generation-versioned caching for the read-mostly list endpoints.
+
+Each cached table has a generation, a change counter in the database
+(see ``counters``) that is bumped in the same transaction as every write
+to the table. Every process and node therefore sees the same generation.
+Serialized list payloads are cached in Django's cache under the
+generation they were built at, and the generation doubles as a strong
+ETag. A client polling with ``If-None-Match`` gets a 304 after one
+counter read, and a plain GET is served from the cached payload until the
+next write. Model saves and deletes bump the generation through signals;
+code that writes with ``QuerySet.update`` or ``bulk_update`` must call
+``bump_generation`` itself.
+
+Payloads are keyed by generation, so the default local-memory cache is
+safe: a process never serves a payload older than the current generation.
+"""
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.http import parse_etags
+
+from . import counters
+from .models import ESP8266Device, FeedingSchedule
+
+DEFAULT_PAYLOAD_TTL = 300  # seconds; stale generations simply expire
+
+DEVICES = 'devices'
+SCHEDULES = 'schedules'
+
+
+def _generation_key(table):
+    return f'list:{table}'
+
+
+def generation(table):
+    """Return the current generation of ``table``."""
+    return counters.read(_generation_key(table))
+
+
+def bump_generation(table):
+    """Invalidate every cached payload of ``table``, together with the current transaction."""
+    counters.bump([_generation_key(table)])
+
+
+def list_etag(table, variant, version):
+    return f'"{table}-{variant}-{version}"'
+
+
+def etag_matches(request, etag):
+    """True if the request's ``If-None-Match`` names ``etag`` (or ``*``)."""
+    header = request.headers.get('If-None-Match')
+    if not header:
+        return False
+    etags = parse_etags(header)
+    return etag in etags or '*' in etags
+
+
+def cached_list(table, variant, build):
+    """Return ``(data, etag)`` for one list payload of ``table``.
+
+    ``variant`` tells apart the different payloads built from the same
+    table. ``build`` runs only when no payload is cached for the current
+    generation. The generation is read before building, so a write that
+    lands meanwhile can only make the stored payload newer than its ETag
+    claims, never older.
+    """
+    version = generation(table)
+    key = f'feeder:list:{table}:{variant}:{version}'
+    data = cache.get(key)
+    if data is None:
+        data = build()
+        cache.set(key, data, getattr(settings, 'FEEDER_LIST_CACHE_TTL', DEFAULT_PAYLOAD_TTL))
+    return data, list_etag(table, variant, version)
+
+
+def not_modified(request, table, variant):
+    """Return the ETag if the client already holds the current payload, else None.
+
+    Costs one counter read, so pollers should be checked with this before
+    ``cached_list``.
+    """
+    etag = list_etag(table, variant, generation(table))
+    return etag if etag_matches(request, etag) else None
+
+
+@receiver(post_save, sender=ESP8266Device)
+@receiver(post_delete, sender=ESP8266Device)
+def _device_changed(sender, raw=False, **kwargs):
+    if not raw:
+        bump_generation(DEVICES)
+
+
+@receiver(post_save, sender=FeedingSchedule)
+@receiver(post_delete, sender=FeedingSchedule)
+def _schedule_changed(sender, raw=False, **kwargs):
+    if not raw:
+        bump_generation(SCHEDULES)
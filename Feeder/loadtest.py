@@ -0,0 +1,288 @@
+"""Load test of the firmware endpoints with a simulated ESP8266 fleet.
+
+Each simulated feeder is an asyncio task that follows the loop in
+``ESP8266_Django_PetFeeder.ino``: register once, send a heartbeat every
+``HEARTBEAT_INTERVAL``, poll for commands every ``STATUS_CHECK_INTERVAL``
+(with the ETag it was last given), acknowledge every feed command it runs,
+and now and then report a manual feed. The firmware intervals can be
+compressed with ``speedup`` so a short run produces a realistic request mix
+for a much larger fleet.
+
+The harness can target any running server. When it starts the server
+itself (``start_test_server``) every response also carries the number of
+database queries the request made, so the report can show queries per
+request next to latency.
+"""
+import asyncio
+import random
+import socket
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import quote
+
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import connections
+
+import requests
+
+from .device_client import AsyncDevicePool
+
+# Firmware timings, in seconds
+HEARTBEAT_INTERVAL = 10
+STATUS_CHECK_INTERVAL = 5
+
+QUERY_COUNT_HEADER = 'X-DB-Queries'
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class LoadReport:
+    """Latency, status and query counts collected per endpoint."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.queries = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.not_modified = defaultdict(int)
+
+    def record(self, endpoint, elapsed, status_code=None, queries=None):
+        self.latencies[endpoint].append(elapsed)
+        if status_code is None or status_code >= 400:
+            self.errors[endpoint] += 1
+        elif status_code == 304:
+            self.not_modified[endpoint] += 1
+        if queries is not None:
+            self.queries[endpoint].append(queries)
+
+    @property
+    def total_requests(self):
+        return sum(len(values) for values in self.latencies.values())
+
+    def rows(self, duration):
+        """One summary dict per endpoint; latencies are in milliseconds."""
+        rows = []
+        for endpoint in sorted(self.latencies):
+            latencies = sorted(self.latencies[endpoint])
+            queries = self.queries.get(endpoint)
+            row = {
+                'endpoint': endpoint,
+                'requests': len(latencies),
+                'rps': len(latencies) / duration if duration else 0.0,
+                'errors': self.errors[endpoint],
+                'not_modified': self.not_modified[endpoint],
+                'queries_per_request': sum(queries) / len(queries) if queries else None,
+                'max_queries': max(queries) if queries else None,
+            }
+            for pct in PERCENTILES:
+                row[f'p{pct}'] = percentile(latencies, pct) * 1000
+            rows.append(row)
+        return rows
+
+
+class SimulatedFeeder:
+    """One ESP8266 speaking the firmware protocol to the server."""
+
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        self.device_id = f"{fleet.prefix}-{index:05d}"
+        self.name = f"Load test feeder {index}"
+        self.etag = ''
+        self.commands_executed = 0
+
+    async def run(self, deadline):
+        fleet = self.fleet
+        await self._post('register', '/api/esp8266/', {
+            'name': self.name,
+            'ip_address': '127.0.0.1',
+            'port': fleet.device_port,
+            'device_id': self.device_id,
+        })
+        # Stagger the fleet like devices powered up at different times
+        loop = asyncio.get_running_loop()
+        next_heartbeat = loop.time() + random.uniform(0, fleet.heartbeat_interval)
+        next_poll = loop.time() + random.uniform(0, fleet.poll_interval)
+        while True:
+            now = loop.time()
+            if now >= deadline:
+                return
+            if now >= next_heartbeat:
+                await self._post('heartbeat', '/api/esp8266/heartbeat/', {
+                    'device_id': self.device_id,
+                    'ip_address': '127.0.0.1',
+                    'status': 'online',
+                    'timestamp': self._millis(),
+                })
+                next_heartbeat = now + fleet.heartbeat_interval
+            if now >= next_poll:
+                await self._poll()
+                if random.random() < fleet.manual_feed_rate:
+                    await self._post('feed', '/api/esp8266/feed/', {
+                        'device_id': self.device_id,
+                        'portion': 1,
+                        'type': 'manual',
+                        'timestamp': self._millis(),
+                    })
+                next_poll = now + fleet.poll_interval
+            await asyncio.sleep(max(min(next_heartbeat, next_poll, deadline) - loop.time(), 0))
+
+    async def _poll(self):
+        headers = {'If-None-Match': self.etag} if self.etag else None
+        response = await self.fleet.send(
+            'commands', 'GET', f"/api/esp8266/commands/?device_id={quote(self.device_id)}", headers=headers
+        )
+        if response is None or response.status_code != 200:
+            return
+        self.etag = response.headers.get('etag', '')
+        for command in response.json().get('commands', []):
+            if command.get('type') == 'feed':
+                self.commands_executed += 1
+                await self._post('acknowledge', '/api/esp8266/acknowledge/', {
+                    'device_id': self.device_id,
+                    'command_id': command['id'],
+                    'status': 'completed',
+                    'timestamp': self._millis(),
+                })
+
+    async def _post(self, endpoint, path, payload):
+        return await self.fleet.send(endpoint, 'POST', path, payload)
+
+    def _millis(self):
+        return int((time.monotonic() - self.fleet.started) * 1000)
+
+
+class SimulatedFleet:
+    """Runs ``devices`` simulated feeders against ``host:port`` and collects a ``LoadReport``.
+
+    ``bulk_feed_interval`` (in seconds, 0 to disable) periodically queues a
+    feed for a random slice of the fleet through ``/api/feed/bulk/``. The
+    simulated feeders register an address nothing listens on, so the push
+    fails fast and the commands are picked up by polling, as for a device
+    behind NAT.
+    """
+
+    def __init__(self, host, port, devices, speedup=1.0, manual_feed_rate=0.02,
+                 bulk_feed_interval=5.0, bulk_feed_fraction=0.1, prefix='LOADTEST',
+                 device_port=9, timeout=30):
+        self.host = host
+        self.port = port
+        self.devices = devices
+        self.heartbeat_interval = HEARTBEAT_INTERVAL / speedup
+        self.poll_interval = STATUS_CHECK_INTERVAL / speedup
+        self.manual_feed_rate = manual_feed_rate
+        self.bulk_feed_interval = bulk_feed_interval
+        self.bulk_feed_fraction = bulk_feed_fraction
+        self.prefix = prefix
+        self.device_port = device_port
+        self.timeout = timeout
+        self.report = LoadReport()
+        self.feeders = []
+        self.started = time.monotonic()
+        # Every feeder talks to the same server address, so the pool must
+        # allow one connection per feeder rather than the per-device default
+        self._pool = AsyncDevicePool(max_per_device=devices + 1, observed=False)
+
+    async def send(self, endpoint, method, path, payload=None, headers=None):
+        started = time.perf_counter()
+        try:
+            response = await self._pool.request(
+                method, self.host, self.port, path, payload, timeout=self.timeout, headers=headers
+            )
+        except requests.exceptions.RequestException:
+            self.report.record(endpoint, time.perf_counter() - started)
+            return None
+        queries = response.headers.get(QUERY_COUNT_HEADER.lower())
+        self.report.record(
+            endpoint, time.perf_counter() - started, response.status_code,
+            int(queries) if queries is not None else None,
+        )
+        return response
+
+    async def run(self, duration):
+        """Run the fleet for ``duration`` seconds and return the measured wall time."""
+        loop = asyncio.get_running_loop()
+        self.started = time.monotonic()
+        started = loop.time()
+        deadline = started + duration
+        self.feeders = [SimulatedFeeder(self, index) for index in range(self.devices)]
+        tasks = [asyncio.create_task(feeder.run(deadline)) for feeder in self.feeders]
+        if self.bulk_feed_interval:
+            tasks.append(asyncio.create_task(self._queue_feeds(deadline)))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            await self._pool.close()
+        return loop.time() - started
+
+    async def _queue_feeds(self, deadline):
+        loop = asyncio.get_running_loop()
+        count = max(int(self.devices * self.bulk_feed_fraction), 1)
+        while loop.time() + self.bulk_feed_interval < deadline:
+            await asyncio.sleep(self.bulk_feed_interval)
+            chosen = random.sample(self.feeders, min(count, len(self.feeders)))
+            await self.send('feed_bulk', 'POST', '/api/feed/bulk/', {
+                'portion': 1,
+                'device_ids': [feeder.device_id for feeder in chosen],
+            })
+
+    @property
+    def commands_executed(self):
+        return sum(feeder.commands_executed for feeder in self.feeders)
+
+
+# ------------------------
+# In-process test server
+# ------------------------
+
+class QueryCountingApplication:
+    """WSGI wrapper adding the number of database queries to each response."""
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        count = [0]
+
+        def counter(execute, sql, params, many, context):
+            count[0] += 1
+            return execute(sql, params, many, context)
+
+        def counting_start_response(status, headers, exc_info=None):
+            # Django calls start_response once the view has run, so the
+            # count already covers every query the request made
+            return start_response(status, list(headers) + [(QUERY_COUNT_HEADER, str(count[0]))], exc_info)
+
+        with connections['default'].execute_wrapper(counter):
+            return self.application(environ, counting_start_response)
+
+
+class _QuietRequestHandler(WSGIRequestHandler):
+    def setup(self):
+        # The handler writes headers and body separately; without NODELAY
+        # every kept-alive response waits out the client's delayed ACK
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().setup()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_test_server(host='127.0.0.1', port=0):
+    """Serve the project in a background thread; returns ``(server, port)``."""
+    server = ThreadedWSGIServer((host, port), _QuietRequestHandler, allow_reuse_address=True)
+    server.set_app(QueryCountingApplication(get_wsgi_application()))
+    threading.Thread(target=server.serve_forever, name='loadtest-server', daemon=True).start()
+    return server, server.server_address[1]
+
+
+def stop_test_server(server):
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,52 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Feeder.models import DeviceCommand, FeedingHistory
+from Feeder.retention import (FINISHED_STATUSES, history_cutoff_date, purge_commands, purge_history,
+                              run_maintenance)
+
+
+class Command(BaseCommand):
+    help = "Purge old finished commands and feeding history in small batches, then run database maintenance."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--command-days', type=int, default=None,
+                            help="Keep finished commands updated within this many days")
+        parser.add_argument('--history-days', type=int, default=None,
+                            help="Keep raw feeding history for this many days (older days stay in rollups)")
+        parser.add_argument('--batch-size', type=int, default=None, help="Rows deleted per transaction")
+        parser.add_argument('--pause', type=float, default=None, help="Seconds to wait between batches")
+        parser.add_argument('--skip-maintenance', action='store_true', help="Do not vacuum/analyze afterwards")
+        parser.add_argument('--full-vacuum', action='store_true',
+                            help="SQLite: run one full VACUUM to enable incremental auto-vacuum")
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted")
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            self._report_dry_run(options)
+            return
+
+        commands = purge_commands(options['command_days'], options['batch_size'], options['pause'])
+        self.stdout.write(f"Deleted {commands} finished commands")
+        folded, history = purge_history(options['history_days'], options['batch_size'], options['pause'])
+        self.stdout.write(f"Folded {folded} rollup rows and deleted {history} history rows")
+
+        if not options['skip_maintenance']:
+            actions = run_maintenance(full_vacuum=options['full_vacuum'])
+            self.stdout.write(f"Maintenance: {', '.join(actions) or 'nothing to do'}")
+        self.stdout.write(self.style.SUCCESS("Retention run complete"))
+
+    def _report_dry_run(self, options):
+        days = options['command_days']
+        if days is None:
+            days = getattr(settings, 'FEEDER_COMMAND_RETENTION_DAYS', 30)
+        cutoff = timezone.now() - datetime.timedelta(days=days)
+        commands = DeviceCommand.objects.filter(status__in=FINISHED_STATUSES, updated_at__lt=cutoff).count()
+        keep_from = history_cutoff_date(options['history_days'])
+        history = FeedingHistory.objects.filter(
+            timestamp__lt=timezone.make_aware(datetime.datetime.combine(keep_from, datetime.time.min))
+        ).count()
+        self.stdout.write(f"Would delete {commands} finished commands and {history} history rows before {keep_from}")
@@ -0,0 +1,53 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from django.core.management.base import BaseCommand
+
+from Feeder.device_client import AsyncDevicePool, send_motor_command
+from Feeder.fake_esp8266 import start_fleet, stop_fleet
+
+MOTOR_DATA = {'steps': 200, 'direction': 'clockwise', 'speed': 1000, 'microstepping': '16'}
+
+
+class Command(BaseCommand):
+    help = "Benchmark motor command dispatch against a local fake ESP8266 fleet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=50)
+        parser.add_argument('--rounds', type=int, default=5, help="Commands sent to every device")
+        parser.add_argument('--latency', type=float, default=0.05, help="Simulated device latency in seconds")
+        parser.add_argument('--threads', type=int, default=4,
+                            help="Worker threads for the blocking client (models WSGI workers)")
+
+    def handle(self, *args, **options):
+        asyncio.run(self._bench(options))
+
+    async def _bench(self, options):
+        fleet = await start_fleet(options['devices'], latency=options['latency'])
+        devices = [SimpleNamespace(ip_address=f.host, port=f.port) for f in fleet]
+        targets = devices * options['rounds']
+        try:
+            # Blocking client on a fixed pool of threads, like WSGI workers would
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(options['threads']) as executor:
+                await asyncio.gather(*(
+                    loop.run_in_executor(executor, send_motor_command, device, MOTOR_DATA) for device in targets
+                ))
+            self._report('blocking requests', len(targets), time.perf_counter() - started)
+
+            pool = AsyncDevicePool()
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                pool.post_json(device.ip_address, device.port, '/motor', MOTOR_DATA) for device in targets
+            ))
+            self._report('async pool', len(targets), time.perf_counter() - started)
+            self.stdout.write(f"  connections opened: {pool.connections_opened} for {pool.requests_sent} requests")
+            await pool.close()
+        finally:
+            await stop_fleet(fleet)
+
+    def _report(self, label, count, elapsed):
+        self.stdout.write(f"{label:>18}: {count} commands in {elapsed:.2f}s ({count / elapsed:.0f} req/s)")
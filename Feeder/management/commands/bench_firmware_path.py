@@ -0,0 +1,99 @@
+import json
+import os
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory, override_settings
+from rest_framework import status
+from rest_framework.decorators import api_view
+from rest_framework.response import Response
+
+from Feeder.devices import device_resolver, get_device
+from Feeder.fastpath import heartbeat_validator
+from Feeder.heartbeat import heartbeat_buffer
+from Feeder.models import ESP8266Device
+from Feeder.serializers import HeartbeatSerializer
+from Feeder.throttle import HEARTBEAT as HEARTBEAT_SCOPE
+from Feeder.views import esp8266_heartbeat
+from Feeder.wire import firmware_wire_format, msgpack
+
+URL = '/api/esp8266/heartbeat/'
+HEARTBEAT = {'device_id': 'BENCH-0001', 'ip_address': '192.168.1.120', 'status': 'online', 'timestamp': 86400123}
+
+
+@firmware_wire_format
+@api_view(['POST'])
+def serializer_heartbeat(request):
+    """The heartbeat endpoint as it was before the fast path, for comparison."""
+    serializer = HeartbeatSerializer(data=request.data)
+    if serializer.is_valid():
+        device = get_device(serializer.validated_data.get('device_id'))
+        if device:
+            heartbeat_buffer.record(device.pk, serializer.validated_data.get('ip_address'))
+            return Response({'status': 'success', 'message': 'Heartbeat received'})
+        return Response({'status': 'error', 'message': 'Device not found'}, status=status.HTTP_404_NOT_FOUND)
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+class Command(BaseCommand):
+    help = "Measure CPU per heartbeat on the DRF serializer path and the firmware fast path."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        # Run against a throwaway copy of the schema, never the real database
+        old_name = connection.settings_dict['NAME']
+        workdir = None
+        if connection.vendor == 'sqlite':
+            workdir = tempfile.mkdtemp(prefix='feeder-bench-')
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            ESP8266Device.objects.create(name='Bench', device_id=HEARTBEAT['device_id'], ip_address=HEARTBEAT['ip_address'])
+            # One device sending thousands of heartbeats would otherwise be throttled
+            with override_settings(FEEDER_THROTTLE_RATES={HEARTBEAT_SCOPE: ''}):
+                self._bench(options['iterations'])
+        finally:
+            heartbeat_buffer.clear()
+            device_resolver.clear()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if workdir:
+                os.rmdir(workdir)
+
+    def _bench(self, iterations):
+        factory = RequestFactory()
+        bodies = [('json', 'application/json', json.dumps(HEARTBEAT))]
+        if msgpack is not None:
+            bodies.append(('msgpack', 'application/msgpack', msgpack.packb(HEARTBEAT)))
+
+        rows = [
+            ('validation', 'serializer', lambda: HeartbeatSerializer(data=HEARTBEAT).is_valid(raise_exception=True), 0),
+            ('validation', 'precompiled', lambda: heartbeat_validator.validate(HEARTBEAT), 0),
+        ]
+        for name, content_type, body in bodies:
+            # Building the request is not part of the view's cost
+            overhead = self._time(lambda: factory.post(URL, body, content_type=content_type), iterations)
+            for path, view in (('serializer', serializer_heartbeat), ('fast path', esp8266_heartbeat)):
+                rows.append((f'view ({name})', path, lambda view=view, body=body, content_type=content_type: (
+                    view(factory.post(URL, body, content_type=content_type)).render()
+                ), overhead))
+
+        header = f"{'stage':<16} {'path':<12} {'cpu us':>8} {'speedup':>8}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        baselines = {}
+        for stage, path, run, overhead in rows:
+            elapsed = self._time(run, iterations) - overhead
+            baseline = baselines.setdefault(stage, elapsed)
+            self.stdout.write(f"{stage:<16} {path:<12} {elapsed * 1e6:>8.1f} {baseline / elapsed:>7.1f}x")
+
+    @staticmethod
+    def _time(run, iterations):
+        run()  # Warm up, and cache the device
+        started = time.process_time()
+        for _ in range(iterations):
+            run()
+        return (time.process_time() - started) / iterations
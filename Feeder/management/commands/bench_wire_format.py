@@ -0,0 +1,78 @@
+import io
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from Feeder.serializers import HeartbeatSerializer
+from Feeder.wire import CBORParser, CBORRenderer, MessagePackParser, MessagePackRenderer, cbor2, msgpack
+
+HEARTBEAT = {'device_id': 'ESP8266-4C11AE0D2F31', 'ip_address': '192.168.1.120', 'status': 'online', 'timestamp': 86400123}
+HEARTBEAT_RESPONSE = {'status': 'success', 'message': 'Heartbeat received'}
+
+
+def commands_response(count):
+    return {
+        'status': 'success',
+        'commands': [
+            {'id': str(uuid.uuid4()), 'type': 'feed', 'portion': 2, 'steps': 400, 'schedule_id': 3}
+            for _ in range(count)
+        ],
+    }
+
+
+class Command(BaseCommand):
+    help = "Compare JSON, MessagePack and CBOR payload size and server-side cost on the firmware endpoints."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+        parser.add_argument('--commands', type=int, default=3, help="Commands in the simulated poll response")
+
+    def handle(self, *args, **options):
+        codecs = [('json', JSONParser(), JSONRenderer())]
+        if msgpack is not None:
+            codecs.append(('msgpack', MessagePackParser(), MessagePackRenderer()))
+        if cbor2 is not None:
+            codecs.append(('cbor', CBORParser(), CBORRenderer()))
+        if len(codecs) == 1:
+            self.stdout.write(self.style.WARNING("Neither msgpack nor cbor2 is installed; only JSON can be measured"))
+
+        iterations = options['iterations']
+        poll = commands_response(options['commands'])
+        header = f"{'path':<22} {'format':<8} {'bytes':>6} {'size':>6} {'us/op':>8} {'speed':>6}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for path, run in (
+            # Request body parsed and validated, response rendered
+            ('heartbeat', lambda parser, renderer, body: self._heartbeat(parser, renderer, body)),
+            # What the device does with the poll response, mirrored on the server
+            ('commands (render)', lambda parser, renderer, body: renderer.render(poll)),
+            ('commands (parse)', lambda parser, renderer, body: parser.parse(io.BytesIO(body))),
+        ):
+            baseline = None
+            for name, parser, renderer in codecs:
+                document = HEARTBEAT if path == 'heartbeat' else poll
+                body = renderer.render(document)
+                elapsed = self._time(run, parser, renderer, body, iterations)
+                if baseline is None:
+                    baseline = (len(body), elapsed)
+                self.stdout.write(
+                    f"{path:<22} {name:<8} {len(body):>6} {len(body) / baseline[0]:>5.0%} "
+                    f"{elapsed * 1e6:>8.1f} {baseline[1] / elapsed:>5.1f}x"
+                )
+
+    @staticmethod
+    def _heartbeat(parser, renderer, body):
+        serializer = HeartbeatSerializer(data=parser.parse(io.BytesIO(body)))
+        serializer.is_valid(raise_exception=True)
+        return renderer.render(HEARTBEAT_RESPONSE)
+
+    @staticmethod
+    def _time(run, parser, renderer, body, iterations):
+        run(parser, renderer, body)  # Warm up
+        started = time.perf_counter()
+        for _ in range(iterations):
+            run(parser, renderer, body)
+        return (time.perf_counter() - started) / iterations
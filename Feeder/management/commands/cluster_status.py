@@ -0,0 +1,46 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Feeder.cluster import HashRing, cluster
+from Feeder.models import ESP8266Device
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the live cluster nodes and how many devices each owns, and how many "
+        "devices would change owner if nodes joined or left."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--join', action='append', default=[], metavar='NODE',
+                            help="Show the effect of NODE joining (repeatable)")
+        parser.add_argument('--leave', action='append', default=[], metavar='NODE',
+                            help="Show the effect of NODE leaving (repeatable)")
+        parser.add_argument('--devices', type=int, default=0,
+                            help="Use this many synthetic device_ids instead of the registered devices")
+
+    def handle(self, *args, **options):
+        if not cluster.enabled:
+            raise CommandError("Multi-node mode is off; set FEEDER_CLUSTER_DIR")
+        # This command only looks; it does not join the ring
+        members = cluster.live_members()
+        if options['devices']:
+            device_ids = [f'SIM-{index:06d}' for index in range(options['devices'])]
+        else:
+            device_ids = list(ESP8266Device.objects.values_list('device_id', flat=True))
+
+        ring = HashRing(members, cluster.replicas)
+        owners = {device_id: ring.owner(device_id) for device_id in device_ids}
+        counts = Counter(owners.values())
+        self.stdout.write(f"{len(members)} live nodes, {len(device_ids)} devices")
+        for node in sorted(members):
+            self.stdout.write(f"  {node:<24} {counts[node]:>7} devices  {members[node] or '(no URL)'}")
+
+        if options['join'] or options['leave']:
+            changed = (set(members) | set(options['join'])) - set(options['leave'])
+            moved = sum(1 for device_id, owner in owners.items() if HashRing(changed, cluster.replicas).owner(device_id) != owner)
+            share = moved / len(device_ids) if device_ids else 0
+            self.stdout.write(
+                f"With nodes {', '.join(sorted(changed)) or '(none)'}: {moved} devices change owner ({share:.1%})"
+            )
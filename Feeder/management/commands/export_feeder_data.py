@@ -0,0 +1,42 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Feeder.export import EXPORTS, FORMATS, parse_bound, stream_export
+
+
+class Command(BaseCommand):
+    help = "Stream feeding history or device commands to a CSV/NDJSON file with constant memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(EXPORTS))
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+        parser.add_argument('--output', '-o', default='-', help="File to write, '-' for stdout")
+        parser.add_argument('--gzip', action='store_true', help="Compress the output with gzip")
+        parser.add_argument('--device-id', help="Only export rows for this device_id")
+        parser.add_argument('--since', help="ISO 8601 lower bound (inclusive)")
+        parser.add_argument('--until', help="ISO 8601 upper bound (exclusive)")
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_bound(options['since'])
+            until = parse_bound(options['until'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        chunks = stream_export(
+            options['name'], options['format'], options['gzip'], options['chunk_size'],
+            device_id=options['device_id'], since=since, until=until,
+        )
+        if options['output'] == '-':
+            out = sys.stdout.buffer if options['gzip'] else sys.stdout
+            for chunk in chunks:
+                out.write(chunk)
+            out.flush()
+            return
+
+        with open(options['output'], 'wb' if options['gzip'] else 'w', newline='' if not options['gzip'] else None) as out:
+            for chunk in chunks:
+                out.write(chunk)
+        self.stderr.write(self.style.SUCCESS(f"Wrote {options['name']} export to {options['output']}"))
@@ -0,0 +1,50 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from Feeder.fake_esp8266 import start_fleet, stop_fleet
+from Feeder.models import ESP8266Device
+
+
+class Command(BaseCommand):
+    help = "Run simulated ESP8266 feeders on local ports for offline testing."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=1, help="Number of fake feeders to start")
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--base-port', type=int, default=9100, help="Port of the first feeder")
+        parser.add_argument('--latency', type=float, default=0.0, help="Seconds each request takes")
+        parser.add_argument('--failure-rate', type=float, default=0.0, help="Fraction of motor commands that fail")
+        parser.add_argument('--prefix', default='FakeFeeder', help="device_id prefix")
+        parser.add_argument('--register', action='store_true',
+                            help="Create or update ESP8266Device rows pointing at the fake feeders")
+
+    def handle(self, *args, **options):
+        asyncio.run(self._serve(options))
+
+    async def _serve(self, options):
+        fleet = await start_fleet(
+            options['count'], options['host'], options['base_port'],
+            options['latency'], options['failure_rate'], options['prefix'],
+        )
+        if options['register']:
+            for feeder in fleet:
+                await ESP8266Device.objects.aupdate_or_create(
+                    device_id=feeder.device_id,
+                    defaults={
+                        'name': f'Fake {feeder.device_id}',
+                        'ip_address': feeder.host,
+                        'port': feeder.port,
+                        'is_active': True,
+                        'last_connected': timezone.now(),
+                    },
+                )
+        self.stdout.write(self.style.SUCCESS(
+            f"Serving {len(fleet)} fake feeders on {options['host']}:"
+            f"{fleet[0].port}-{fleet[-1].port}. Press Ctrl+C to stop."
+        ))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await stop_fleet(fleet)
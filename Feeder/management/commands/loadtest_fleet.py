@@ -0,0 +1,120 @@
+import asyncio
+import os
+import tempfile
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from Feeder.devices import device_resolver
+from Feeder.heartbeat import heartbeat_buffer
+from Feeder.loadtest import PERCENTILES, SimulatedFleet, start_test_server, stop_test_server
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test the firmware endpoints with simulated ESP8266 feeders and report "
+        "requests/sec, latency percentiles and DB queries per request for each endpoint."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=100, help="Number of simulated feeders")
+        parser.add_argument('--duration', type=float, default=30, help="Length of the run in seconds")
+        parser.add_argument('--speedup', type=float, default=10,
+                            help="Divide the firmware heartbeat/poll intervals by this factor")
+        parser.add_argument('--manual-feed-rate', type=float, default=0.02,
+                            help="Chance per poll that a feeder reports a manual feed")
+        parser.add_argument('--bulk-feed-interval', type=float, default=5,
+                            help="Seconds between bulk feeds queued for 10%% of the fleet (0 disables)")
+        parser.add_argument('--prefix', default='LOADTEST', help="Prefix for simulated device IDs")
+        parser.add_argument('--url', help="Target a running server instead of starting one. "
+                                          "DB query counts are only reported for the built-in server.")
+        parser.add_argument('--max-p95', type=float,
+                            help="Fail if any endpoint's p95 latency exceeds this many milliseconds")
+        parser.add_argument('--max-queries', type=float,
+                            help="Fail if any endpoint averages more DB queries per request than this")
+
+    def handle(self, *args, **options):
+        if options['devices'] < 1 or options['duration'] <= 0 or options['speedup'] <= 0:
+            raise CommandError("--devices, --duration and --speedup must be positive")
+
+        if options['url']:
+            target = urlsplit(options['url'])
+            if not target.hostname:
+                raise CommandError(f"Invalid --url {options['url']!r}")
+            fleet, elapsed = self._run(target.hostname, target.port or 80, options)
+        else:
+            fleet, elapsed = self._run_in_process(options)
+        self._report(fleet, elapsed, options)
+
+    def _run(self, host, port, options):
+        fleet = SimulatedFleet(
+            host, port, options['devices'],
+            speedup=options['speedup'],
+            manual_feed_rate=options['manual_feed_rate'],
+            bulk_feed_interval=options['bulk_feed_interval'],
+            prefix=options['prefix'],
+        )
+        self.stdout.write(
+            f"Running {options['devices']} feeders against {host}:{port} for {options['duration']:g}s "
+            f"(heartbeat every {fleet.heartbeat_interval:g}s, poll every {fleet.poll_interval:g}s)"
+        )
+        elapsed = asyncio.run(fleet.run(options['duration']))
+        return fleet, elapsed
+
+    def _run_in_process(self, options):
+        # Run against a throwaway copy of the schema, never the real database
+        old_name = connection.settings_dict['NAME']
+        workdir = None
+        if connection.vendor == 'sqlite':
+            # A file rather than the default in-memory test database, which
+            # cannot take concurrent writers from the server threads
+            workdir = tempfile.mkdtemp(prefix='feeder-loadtest-')
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(workdir, 'loadtest.sqlite3')
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        server, port = start_test_server()
+        try:
+            return self._run('127.0.0.1', port, options)
+        finally:
+            stop_test_server(server)
+            # Write buffered heartbeats while the test database still exists and
+            # drop cached devices so nothing leaks into the real database
+            heartbeat_buffer.flush()
+            heartbeat_buffer.clear()
+            device_resolver.clear()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if workdir:
+                os.rmdir(workdir)
+
+    def _report(self, fleet, elapsed, options):
+        report = fleet.report
+        rows = report.rows(elapsed)
+        self.stdout.write(
+            f"\n{report.total_requests} requests in {elapsed:.1f}s "
+            f"({report.total_requests / elapsed:.0f} req/s), {fleet.commands_executed} commands executed\n"
+        )
+        header = f"{'endpoint':<12} {'requests':>8} {'req/s':>8} " + ' '.join(
+            f"{'p%d ms' % pct:>8}" for pct in PERCENTILES
+        ) + f" {'errors':>6} {'304':>6} {'queries':>8}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for row in rows:
+            queries = '-' if row['queries_per_request'] is None else f"{row['queries_per_request']:.2f}"
+            self.stdout.write(
+                f"{row['endpoint']:<12} {row['requests']:>8} {row['rps']:>8.1f} "
+                + ' '.join(f"{row[f'p{pct}']:>8.1f}" for pct in PERCENTILES)
+                + f" {row['errors']:>6} {row['not_modified']:>6} {queries:>8}"
+            )
+
+        failures = []
+        for row in rows:
+            if options['max_p95'] is not None and row['p95'] > options['max_p95']:
+                failures.append(f"{row['endpoint']} p95 {row['p95']:.1f}ms > {options['max_p95']:g}ms")
+            if (options['max_queries'] is not None and row['queries_per_request'] is not None
+                    and row['queries_per_request'] > options['max_queries']):
+                failures.append(
+                    f"{row['endpoint']} {row['queries_per_request']:.2f} queries/request > {options['max_queries']:g}"
+                )
+        if failures:
+            raise CommandError("Load test thresholds exceeded: " + '; '.join(failures))
+        self.stdout.write(self.style.SUCCESS("Load test finished"))
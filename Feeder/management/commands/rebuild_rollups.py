@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from Feeder.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = "Recompute DailyConsumption rollups from the raw FeedingHistory rows."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help="First date to rebuild (YYYY-MM-DD); defaults to the oldest raw row")
+        parser.add_argument('--until', help="Date to stop before (YYYY-MM-DD)")
+
+    def handle(self, *args, **options):
+        bounds = {}
+        for name in ('since', 'until'):
+            if options[name]:
+                bounds[name] = parse_date(options[name])
+                if bounds[name] is None:
+                    raise CommandError(f"--{name} must be a date (YYYY-MM-DD)")
+        written = rebuild_rollups(**bounds)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} daily rollup rows"))
@@ -0,0 +1,46 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from Feeder.cluster import cluster
+from Feeder.scheduler import FeedScheduler
+
+
+class Command(BaseCommand):
+    help = "Run the server-side feeding scheduler, turning FeedingSchedule rows into device commands."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Fire whatever is due (including missed fires) and exit")
+        parser.add_argument('--catchup-window', type=int, default=None,
+                            help="Seconds after a missed fire during which it is still caught up")
+        parser.add_argument('--sync-interval', type=int, default=None,
+                            help="Seconds between checks for edited schedules")
+
+    def handle(self, *args, **options):
+        # In a cluster every node runs a scheduler for the devices it owns
+        cluster.start()
+        scheduler = FeedScheduler(
+            catchup_window=options['catchup_window'], sync_interval=options['sync_interval'],
+            device_filter=cluster.filter_owned if cluster.enabled else None,
+        )
+        loaded = scheduler.load()
+        self.stdout.write(f"Loaded {loaded} schedules; next fire at {scheduler.next_fire_at()}")
+
+        if options['once']:
+            created = scheduler.fire_due()
+            self.stdout.write(self.style.SUCCESS(f"Created {created} device commands"))
+            return
+
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+        try:
+            scheduler.run(stop_event)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            cluster.stop()
+        self.stdout.write(self.style.SUCCESS(
+            f"Scheduler stopped after firing {scheduler.fired} schedules ({scheduler.commands_created} commands)"
+        ))
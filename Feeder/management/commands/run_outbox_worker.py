@@ -0,0 +1,63 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from Feeder.cluster import cluster
+from Feeder.outbox import OutboxWorker
+
+
+class Command(BaseCommand):
+    help = "Push queued device commands to the feeders, retrying unreachable ones with backoff."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4,
+                            help="Delivery threads; each pushes to one device at a time")
+        parser.add_argument('--once', action='store_true',
+                            help="Push one batch of due commands per worker and exit")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Commands each worker claims at a time")
+        parser.add_argument('--poll-interval', type=float, default=None,
+                            help="Seconds between checks for due commands when idle")
+
+    def handle(self, *args, **options):
+        # In a cluster the workers push only to the devices this node owns
+        cluster.start()
+        stop_event = threading.Event()
+        workers = [
+            OutboxWorker(batch_size=options['batch_size'], poll_interval=options['poll_interval'], stop_event=stop_event)
+            for _ in range(max(options['workers'], 1))
+        ]
+
+        if options['once']:
+            handled = sum(worker.run_once() for worker in workers)
+            cluster.stop()
+            self.stdout.write(self.style.SUCCESS(f"Handled {handled} commands"))
+            return
+
+        def stop(*args):
+            for worker in workers:
+                worker.stop()
+
+        signal.signal(signal.SIGTERM, stop)
+        threads = [
+            threading.Thread(target=worker.run, name=f'outbox-worker-{index}', daemon=True)
+            for index, worker in enumerate(workers)
+        ]
+        for thread in threads:
+            thread.start()
+        self.stdout.write(f"Started {len(threads)} outbox workers")
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            stop()
+            for thread in threads:
+                thread.join()
+        cluster.stop()
+
+        totals = {key: sum(worker.stats()[key] for worker in workers) for key in ('delivered', 'retried', 'failed', 'expired')}
+        self.stdout.write(self.style.SUCCESS(
+            "Outbox stopped: {delivered} delivered, {retried} retries, {failed} failed, {expired} expired".format(**totals)
+        ))
@@ -0,0 +1,296 @@
+"""Request, database and device-call metrics in Prometheus text format.
+
+``MetricsMiddleware`` times every request and counts the database queries
+it makes, labelled by URL route. Outbound calls to feeders are reported
+through the request hook in ``device_client``. ``metrics.render()``
+produces the ``/metrics`` payload.
+
+Query counting works by installing one execute wrapper on each database
+connection when it is opened. The wrapper adds to the counter of the
+request being served, which is looked up through a context variable, so
+queries made from ``sync_to_async`` threads under ASGI are counted too.
+Outside a request the wrapper only pays for a context-variable lookup.
+
+Everything is kept per process; with several workers each one exposes its
+own numbers, as with any Prometheus client in multi-process mode.
+"""
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+from . import device_client
+from .cluster import cluster
+from .devices import device_resolver
+from .events import event_bus
+from .health import device_breaker
+from .heartbeat import heartbeat_buffer
+from .push import push_registry
+from .throttle import request_limiter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SLOW_REQUEST_MS = 500
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_current_request = contextvars.ContextVar('feeder_request_stats', default=None)
+
+
+class Histogram:
+    """Fixed-bucket histogram; not thread-safe on its own."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class _RequestStats:
+    __slots__ = ('queries', 'query_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+
+
+class MetricsRegistry:
+    """Thread-safe collection of the feeder's metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.request_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # (route, method)
+            self.request_queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))    # route
+            self.request_query_time = defaultdict(float)                           # route
+            self.responses = defaultdict(int)                                       # (route, method, status)
+            self.slow_requests = defaultdict(int)                                   # route
+            self.device_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))   # outcome
+            self.device_requests = defaultdict(int)                                 # (method, outcome)
+
+    def observe_request(self, route, method, status_code, duration, queries, query_time, slow=False):
+        with self._lock:
+            self.request_latency[(route, method)].observe(duration)
+            self.request_queries[route].observe(queries)
+            self.request_query_time[route] += query_time
+            self.responses[(route, method, str(status_code))] += 1
+            if slow:
+                self.slow_requests[route] += 1
+
+    def observe_device(self, method, address, status_code, elapsed, error=None):
+        if error is not None:
+            outcome = 'timeout' if isinstance(error, requests.exceptions.Timeout) else 'unreachable'
+        else:
+            outcome = 'ok' if 200 <= status_code < 300 else 'http_error'
+        with self._lock:
+            self.device_latency[outcome].observe(elapsed)
+            self.device_requests[(method, outcome)] += 1
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            _histograms(lines, 'feeder_http_request_duration_seconds', 'Request latency by route.',
+                        self.request_latency, ('route', 'method'))
+            _counters(lines, 'feeder_http_responses_total', 'Responses by route and status code.',
+                      self.responses, ('route', 'method', 'status'))
+            _histograms(lines, 'feeder_http_request_db_queries', 'Database queries per request.',
+                        self.request_queries, ('route',))
+            _counters(lines, 'feeder_http_request_db_seconds_total', 'Time spent in database queries.',
+                      self.request_query_time, ('route',))
+            _counters(lines, 'feeder_http_slow_requests_total', 'Requests over the slow-request threshold.',
+                      self.slow_requests, ('route',))
+            _histograms(lines, 'feeder_device_request_duration_seconds', 'Latency of calls to feeders.',
+                        self.device_latency, ('outcome',))
+            _counters(lines, 'feeder_device_requests_total', 'Calls to feeders by outcome.',
+                      self.device_requests, ('method', 'outcome'))
+        _runtime_gauges(lines)
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(names, values):
+    if isinstance(values, str):
+        values = (values,)
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return ','.join(pairs)
+
+
+def _format(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _counters(lines, name, help_text, values, label_names):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} counter')
+    for key, value in sorted(values.items()):
+        lines.append(f'{name}{{{_labels(label_names, key)}}} {_format(value)}')
+
+
+def _histograms(lines, name, help_text, histograms, label_names):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} histogram')
+    for key, histogram in sorted(histograms.items()):
+        labels = _labels(label_names, key)
+        for bound, count in histogram.cumulative():
+            le = '+Inf' if bound == float('inf') else _format(bound)
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {count}')
+        lines.append(f'{name}_sum{{{labels}}} {_format(histogram.sum)}')
+        lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+
+def _scalar(lines, name, help_text, value, kind='gauge'):
+    lines.append(f'# HELP {name} {help_text}')
+    lines.append(f'# TYPE {name} {kind}')
+    lines.append(f'{name} {_format(value)}')
+
+
+def _runtime_gauges(lines):
+    heartbeats = heartbeat_buffer.stats()
+    _scalar(lines, 'feeder_heartbeats_received_total', 'Heartbeats received.', heartbeats['received'], 'counter')
+    _scalar(lines, 'feeder_heartbeats_written_total', 'Heartbeats written to the database.',
+            heartbeats['written'], 'counter')
+    _scalar(lines, 'feeder_heartbeats_pending', 'Heartbeats buffered but not yet written.', heartbeats['pending'])
+    _scalar(lines, 'feeder_device_cache_hits_total', 'Device lookups served from cache.',
+            device_resolver.hits, 'counter')
+    _scalar(lines, 'feeder_device_cache_misses_total', 'Device lookups that hit the database.',
+            device_resolver.misses, 'counter')
+    breaker = device_breaker.stats()
+    _scalar(lines, 'feeder_device_breakers_open', 'Device addresses with an open circuit breaker.',
+            len(breaker['open']))
+    _scalar(lines, 'feeder_device_breaker_rejections_total', 'Direct device calls skipped by the breaker.',
+            breaker['rejected'], 'counter')
+    push = push_registry.stats()
+    _scalar(lines, 'feeder_push_connections', 'Feeders connected to the WebSocket push channel.',
+            push['connections'])
+    _scalar(lines, 'feeder_push_commands_total', 'Commands delivered over the push channel.',
+            push['commands_pushed'], 'counter')
+    events = event_bus.stats()
+    _scalar(lines, 'feeder_event_subscribers', 'Open live dashboard streams.', events['subscribers'])
+    _scalar(lines, 'feeder_events_published_total', 'Dashboard events published.', events['published'], 'counter')
+    _scalar(lines, 'feeder_events_skipped_total', 'Dashboard event batches dropped with no stream open.',
+            events['skipped'], 'counter')
+    if cluster.enabled:
+        ring = cluster.stats()
+        _scalar(lines, 'feeder_cluster_nodes', 'Live nodes on the device ownership ring.', len(ring['members']))
+        _scalar(lines, 'feeder_cluster_rebalances_total', 'Ring changes since this node started.',
+                ring['rebalances'], 'counter')
+    throttling = request_limiter.stats()
+    _counters(lines, 'feeder_throttled_requests_total', 'Requests refused by the token-bucket throttle.',
+              throttling['throttled'], ('scope',))
+    _scalar(lines, 'feeder_throttle_buckets', 'Token buckets held for recently active clients.',
+            throttling['buckets'])
+
+
+metrics = MetricsRegistry()
+device_client.add_request_hook(metrics.observe_device)
+
+
+def slow_request_threshold():
+    """Requests slower than this many seconds are logged; 0 disables the log."""
+    return getattr(settings, 'FEEDER_SLOW_REQUEST_MS', DEFAULT_SLOW_REQUEST_MS) / 1000
+
+
+def _count_query(execute, sql, params, many, context):
+    stats = _current_request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.query_time += time.perf_counter() - started
+
+
+def _install_query_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+connection_created.connect(_install_query_counter, dispatch_uid='feeder_metrics_query_counter')
+
+
+class MetricsMiddleware:
+    """Record latency and database usage for every request, sync or async.
+
+    Put it first in ``MIDDLEWARE`` so the timing covers the other
+    middleware too. For streaming responses only the time to the first
+    byte is measured.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats, token, started = self._start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current_request.reset(token)
+        self._finish(request, response, stats, started)
+        return response
+
+    async def __acall__(self, request):
+        stats, token, started = self._start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current_request.reset(token)
+        self._finish(request, response, stats, started)
+        return response
+
+    @staticmethod
+    def _start():
+        stats = _RequestStats()
+        return stats, _current_request.set(stats), time.perf_counter()
+
+    @staticmethod
+    def _finish(request, response, stats, started):
+        duration = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else 'unmatched'
+        threshold = slow_request_threshold()
+        slow = 0 < threshold <= duration
+        metrics.observe_request(
+            route, request.method, response.status_code, duration, stats.queries, stats.query_time, slow
+        )
+        if slow:
+            logger.warning(
+                "Slow request %s %s took %.0fms (%d queries, %.0fms in database)",
+                request.method, request.path, duration * 1000, stats.queries, stats.query_time * 1000,
+            )
+
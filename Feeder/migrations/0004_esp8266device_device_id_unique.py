@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:16
+
+from django.db import migrations, models
+
+
+def clear_duplicate_device_ids(apps, schema_editor):
+    """Blank device_ids become NULL and only the oldest row keeps a duplicated id."""
+    ESP8266Device = apps.get_model('Feeder', 'ESP8266Device')
+    ESP8266Device.objects.filter(device_id='').update(device_id=None)
+    seen = set()
+    for pk, device_id in ESP8266Device.objects.exclude(device_id=None).order_by('pk').values_list('pk', 'device_id'):
+        if device_id in seen:
+            ESP8266Device.objects.filter(pk=pk).update(device_id=None)
+        seen.add(device_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Feeder', '0003_esp8266device_device_id_devicecommand_feedinghistory'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_device_ids, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='esp8266device',
+            name='device_id',
+            field=models.CharField(blank=True, max_length=50, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Feeder', '0004_esp8266device_device_id_unique'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='devicecommand',
+            index=models.Index(fields=['device', 'status', 'created_at'], name='command_device_status_idx'),
+        ),
+    ]
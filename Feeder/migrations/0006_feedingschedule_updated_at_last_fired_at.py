@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Feeder', '0005_devicecommand_device_status_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feedingschedule',
+            name='last_fired_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='feedingschedule',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Feeder', '0006_feedingschedule_updated_at_last_fired_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='feedinghistory',
+            index=models.Index(fields=['device', 'timestamp'], name='history_device_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='feedinghistory',
+            index=models.Index(fields=['timestamp', 'id'], name='history_time_id_idx'),
+        ),
+    ]
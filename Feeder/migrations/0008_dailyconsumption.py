@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Feeder', '0007_feedinghistory_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyConsumption',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('feed_type', models.CharField(choices=[('manual', 'Manual'), ('scheduled', 'Scheduled'), ('remote', 'Remote API')], max_length=20)),
+                ('total_portion', models.PositiveIntegerField(default=0)),
+                ('feed_count', models.PositiveIntegerField(default=0)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_consumption', to='Feeder.esp8266device')),
+            ],
+            options={
+                'verbose_name_plural': 'Daily consumption',
+                'ordering': ['-date'],
+                'indexes': [models.Index(fields=['date'], name='consumption_date_idx')],
+                'constraints': [models.UniqueConstraint(fields=('device', 'date', 'feed_type'), name='unique_daily_consumption')],
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Feeder', '0008_dailyconsumption'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='devicecommand',
+            index=models.Index(fields=['status', 'updated_at'], name='command_status_updated_idx'),
+        ),
+    ]
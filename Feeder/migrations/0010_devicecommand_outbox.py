@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Feeder', '0009_devicecommand_retention_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicecommand',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='devicecommand',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='devicecommand',
+            name='last_error',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='devicecommand',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='devicecommand',
+            index=models.Index(fields=['status', 'next_attempt_at'], name='command_outbox_due_idx'),
+        ),
+    ]
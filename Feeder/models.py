@@ -5,6 +5,10 @@ from django.utils import timezone
 class FeedingSchedule(models.Model):
     time = models.TimeField()
     portion = models.PositiveIntegerField()
+    # Lets the scheduler pick up edits incrementally instead of rescanning
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Scheduled occurrence that was last turned into device commands
+    last_fired_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.time} - {self.portion}g"
@@ -15,11 +19,21 @@ class ESP8266Device(models.Model):
     port = models.PositiveIntegerField(default=80)
     last_connected = models.DateTimeField(null=True, blank=True)
     is_active = models.BooleanField(default=False)
-    device_id = models.CharField(max_length=50, blank=True, null=True)
+    device_id = models.CharField(max_length=50, blank=True, null=True, unique=True)
     
     def __str__(self):
         return f"{self.name} ({self.ip_address})"
 
+class FeedingHistoryQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create sends no post_save, so keep the daily rollups current here
+        from .events import publish_history
+        from .rollups import add_to_rollups
+        created = super().bulk_create(objs, *args, **kwargs)
+        add_to_rollups(created)
+        publish_history(created)
+        return created
+
 class FeedingHistory(models.Model):
     FEED_TYPES = (
         ('manual', 'Manual'),
@@ -32,12 +46,65 @@ class FeedingHistory(models.Model):
     portion = models.PositiveIntegerField()
     feed_type = models.CharField(max_length=20, choices=FEED_TYPES)
     
+    objects = FeedingHistoryQuerySet.as_manager()
+    
     def __str__(self):
         return f"{self.device.name} - {self.timestamp} - {self.portion}g"
     
     class Meta:
         ordering = ['-timestamp']
         verbose_name_plural = "Feeding histories"
+        indexes = [
+            # Keyset pagination: per-device and fleet-wide (timestamp, id) seeks
+            models.Index(fields=['device', 'timestamp'], name='history_device_time_idx'),
+            models.Index(fields=['timestamp', 'id'], name='history_time_id_idx'),
+        ]
+
+class DailyConsumption(models.Model):
+    """Per-device, per-day feeding totals by feed type, rolled up from FeedingHistory."""
+    device = models.ForeignKey(ESP8266Device, on_delete=models.CASCADE, related_name='daily_consumption')
+    date = models.DateField()
+    feed_type = models.CharField(max_length=20, choices=FeedingHistory.FEED_TYPES)
+    total_portion = models.PositiveIntegerField(default=0)
+    feed_count = models.PositiveIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.device.name} - {self.date} - {self.feed_type}: {self.total_portion}g"
+    
+    class Meta:
+        ordering = ['-date']
+        verbose_name_plural = "Daily consumption"
+        constraints = [
+            models.UniqueConstraint(fields=['device', 'date', 'feed_type'], name='unique_daily_consumption'),
+        ]
+        indexes = [
+            models.Index(fields=['date'], name='consumption_date_idx'),
+        ]
+
+class ChangeCounter(models.Model):
+    """Named version counter shared by every process through the database (see ``Feeder.counters``)."""
+    name = models.CharField(max_length=100, primary_key=True)
+    value = models.PositiveBigIntegerField(default=0)
+    
+    def __str__(self):
+        return f"{self.name} = {self.value}"
+
+class LiveEvent(models.Model):
+    """One entry of the live dashboard event log (see ``Feeder.events``)."""
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=16)
+    data = models.JSONField()
+    
+    def __str__(self):
+        return f"{self.id} {self.kind}"
+
+class DeviceCommandQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        # bulk_create sends no post_save, so announce the new commands here
+        from .events import publish_command_status
+        created = super().bulk_create(objs, *args, **kwargs)
+        publish_command_status(created)
+        return created
 
 class DeviceCommand(models.Model):
     COMMAND_TYPES = (
@@ -60,9 +127,26 @@ class DeviceCommand(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Outbox delivery: when the next HTTP push is due (null means the device
+    # pulls it), push attempts so far, the last failure, and when an
+    # undelivered command is given up on
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True, default='')
+    expires_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = DeviceCommandQuerySet.as_manager()
     
     def __str__(self):
         return f"{self.device.name} - {self.command_type} - {self.status}"
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # Serves the per-device pending command poll as an index range scan
+            models.Index(fields=['device', 'status', 'created_at'], name='command_device_status_idx'),
+            # Lets the retention job find finished commands past their TTL
+            models.Index(fields=['status', 'updated_at'], name='command_status_updated_idx'),
+            # Lets outbox workers find the pushes that are due
+            models.Index(fields=['status', 'next_attempt_at'], name='command_outbox_due_idx'),
+        ]
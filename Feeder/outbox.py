@@ -0,0 +1,277 @@
+"""Durable outbox for feed commands pushed to feeders over HTTP.
+
+Views no longer call the feeder while the user waits. ``enqueue_command``
+writes the command as 'pending' with ``next_attempt_at`` set and returns,
+and ``OutboxWorker`` threads (``manage.py run_outbox_worker``) push due
+commands to the devices:
+
+- A command is claimed with the same guarded pending -> 'sent' UPDATE
+  the polling endpoint uses, so a command is handed out once, whether a
+  worker pushes it or the device pulls it first.
+- A connect failure means the device never got the command. It goes back
+  to 'pending' with exponential backoff and jitter, and stays available
+  to a device poll in the meantime.
+- Any other failure (a timeout after the request was sent, an HTTP
+  error) might have reached the motor, so the command is marked failed
+  rather than retried: at most once beats a double feed.
+- Commands that are still undelivered at ``expires_at``, or after
+  ``FEEDER_OUTBOX_MAX_ATTEMPTS`` pushes, are marked failed. Polls skip
+  expired commands too.
+
+Devices that are stale or behind an open circuit breaker are not pushed
+to, and their commands wait for the breaker's cooldown without using up
+an attempt. In a cluster, workers only claim commands for devices their
+node owns (see ``cluster``).
+"""
+import datetime
+import logging
+import random
+import threading
+
+import requests
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .cluster import cluster
+from .commands import add_queue_listener, notify_commands_queued, remove_queue_listener
+from .db import retry_on_locked
+from .device_client import device_address, send_motor_command
+from .events import publish_transitions
+from .health import can_call_directly, device_breaker, is_connect_failure
+from .listcache import DEVICES, bump_generation
+from .models import DeviceCommand, ESP8266Device, FeedingHistory
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COMMAND_TTL = 600  # seconds; a feed hours late is worse than none
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BACKOFF_BASE = 2  # seconds before the first retry
+DEFAULT_BACKOFF_MAX = 120  # seconds
+DEFAULT_POLL_INTERVAL = 2  # seconds between checks for due commands
+DEFAULT_CLAIM_BATCH = 20
+DELIVERY_TIMEOUT = 5  # seconds, as for the direct calls the views made
+
+
+def command_ttl():
+    return getattr(settings, 'FEEDER_COMMAND_TTL', DEFAULT_COMMAND_TTL)
+
+
+def backoff_delay(attempts):
+    """Seconds to wait before push number ``attempts + 1``, with equal jitter.
+
+    The delay doubles per attempt up to ``FEEDER_OUTBOX_BACKOFF_MAX``; a
+    random half of it is added on top of the other half so devices coming
+    back after a Wi-Fi drop are not all retried in the same instant.
+    """
+    base = getattr(settings, 'FEEDER_OUTBOX_BACKOFF_BASE', DEFAULT_BACKOFF_BASE)
+    delay = min(base * 2 ** max(attempts - 1, 0), getattr(settings, 'FEEDER_OUTBOX_BACKOFF_MAX', DEFAULT_BACKOFF_MAX))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def enqueue_command(device, command_type, parameters, push=True):
+    """Queue a command for a device and return it without contacting the device.
+
+    With ``push`` an outbox worker delivers it over HTTP to devices with
+    an address; otherwise it waits for the device to poll. The commit
+    wakes in-process workers, polls and sockets through the queue
+    listeners.
+    """
+    now = timezone.now()
+    # One transaction, so the command and its command version bump land together
+    with transaction.atomic():
+        return DeviceCommand.objects.create(
+            device=device,
+            command_type=command_type,
+            parameters=parameters,
+            next_attempt_at=now if push and device.ip_address else None,
+            expires_at=now + datetime.timedelta(seconds=command_ttl()),
+        )
+
+
+def motor_data(command):
+    """Body of the /motor request that carries out a feed command."""
+    parameters = command.parameters
+    return {
+        'steps': parameters.get('steps', 0),
+        'direction': parameters.get('direction', 'clockwise'),
+        'speed': parameters.get('speed', 1000),
+        'microstepping': parameters.get('microstepping', '16'),
+    }
+
+
+@retry_on_locked
+def expire_commands(now=None):
+    """Fail pending commands past their ``expires_at``; returns how many."""
+    now = now or timezone.now()
+    expired = list(
+        DeviceCommand.objects.filter(status='pending', expires_at__lte=now)
+        .values_list('id', 'device_id', 'command_type')[:500]
+    )
+    if not expired:
+        return 0
+    ids = [command_id for command_id, _, _ in expired]
+    marked = DeviceCommand.objects.filter(id__in=ids, status='pending').update(
+        status='failed', next_attempt_at=None, last_error='Expired before delivery', updated_at=now
+    )
+    publish_transitions((command_id, device_pk, 'failed', command_type) for command_id, device_pk, command_type in expired)
+    logger.info("Expired %d undelivered commands", marked)
+    return marked
+
+
+@retry_on_locked
+def claim_due_commands(limit=DEFAULT_CLAIM_BATCH, now=None, device_pks=None):
+    """Claim up to ``limit`` commands whose next push is due, oldest due first.
+
+    ``device_pks`` restricts the claim to those devices.
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        due = DeviceCommand.objects.filter(status='pending', next_attempt_at__lte=now).order_by('next_attempt_at')
+        if device_pks is not None:
+            due = due.filter(device_id__in=device_pks)
+        if connection.features.has_select_for_update_skip_locked:
+            due = due.select_for_update(skip_locked=True)
+        ids = list(due.values_list('id', flat=True)[:limit])
+        if not ids:
+            return []
+        claimed_at = timezone.now()
+        DeviceCommand.objects.filter(id__in=ids, status='pending').update(status='sent', updated_at=claimed_at)
+        # Only rows stamped by this claim; a poll may have won some
+        commands = list(
+            DeviceCommand.objects.filter(id__in=ids, status='sent', updated_at=claimed_at)
+            .select_related('device')
+            .order_by('next_attempt_at')
+        )
+    publish_transitions((command.id, command.device_id, 'sent', command.command_type) for command in commands)
+    return commands
+
+
+class OutboxWorker:
+    """Pushes due outbox commands to devices until stopped."""
+
+    def __init__(self, batch_size=None, poll_interval=None, max_attempts=None, stop_event=None):
+        self.batch_size = batch_size or getattr(settings, 'FEEDER_OUTBOX_BATCH_SIZE', DEFAULT_CLAIM_BATCH)
+        self.poll_interval = poll_interval or getattr(settings, 'FEEDER_OUTBOX_POLL_INTERVAL', DEFAULT_POLL_INTERVAL)
+        self.max_attempts = max_attempts or getattr(settings, 'FEEDER_OUTBOX_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        self.stop_event = stop_event or threading.Event()
+        self.wakeup = threading.Event()
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+        self.expired = 0
+
+    def wake(self, device_pks=None):
+        """Queue listener: look for due commands now instead of at the next poll."""
+        self.wakeup.set()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wakeup.set()
+
+    def run_once(self, now=None):
+        """Expire, claim and push one batch; returns the number of commands handled."""
+        self.expired += expire_commands(now)
+        owned = cluster.owned_device_pks() if cluster.enabled else None
+        commands = claim_due_commands(self.batch_size, now, owned)
+        for command in commands:
+            self.deliver(command)
+        return len(commands)
+
+    def run(self):
+        add_queue_listener(self.wake)
+        # Devices taken over from a node that left may have commands waiting
+        cluster.add_listener(self.wake)
+        try:
+            while not self.stop_event.is_set():
+                self.wakeup.clear()
+                try:
+                    handled = self.run_once()
+                except Exception:
+                    logger.exception("Outbox batch failed")
+                    handled = 0
+                if handled < self.batch_size:
+                    self.wakeup.wait(self.poll_interval)
+        finally:
+            remove_queue_listener(self.wake)
+            cluster.remove_listener(self.wake)
+            connections.close_all()
+
+    def deliver(self, command):
+        device = command.device
+        if not device.ip_address:
+            # Lost its address since it was queued; leave it for the device to pull
+            self._release(command, next_attempt_at=None)
+            return
+        if not can_call_directly(device):
+            # Stale or failing device: wait for the breaker without spending an attempt
+            wait = max(device_breaker.retry_after(device_address(device)), backoff_delay(command.attempts + 1))
+            self._release(command, next_attempt_at=timezone.now() + datetime.timedelta(seconds=wait))
+            return
+        try:
+            response = send_motor_command(device, motor_data(command), timeout=DELIVERY_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            if is_connect_failure(e):
+                self._retry(command, str(e))
+            else:
+                self._fail(command, str(e))
+            return
+        if response.status_code == 200:
+            self._complete(command)
+        else:
+            self._fail(command, f'Device returned status code {response.status_code}')
+
+    def _transition(self, command, **fields):
+        """Move the claimed command out of 'sent'; False if someone else already did."""
+        return DeviceCommand.objects.filter(pk=command.pk, status='sent').update(
+            updated_at=timezone.now(), **fields
+        ) == 1
+
+    @transaction.atomic
+    def _release(self, command, next_attempt_at):
+        if self._transition(command, status='pending', next_attempt_at=next_attempt_at):
+            publish_transitions([(command.id, command.device_id, 'pending', command.command_type)])
+            notify_commands_queued([command.device_id])
+
+    def _retry(self, command, error):
+        attempts = command.attempts + 1
+        if attempts >= self.max_attempts:
+            self._fail(command, f'Gave up after {attempts} attempts: {error}', attempts=attempts)
+            return
+        next_attempt_at = timezone.now() + datetime.timedelta(seconds=backoff_delay(attempts))
+        with transaction.atomic():
+            if not self._transition(command, status='pending', attempts=F('attempts') + 1,
+                                    next_attempt_at=next_attempt_at, last_error=error[:255]):
+                return
+            publish_transitions([(command.id, command.device_id, 'pending', command.command_type)])
+            # Still pending, so a poll in the meantime can pick it up
+            notify_commands_queued([command.device_id])
+        self.retried += 1
+        logger.info("Command %s to %s failed to connect (attempt %d), retrying at %s",
+                    command.pk, device_address(command.device), attempts, next_attempt_at.isoformat())
+
+    def _fail(self, command, error, attempts=None):
+        if self._transition(command, status='failed', next_attempt_at=None, last_error=error[:255],
+                            attempts=attempts if attempts is not None else F('attempts') + 1):
+            self.failed += 1
+            logger.warning("Command %s to %s failed: %s", command.pk, device_address(command.device), error)
+            publish_transitions([(command.id, command.device_id, 'failed', command.command_type)])
+
+    def _complete(self, command):
+        now = timezone.now()
+        with transaction.atomic():
+            if not self._transition(command, status='completed', next_attempt_at=None,
+                                    attempts=F('attempts') + 1, last_error=''):
+                return
+            ESP8266Device.objects.filter(pk=command.device_id).update(last_connected=now)
+            bump_generation(DEVICES)
+            if command.command_type == 'feed':
+                FeedingHistory.objects.create(
+                    device=command.device, portion=command.parameters.get('portion', 1), feed_type='remote'
+                )
+        self.delivered += 1
+        publish_transitions([(command.id, command.device_id, 'completed', command.command_type)])
+
+    def stats(self):
+        return {'delivered': self.delivered, 'retried': self.retried, 'failed': self.failed, 'expired': self.expired}
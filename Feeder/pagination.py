@@ -0,0 +1,93 @@
+"""Keyset (seek) pagination for append-mostly tables such as FeedingHistory.
+
+Pages are ordered by ``(timestamp, id)`` descending and the cursor carries
+the last row's ``(timestamp, id)``. The next page is fetched with a
+``WHERE (timestamp, id) < cursor`` range condition that an index on
+``(device, timestamp)`` serves directly, so deep pages cost the same as
+the first one, unlike OFFSET pagination.
+"""
+import base64
+from collections import OrderedDict
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """Forward-only cursor pagination over ``(timestamp, id)`` descending."""
+
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 500
+    timestamp_field = 'timestamp'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        position = self.decode_cursor(request)
+
+        queryset = queryset.order_by(f'-{self.timestamp_field}', '-id')
+        if position is not None:
+            timestamp, pk = position
+            queryset = queryset.filter(
+                Q(**{f'{self.timestamp_field}__lt': timestamp})
+                | Q(**{self.timestamp_field: timestamp, 'id__lt': pk})
+            )
+        # Fetch one extra row to learn whether another page exists
+        rows = list(queryset[:self.page_size + 1])
+        self.has_next = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(encoded.encode('ascii')).decode('ascii')
+            timestamp, pk = raw.rsplit('|', 1)
+            timestamp = parse_datetime(timestamp)
+            if timestamp is None:
+                raise ValueError(raw)
+            return timestamp, int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, row):
+        raw = f'{getattr(row, self.timestamp_field).isoformat()}|{row.pk}'
+        return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
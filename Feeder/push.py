@@ -0,0 +1,309 @@
+"""WebSocket push channel between the server and feeders.
+
+A feeder opens one WebSocket to ``/ws/esp8266/?device_id=<id>`` (served by
+``Petfeeder/asgi.py``) and keeps it open. Everything the HTTP endpoints do
+then flows over that connection as small JSON frames keyed by ``t``:
+
+Server to device::
+
+    {"t": "cmd", "id": "<uuid>", "type": "feed", "portion": 2, "steps": 400}
+    {"t": "ok", "seq": 7}
+    {"t": "err", "seq": 7, "errors": {...}}
+    {"t": "pong"}
+    {"t": "moved", "url": "ws://<owner node>/ws/esp8266/?device_id=<id>&routed=1"}
+
+Device to server (``ts`` is the device's millis(); ``seq`` is optional and
+asks for an ``ok``/``err`` reply)::
+
+    {"t": "hb", "ip": "192.168.1.20", "ts": 1234, "seq": 7}
+    {"t": "feed", "portion": 1, "type": "manual", "ts": 1234}
+    {"t": "ack", "id": "<uuid>", "status": "completed", "ts": 1234}
+    {"t": "ping"}
+
+Device frames are validated and stored by ``ingest_events``, exactly like
+the batch endpoint. Commands are claimed with the same guarded update as
+the polling endpoint, so a device that both polls and holds a socket never
+receives a command twice. ``push_registry`` maps devices to their open
+connection and is woken by ``notify_commands_queued``, so a command queued
+in this process goes out as soon as it is committed. Commands queued by
+other processes are picked up within ``FEEDER_PUSH_RECHECK_INTERVAL``
+seconds through the shared command version.
+
+Only the server side exists: the shipped firmware has no WebSocket client
+and keeps polling, so nothing else in the server assumes a feeder is
+connected. Feeds are queued the same way for every feeder, and an open
+socket merely claims them before the outbox or a poll does.
+
+In a cluster only the node owning a device keeps its socket. Elsewhere, and
+whenever ownership moves while the socket is open, the device is sent a
+``moved`` frame naming its owner's URL and the socket is closed with
+``CLOSE_MOVED``.
+"""
+import asyncio
+import json
+import logging
+import threading
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .cluster import cluster, redirect_location
+from .commands import (add_queue_listener, claim_for_delivery, command_batch_size, command_version, format_command,
+                       is_drained, notify_commands_queued)
+from .devices import get_device
+from .events import publish_transitions
+from .heartbeat import heartbeat_buffer
+from .ingest import ingest_events
+from .models import DeviceCommand
+
+logger = logging.getLogger(__name__)
+
+WS_PATH = '/ws/esp8266/'
+DEFAULT_RECHECK_INTERVAL = 5  # seconds, the firmware's poll interval
+
+# Close codes in the application range (4000-4999)
+CLOSE_UNKNOWN_DEVICE = 4404
+CLOSE_REPLACED = 4409
+CLOSE_MOVED = 4307
+
+FRAME_EVENTS = {
+    'hb': 'heartbeat',
+    'feed': 'feed',
+    'ack': 'ack',
+}
+
+
+def recheck_interval():
+    return getattr(settings, 'FEEDER_PUSH_RECHECK_INTERVAL', DEFAULT_RECHECK_INTERVAL)
+
+
+def encode_frame(frame):
+    return json.dumps(frame, separators=(',', ':'))
+
+
+def frame_to_event(frame, device_id, client_ip):
+    """Translate a compact device frame into an ``ingest_events`` event."""
+    kind = FRAME_EVENTS.get(frame.get('t'))
+    if kind is None:
+        return None
+    event = {'event': kind, 'device_id': device_id, 'timestamp': frame.get('ts', 0)}
+    if kind == 'heartbeat':
+        event.update(ip_address=frame.get('ip', client_ip), status=frame.get('status', 'online'))
+    elif kind == 'feed':
+        event.update(portion=frame.get('portion', 1), type=frame.get('type', 'manual'))
+    else:
+        event.update(command_id=frame.get('id'), status=frame.get('status', 'completed'))
+    return event
+
+
+def moved_url(device_id, query):
+    """WebSocket URL on the node owning ``device_id``, or None if this node serves it."""
+    location = redirect_location(device_id, WS_PATH, query)
+    if location is None:
+        return None
+    return 'ws' + location[len('http'):] if location.startswith('http') else location
+
+
+class DeviceConnection:
+    """One feeder's open socket, bound to the event loop serving it."""
+
+    def __init__(self, device, send, query=''):
+        self.device = device
+        self.query = query
+        self._send = send
+        self.loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.close_code = None
+        self.frames_sent = 0
+        self.frames_received = 0
+
+    async def send_frame(self, frame):
+        await self._send({'type': 'websocket.send', 'text': encode_frame(frame)})
+        self.frames_sent += 1
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    def close(self, code):
+        self.close_code = code
+        self.wake()
+
+
+class PushRegistry:
+    """Open device connections in this process, keyed by device pk."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections = {}
+        self.commands_pushed = 0
+
+    def register(self, connection):
+        """Add a connection, closing any older one from the same device."""
+        with self._lock:
+            previous = self._connections.get(connection.device.pk)
+            self._connections[connection.device.pk] = connection
+        if previous is not None:
+            previous.close(CLOSE_REPLACED)
+
+    def unregister(self, connection):
+        with self._lock:
+            if self._connections.get(connection.device.pk) is connection:
+                del self._connections[connection.device.pk]
+
+    def is_connected(self, device_pk):
+        return device_pk in self._connections
+
+    def wake(self, device_pks):
+        """Queue listener: nudge the connections of devices that have new commands."""
+        for device_pk in device_pks:
+            connection = self._connections.get(device_pk)
+            if connection is not None:
+                connection.wake()
+
+    def wake_all(self):
+        """Ring listener: nudge every connection so it re-checks which node owns its device."""
+        with self._lock:
+            connections = list(self._connections.values())
+        for connection in connections:
+            connection.wake()
+
+    def stats(self):
+        with self._lock:
+            return {'connections': len(self._connections), 'commands_pushed': self.commands_pushed}
+
+
+push_registry = PushRegistry()
+add_queue_listener(push_registry.wake)
+cluster.add_listener(push_registry.wake_all)
+
+
+def _claim(device, limit):
+    # Same fast path as the polling endpoint. The version is re-read once per
+    # recheck so commands queued by other processes go out within it
+    version = command_version(device.pk, max_age=recheck_interval())
+    if is_drained(device.pk, version):
+        return []
+    return claim_for_delivery(device, limit, version)
+
+
+@transaction.atomic
+def _requeue(device, command_ids):
+    DeviceCommand.objects.filter(id__in=command_ids, status='sent').update(status='pending', updated_at=timezone.now())
+    publish_transitions((command_id, device.pk, 'pending', None) for command_id in command_ids)
+    notify_commands_queued([device.pk])
+
+
+async def _deliver(connection):
+    """Push pending commands whenever the device's queue changes."""
+    device = connection.device
+    limit = command_batch_size()
+    while connection.close_code is None:
+        connection.wakeup.clear()
+        url = moved_url(device.device_id, connection.query)
+        if url is not None:
+            # The ring changed: the new owner delivers this device's commands
+            await connection.send_frame({'t': 'moved', 'url': url})
+            connection.close(CLOSE_MOVED)
+            return
+        commands = await sync_to_async(_claim)(device, limit)
+        try:
+            for command in commands:
+                await connection.send_frame({'t': 'cmd', **format_command(command)})
+        except Exception:
+            # The socket went away mid-delivery; let a later poll or connection have them
+            await sync_to_async(_requeue)(device, [command.id for command in commands])
+            raise
+        push_registry.commands_pushed += len(commands)
+        if len(commands) == limit:
+            continue  # More may be waiting
+        try:
+            await asyncio.wait_for(connection.wakeup.wait(), recheck_interval())
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _read(connection, receive, client_ip):
+    """Handle device frames until the socket closes."""
+    device_id = connection.device.device_id
+    while True:
+        message = await receive()
+        if message['type'] == 'websocket.disconnect':
+            return
+        if message['type'] != 'websocket.receive':
+            continue
+        connection.frames_received += 1
+        try:
+            frame = json.loads(message.get('text') or message.get('bytes') or b'')
+        except ValueError:
+            await connection.send_frame({'t': 'err', 'errors': {'frame': ['Invalid JSON.']}})
+            continue
+        if not isinstance(frame, dict):
+            await connection.send_frame({'t': 'err', 'errors': {'frame': ['Expected an object.']}})
+            continue
+        if frame.get('t') == 'ping':
+            await connection.send_frame({'t': 'pong'})
+            continue
+
+        event = frame_to_event(frame, device_id, client_ip)
+        if event is None:
+            errors = {'t': [f"\"{frame.get('t')}\" is not a valid frame type."]}
+        else:
+            _, rejected = await sync_to_async(ingest_events)([event])
+            errors = rejected.get(0)
+        if 'seq' in frame:
+            reply = {'t': 'err', 'seq': frame['seq'], 'errors': errors} if errors else {'t': 'ok', 'seq': frame['seq']}
+            await connection.send_frame(reply)
+
+
+async def device_socket(scope, receive, send):
+    """ASGI handler for one feeder's WebSocket."""
+    message = await receive()
+    if message['type'] != 'websocket.connect':
+        return
+    query_string = scope.get('query_string', b'').decode('latin-1')
+    query = parse_qs(query_string)
+    device = await sync_to_async(get_device)(query.get('device_id', [None])[0])
+    if device is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNKNOWN_DEVICE})
+        return
+    await send({'type': 'websocket.accept'})
+    url = moved_url(device.device_id, query_string)
+    if url is not None:
+        # Another node owns this device; its presence and commands live there
+        await send({'type': 'websocket.send', 'text': encode_frame({'t': 'moved', 'url': url})})
+        await send({'type': 'websocket.close', 'code': CLOSE_MOVED})
+        return
+
+    client_ip = (scope.get('client') or (device.ip_address,))[0]
+    connection = DeviceConnection(device, send, query_string)
+    push_registry.register(connection)
+    # An open socket is as good as a heartbeat
+    await sync_to_async(heartbeat_buffer.record)(device.pk, client_ip)
+    logger.info("Device %s connected to the push channel", device.device_id)
+
+    reader = asyncio.ensure_future(_read(connection, receive, client_ip))
+    writer = asyncio.ensure_future(_deliver(connection))
+    try:
+        done, _ = await asyncio.wait({reader, writer}, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                logger.warning("Push channel for %s failed: %r", device.device_id, task.exception())
+        if connection.close_code is not None:
+            await send({'type': 'websocket.close', 'code': connection.close_code})
+    finally:
+        reader.cancel()
+        writer.cancel()
+        push_registry.unregister(connection)
+        logger.info("Device %s left the push channel", device.device_id)
+
+
+async def websocket_application(scope, receive, send):
+    """Route WebSocket connections; only the device channel is served."""
+    if scope['path'] == WS_PATH:
+        await device_socket(scope, receive, send)
+        return
+    await receive()  # websocket.connect
+    await send({'type': 'websocket.close', 'code': CLOSE_UNKNOWN_DEVICE})
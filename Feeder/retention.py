@@ -0,0 +1,119 @@
+"""Retention policy for DeviceCommand and FeedingHistory.
+
+Finished commands and old feeding history are deleted in small batches,
+each in its own short transaction, so the job never holds the SQLite write
+lock for long. History days are folded into the daily rollups, one day
+per transaction, before their raw rows are purged, and whole local days
+are purged at a time so the rollups for the oldest remaining day always
+match its raw rows.
+"""
+import datetime
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import DailyConsumption, DeviceCommand, FeedingHistory
+from .rollups import local_date, rebuild_rollups
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COMMAND_RETENTION_DAYS = 30
+DEFAULT_HISTORY_RETENTION_DAYS = 365
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_PAUSE = 0.05  # seconds between batches, lets other writers in
+DEFAULT_VACUUM_PAGES = 2000
+
+FINISHED_STATUSES = ('completed', 'failed')
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def _delete_in_batches(queryset, batch_size, pause):
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            ids = list(queryset.values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            # Neither model has dependents or delete signals, so this is a
+            # single DELETE ... WHERE id IN (...)
+            queryset.model.objects.filter(pk__in=ids).delete()
+        deleted += len(ids)
+        if pause:
+            time.sleep(pause)
+
+
+def purge_commands(days=None, batch_size=None, pause=None, now=None):
+    """Delete completed/failed commands not updated for ``days`` days."""
+    days = _setting('FEEDER_COMMAND_RETENTION_DAYS', DEFAULT_COMMAND_RETENTION_DAYS) if days is None else days
+    cutoff = (now or timezone.now()) - datetime.timedelta(days=days)
+    finished = DeviceCommand.objects.filter(status__in=FINISHED_STATUSES, updated_at__lt=cutoff).order_by()
+    return _delete_in_batches(
+        finished,
+        batch_size or _setting('FEEDER_RETENTION_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+        DEFAULT_BATCH_PAUSE if pause is None else pause,
+    )
+
+
+def history_cutoff_date(days=None, now=None):
+    """First local date whose history is kept; everything before it may be purged."""
+    days = _setting('FEEDER_HISTORY_RETENTION_DAYS', DEFAULT_HISTORY_RETENTION_DAYS) if days is None else days
+    return local_date(now or timezone.now()) - datetime.timedelta(days=days)
+
+
+def purge_history(days=None, batch_size=None, pause=None, now=None):
+    """Fold expiring history days into rollups, then delete their raw rows.
+
+    Returns ``(rollup_rows_written, history_rows_deleted)``.
+    """
+    keep_from = history_cutoff_date(days, now)
+    boundary = timezone.make_aware(datetime.datetime.combine(keep_from, datetime.time.min))
+    expiring = FeedingHistory.objects.filter(timestamp__lt=boundary).order_by()
+    if not expiring.exists():
+        return 0, 0
+
+    pause = DEFAULT_BATCH_PAUSE if pause is None else pause
+    # Recompute the expiring days from their raw rows so they are exact even
+    # for history written before rollups existed.
+    folded = rebuild_rollups(until=keep_from, pause=pause)
+    deleted = _delete_in_batches(
+        expiring,
+        batch_size or _setting('FEEDER_RETENTION_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+        pause,
+    )
+    return folded, deleted
+
+
+def run_maintenance(vacuum_pages=None, full_vacuum=False):
+    """Reclaim free pages and refresh planner statistics; returns a list of actions taken."""
+    actions = []
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute('PRAGMA auto_vacuum')
+            mode = cursor.fetchone()[0]
+            if full_vacuum and mode != 2:
+                # One-off: switch to incremental auto-vacuum. VACUUM rewrites
+                # the whole file and locks it, so only run on request.
+                cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                cursor.execute('VACUUM')
+                actions.append('vacuum (switched to incremental auto_vacuum)')
+            elif mode == 2:
+                pages = vacuum_pages or _setting('FEEDER_VACUUM_PAGES', DEFAULT_VACUUM_PAGES)
+                cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})')
+                cursor.fetchall()
+                actions.append(f'incremental_vacuum({int(pages)})')
+            else:
+                logger.info("SQLite auto_vacuum is off; run with full_vacuum once to enable incremental vacuum")
+            # Runs ANALYZE only on tables whose statistics are stale
+            cursor.execute('PRAGMA optimize')
+            actions.append('optimize')
+        else:
+            for model in (DeviceCommand, FeedingHistory, DailyConsumption):
+                cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+            actions.append('analyze')
+    return actions
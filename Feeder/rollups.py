@@ -0,0 +1,164 @@
+"""Daily consumption rollups maintained from FeedingHistory.
+
+Every FeedingHistory row adds its portion to the DailyConsumption row for
+its device, local date and feed type: ``create()`` through post_save, and
+``bulk_create()`` through FeedingHistoryQuerySet. Dashboards then read a
+few rollup rows per device and day instead of aggregating raw events.
+Rollups are deliberately not reduced when history rows are deleted, so
+they outlive the retention window of the raw table; ``rebuild_rollups``
+recomputes a date range from the raw rows that remain, one day per
+transaction.
+"""
+import datetime
+import time
+from collections import OrderedDict, defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate, TruncMonth, TruncWeek
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import DailyConsumption, FeedingHistory
+
+PERIODS = {
+    'day': F('date'),
+    'week': TruncWeek('date'),
+    'month': TruncMonth('date'),
+}
+
+
+def local_date(timestamp):
+    return timezone.localtime(timestamp).date() if timezone.is_aware(timestamp) else timestamp.date()
+
+
+def add_to_rollups(entries):
+    """Add FeedingHistory rows to their daily rollups; returns the rollup rows touched."""
+    deltas = defaultdict(lambda: [0, 0])
+    for entry in entries:
+        key = (entry.device_id, local_date(entry.timestamp), entry.feed_type)
+        deltas[key][0] += entry.portion
+        deltas[key][1] += 1
+
+    with transaction.atomic():
+        for (device_id, date, feed_type), (portion, count) in deltas.items():
+            _increment(device_id, date, feed_type, portion, count)
+    return len(deltas)
+
+
+def _increment(device_id, date, feed_type, portion, count):
+    rollup = DailyConsumption.objects.filter(device_id=device_id, date=date, feed_type=feed_type)
+    increment = {'total_portion': F('total_portion') + portion, 'feed_count': F('feed_count') + count}
+    if rollup.update(**increment):
+        return
+    try:
+        with transaction.atomic():
+            DailyConsumption.objects.create(
+                device_id=device_id, date=date, feed_type=feed_type, total_portion=portion, feed_count=count
+            )
+    except IntegrityError:
+        # Created concurrently between the update and the insert
+        rollup.update(**increment)
+
+
+@receiver(post_save, sender=FeedingHistory)
+def _history_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        add_to_rollups([instance])
+
+
+def _day_start(date):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+def rebuild_rollups(since=None, until=None, pause=0):
+    """Recompute rollups for ``since <= date < until`` from the raw history.
+
+    ``since`` defaults to the date of the oldest history row still stored,
+    so rollups for days whose raw rows were purged are left alone. Each
+    day is rebuilt in its own short transaction, with ``pause`` seconds
+    between days, so a long range never holds the SQLite write lock for
+    long. Returns the number of rollup rows written.
+    """
+    history = FeedingHistory.objects.all()
+    if since is None:
+        oldest = history.order_by('timestamp').values_list('timestamp', flat=True).first()
+        if oldest is None:
+            return 0
+        since = local_date(oldest)
+    history = history.filter(timestamp__gte=_day_start(since))
+    rollups = DailyConsumption.objects.filter(date__gte=since)
+    if until is not None:
+        history = history.filter(timestamp__lt=_day_start(until))
+        rollups = rollups.filter(date__lt=until)
+
+    # Days with raw rows to sum or stale rollups to drop
+    days = set(history.annotate(day=TruncDate('timestamp')).values_list('day', flat=True).order_by().distinct())
+    days.update(rollups.values_list('date', flat=True).order_by().distinct())
+    written = 0
+    for index, day in enumerate(sorted(days)):
+        if index and pause:
+            time.sleep(pause)
+        written += _rebuild_day(day)
+    return written
+
+
+def _rebuild_day(day):
+    totals = (
+        FeedingHistory.objects.filter(
+            timestamp__gte=_day_start(day), timestamp__lt=_day_start(day + datetime.timedelta(days=1))
+        )
+        .values('device_id', 'feed_type')
+        .annotate(total_portion=Sum('portion'), feed_count=Count('id'))
+        .order_by()
+    )
+    with transaction.atomic():
+        DailyConsumption.objects.filter(date=day).delete()
+        created = DailyConsumption.objects.bulk_create([
+            DailyConsumption(
+                device_id=row['device_id'],
+                date=day,
+                feed_type=row['feed_type'],
+                total_portion=row['total_portion'],
+                feed_count=row['feed_count'],
+            )
+            for row in totals
+        ], batch_size=500)
+    return len(created)
+
+
+def consumption_summary(period='day', device_id=None, since=None, until=None):
+    """Totals per device and period, with a breakdown by feed type."""
+    rollups = DailyConsumption.objects.all()
+    if device_id:
+        rollups = rollups.filter(device__device_id=device_id)
+    if since:
+        rollups = rollups.filter(date__gte=since)
+    if until:
+        rollups = rollups.filter(date__lt=until)
+
+    rows = (
+        rollups.annotate(period=PERIODS[period])
+        .values('device_id', 'device__device_id', 'device__name', 'period', 'feed_type')
+        .annotate(portion=Sum('total_portion'), count=Sum('feed_count'))
+        .order_by('-period', 'device_id', 'feed_type')
+    )
+    summary = OrderedDict()
+    for row in rows:
+        key = (row['period'], row['device_id'])
+        entry = summary.get(key)
+        if entry is None:
+            entry = summary[key] = {
+                'device': row['device_id'],
+                'device_id': row['device__device_id'],
+                'device_name': row['device__name'],
+                'period': row['period'],
+                'total_portion': 0,
+                'feed_count': 0,
+                'by_type': {},
+            }
+        entry['total_portion'] += row['portion']
+        entry['feed_count'] += row['count']
+        entry['by_type'][row['feed_type']] = {'portion': row['portion'], 'count': row['count']}
+    return list(summary.values())
@@ -0,0 +1,236 @@
+"""Server-side engine that turns FeedingSchedule rows into device commands.
+
+Schedules are kept in a min-heap keyed by their next fire time, so each
+tick only looks at the top of the heap. Edits are picked up incrementally
+through ``FeedingSchedule.updated_at``; deleted schedules are noticed when
+their entry comes due. ``last_fired_at`` records the occurrence that was
+last fired, which lets a restarted scheduler catch up on missed fires and
+keeps two schedulers from firing the same occurrence twice.
+
+A scheduler with a ``device_filter`` fires every occurrence for its own
+devices, whether or not another scheduler claimed it already. This is
+how each node of a cluster serves the devices it owns. Scheduled
+commands get an id derived from schedule, device and occurrence, so a
+device gets one command per occurrence however many schedulers fire it.
+Only commands that were actually inserted are announced and wake polls.
+"""
+import datetime
+import heapq
+import logging
+import threading
+import uuid
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .commands import notify_commands_queued
+from .dispatch import STEPS_PER_PORTION
+from .models import DeviceCommand, ESP8266Device, FeedingSchedule
+from .outbox import command_ttl
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATCHUP_WINDOW = 3600  # seconds
+DEFAULT_SYNC_INTERVAL = 30  # seconds
+
+SCHEDULED_COMMAND_NAMESPACE = uuid.UUID('5b0e9a2c-43f1-4f7e-9a8e-6d3c1f2b7a10')
+
+
+def scheduled_command_id(schedule_id, device_pk, occurrence):
+    """Id of the feed command an occurrence of a schedule creates for a device."""
+    return uuid.uuid5(SCHEDULED_COMMAND_NAMESPACE, f'{schedule_id}:{device_pk}:{occurrence.isoformat()}')
+
+
+def _at(day, schedule_time, tz):
+    return timezone.make_aware(datetime.datetime.combine(day, schedule_time), tz)
+
+
+def next_fire_time(schedule_time, after):
+    """First occurrence of a daily wall-clock time strictly after ``after``."""
+    tz = timezone.get_current_timezone()
+    day = timezone.localtime(after, tz).date()
+    candidate = _at(day, schedule_time, tz)
+    if candidate <= after:
+        candidate = _at(day + datetime.timedelta(days=1), schedule_time, tz)
+    return candidate
+
+
+def previous_fire_time(schedule_time, now):
+    """Latest occurrence of a daily wall-clock time at or before ``now``."""
+    tz = timezone.get_current_timezone()
+    day = timezone.localtime(now, tz).date()
+    candidate = _at(day, schedule_time, tz)
+    if candidate > now:
+        candidate = _at(day - datetime.timedelta(days=1), schedule_time, tz)
+    return candidate
+
+
+def _insert_new(commands):
+    """Insert the commands whose id is not taken yet and return those."""
+    while commands:
+        # Fired before by this or another scheduler, or by the node that owned the device then
+        existing = set(
+            DeviceCommand.objects.filter(id__in=[command.id for command in commands]).values_list('id', flat=True)
+        )
+        commands = [command for command in commands if command.id not in existing]
+        try:
+            with transaction.atomic():
+                DeviceCommand.objects.bulk_create(commands, batch_size=500)
+            return commands
+        except IntegrityError:
+            continue  # Another scheduler inserted some of them meanwhile; look again
+    return commands
+
+
+class FeedScheduler:
+    """Min-heap of upcoming schedule fires with incremental resync."""
+
+    def __init__(self, catchup_window=None, sync_interval=None, device_filter=None):
+        if catchup_window is None:
+            catchup_window = getattr(settings, 'FEEDER_SCHEDULE_CATCHUP_WINDOW', DEFAULT_CATCHUP_WINDOW)
+        if sync_interval is None:
+            sync_interval = getattr(settings, 'FEEDER_SCHEDULE_SYNC_INTERVAL', DEFAULT_SYNC_INTERVAL)
+        self.catchup_window = datetime.timedelta(seconds=catchup_window)
+        self.sync_interval = sync_interval
+        # Optional callable narrowing the devices a scheduler fires for
+        self.device_filter = device_filter
+        self._heap = []      # (fire_at, schedule_id)
+        self._fire_at = {}   # schedule_id -> fire_at of its live heap entry
+        self._synced_through = None
+        self.fired = 0
+        self.commands_created = 0
+
+    def __len__(self):
+        return len(self._fire_at)
+
+    def next_fire_at(self):
+        """Fire time of the earliest live heap entry, or None when idle."""
+        while self._heap and self._fire_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def load(self, now=None):
+        """Build the heap from scratch, scheduling catch-up fires for missed occurrences."""
+        now = now or timezone.now()
+        self._heap = []
+        self._fire_at = {}
+        schedules = list(FeedingSchedule.objects.only('id', 'time', 'last_fired_at', 'updated_at'))
+        for schedule in schedules:
+            self._push(schedule, now, catch_up=True)
+        self._synced_through = max((s.updated_at for s in schedules), default=None)
+        return len(schedules)
+
+    def sync(self, now=None):
+        """Pick up schedules created or edited since the last sync."""
+        now = now or timezone.now()
+        if self._synced_through is None:
+            return self.load(now)
+        changed = list(
+            FeedingSchedule.objects.filter(updated_at__gt=self._synced_through)
+            .only('id', 'time', 'last_fired_at', 'updated_at')
+        )
+        for schedule in changed:
+            self._push(schedule, now, catch_up=False)
+        if changed:
+            self._synced_through = max(s.updated_at for s in changed)
+        return len(changed)
+
+    def _push(self, schedule, now, catch_up):
+        fire_at = next_fire_time(schedule.time, now)
+        if catch_up:
+            missed = previous_fire_time(schedule.time, now)
+            # A schedule that never fired has missed its last occurrence too.
+            # Partitioned schedulers catch up on occurrences another node fired for its own devices.
+            fired = (schedule.last_fired_at is not None and missed <= schedule.last_fired_at
+                     and self.device_filter is None)
+            if not fired and now - missed <= self.catchup_window:
+                fire_at = missed
+        self._fire_at[schedule.pk] = fire_at
+        heapq.heappush(self._heap, (fire_at, schedule.pk))
+
+    def pop_due(self, now=None):
+        """Remove and return ``{schedule_id: occurrence}`` for every entry due by ``now``."""
+        now = now or timezone.now()
+        due = {}
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, schedule_id = heapq.heappop(self._heap)
+            # Entries superseded by an edit are skipped lazily
+            if self._fire_at.get(schedule_id) == fire_at:
+                due[schedule_id] = fire_at
+                del self._fire_at[schedule_id]
+        return due
+
+    def fire_due(self, now=None):
+        """Emit feed commands for every due schedule and return how many commands were created."""
+        now = now or timezone.now()
+        due = self.pop_due(now)
+        if not due:
+            return 0
+
+        schedules = {s.pk: s for s in FeedingSchedule.objects.filter(pk__in=due.keys())}
+        devices = ESP8266Device.objects.filter(is_active=True).only('id', 'ip_address')
+        if self.device_filter is not None:
+            devices = self.device_filter(devices)
+        devices = list(devices)
+
+        commands = []
+        fired = []
+        expires_at = now + datetime.timedelta(seconds=command_ttl())
+        with transaction.atomic():
+            for schedule_id, occurrence in due.items():
+                schedule = schedules.get(schedule_id)
+                if schedule is None:
+                    continue  # Deleted since it was queued
+                # Claim this occurrence; another scheduler may already have fired it
+                claimed = FeedingSchedule.objects.filter(pk=schedule_id).filter(
+                    Q(last_fired_at__isnull=True) | Q(last_fired_at__lt=occurrence)
+                ).update(last_fired_at=occurrence)
+                # Partitioned schedulers each fire their own devices
+                if claimed or self.device_filter is not None:
+                    fired.append(schedule)
+                    commands.extend(
+                        DeviceCommand(
+                            id=scheduled_command_id(schedule_id, device.pk, occurrence),
+                            device=device,
+                            command_type='feed',
+                            parameters={
+                                'portion': schedule.portion,
+                                'steps': schedule.portion * STEPS_PER_PORTION,
+                                'schedule_id': schedule.pk,
+                            },
+                            # As enqueue_command: the outbox pushes to devices with an address
+                            next_attempt_at=now if device.ip_address else None,
+                            expires_at=expires_at,
+                        )
+                        for device in devices
+                    )
+            commands = _insert_new(commands)
+            if commands:
+                notify_commands_queued(command.device_id for command in commands)
+
+        for schedule in schedules.values():
+            self._push(schedule, max(now, due[schedule.pk]), catch_up=False)
+        self.fired += len(fired)
+        self.commands_created += len(commands)
+        if fired:
+            logger.info("Fired %d schedules as %d device commands", len(fired), len(commands))
+        return len(commands)
+
+    def run(self, stop_event=None, max_sleep=None):
+        """Fire schedules until ``stop_event`` is set, resyncing every ``sync_interval``."""
+        stop_event = stop_event or threading.Event()
+        max_sleep = max_sleep or self.sync_interval
+        if self._synced_through is None:
+            self.load()
+        next_sync = timezone.now() + datetime.timedelta(seconds=self.sync_interval)
+        while not stop_event.is_set():
+            now = timezone.now()
+            if now >= next_sync:
+                self.sync(now)
+                next_sync = now + datetime.timedelta(seconds=self.sync_interval)
+            self.fire_due(now)
+            wake_at = min(filter(None, [self.next_fire_at(), next_sync]))
+            stop_event.wait(min(max((wake_at - timezone.now()).total_seconds(), 0.05), max_sleep))
+
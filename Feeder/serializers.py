@@ -15,6 +15,22 @@ class MotorControlSerializer(serializers.Serializer):
     microstepping = serializers.ChoiceField(choices=['1', '2', '4', '8', '16'], default='16', required=False,
                                           help_text="Microstepping mode (1, 2, 4, 8, or 16)")
 
+class BulkFeedSerializer(serializers.Serializer):
+    portion = serializers.IntegerField(min_value=1, default=5)
+    direction = serializers.ChoiceField(choices=['clockwise', 'counterclockwise'], default='clockwise')
+    speed = serializers.IntegerField(required=False, default=1000)
+    microstepping = serializers.ChoiceField(choices=['1', '2', '4', '8', '16'], default='16', required=False)
+    all_active = serializers.BooleanField(default=False, help_text="Select every active device")
+    device_ids = serializers.ListField(child=serializers.CharField(max_length=50), required=False,
+                                       allow_empty=False, help_text="Select devices by device_id")
+    name_pattern = serializers.CharField(max_length=100, required=False,
+                                         help_text="Select devices by name, shell-style (e.g. 'Kennel *')")
+
+    def validate(self, attrs):
+        if not (attrs.get('all_active') or attrs.get('device_ids') or attrs.get('name_pattern')):
+            raise serializers.ValidationError("Provide at least one of all_active, device_ids or name_pattern.")
+        return attrs
+
 class ESP8266DeviceSerializer(serializers.ModelSerializer):
     class Meta:
         model = ESP8266Device
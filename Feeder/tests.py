@@ -1,3 +1,560 @@
-from django.test import TestCase
+import datetime
+import shutil
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import requests
+import urllib3
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import counters
+from .cluster import Cluster, FileMembership, HashRing
+from .commands import command_version, forget_versions, notify_commands_queued, wait_for_commands
+from .devices import REGISTRY_COUNTER, device_resolver
+from .dispatch import dispatch_motor_commands_sync
+from .events import event_bus
+from .health import is_connect_failure
+from .heartbeat import heartbeat_buffer
+from .listcache import DEVICES, bump_generation, generation
+from .models import DailyConsumption, DeviceCommand, ESP8266Device, FeedingHistory, FeedingSchedule, LiveEvent
+from .outbox import OutboxWorker, enqueue_command
+from .rollups import rebuild_rollups
+from .scheduler import FeedScheduler, scheduled_command_id
+from .throttle import TokenBucketLimiter, request_limiter
+
+
+class FeederTestCase(TestCase):
+    """Starts every test with empty per-process caches, as a fresh worker would."""
+
+    def setUp(self):
+        cache.clear()
+        forget_versions()
+        device_resolver.clear()
+        heartbeat_buffer.clear()
+        request_limiter.clear()
+
+    def create_device(self, device_id='feeder-1', **fields):
+        fields.setdefault('ip_address', '192.168.1.20')
+        fields.setdefault('is_active', True)
+        return ESP8266Device.objects.create(device_id=device_id, **fields)
+
+
+class CommandPollTests(FeederTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = self.create_device()
+
+    def poll(self, **headers):
+        return self.client.get('/api/esp8266/commands/', {'device_id': self.device.device_id}, **headers)
+
+    def test_unchanged_queue_answers_304(self):
+        first = self.poll()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.json()['commands'], [])
+        repeat = self.poll(HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(repeat.status_code, 304)
+        self.assertEqual(repeat['ETag'], first['ETag'])
+
+    def test_new_command_changes_the_etag(self):
+        etag = self.poll()['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            command = DeviceCommand.objects.create(device=self.device, command_type='feed', parameters={'portion': 1})
+        response = self.poll(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c['id'] for c in response.json()['commands']], [str(command.id)])
+
+    def queue_elsewhere(self):
+        """Insert a command the way another process does: no signals here, then bump the shared version."""
+        command = DeviceCommand.objects.bulk_create([
+            DeviceCommand(device=self.device, command_type='feed', parameters={'portion': 1})
+        ])[0]
+        counters.bump([f'commands:{self.device.pk}'])
+        return command
+
+    @override_settings(FEEDER_COMMAND_VERSION_MAX_AGE=0)
+    def test_command_queued_by_another_process_is_seen(self):
+        self.poll()  # Marks the queue drained in this process
+        command = self.queue_elsewhere()
+        response = self.poll()
+        self.assertEqual([c['id'] for c in response.json()['commands']], [str(command.id)])
+
+    @override_settings(FEEDER_DEVICE_CACHE_CHECK_INTERVAL=60)
+    def test_drained_poll_costs_no_query(self):
+        self.poll()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.poll().status_code, 200)
+
+    @override_settings(FEEDER_DEVICE_CACHE_CHECK_INTERVAL=60)
+    def test_long_poll_reads_the_version_once_when_the_wait_runs_out(self):
+        self.poll()
+        command = self.queue_elsewhere()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/esp8266/commands/', {'device_id': self.device.device_id, 'wait': 0.2})
+        self.assertEqual([c['id'] for c in response.json()['commands']], [str(command.id)])
+        version_reads = [query for query in queries if f'commands:{self.device.pk}' in query['sql']]
+        self.assertEqual(len(version_reads), 1)
+
+    def test_local_commit_wakes_a_long_poll(self):
+        version = command_version(self.device.pk)
+        woke = []
+        waiter = threading.Thread(target=lambda: woke.append(wait_for_commands(self.device.pk, version, 5)))
+        waiter.start()
+        with self.captureOnCommitCallbacks(execute=True):
+            notify_commands_queued([self.device.pk])
+        waiter.join(2)  # Well inside the wait: only the wakeup can end it in time
+        self.assertEqual(woke, [True])
+
+    def test_claimed_command_is_handed_out_once(self):
+        DeviceCommand.objects.create(device=self.device, command_type='feed', parameters={'portion': 1})
+        self.assertEqual(len(self.poll().json()['commands']), 1)
+        self.assertEqual(self.poll().json()['commands'], [])
+        self.assertEqual(DeviceCommand.objects.get().status, 'sent')
+
+
+class HeartbeatBufferTests(FeederTestCase):
+    def test_flush_bumps_the_device_list_once(self):
+        devices = [self.create_device(f'feeder-{i}') for i in range(3)]
+        before = generation(DEVICES)
+        with mock.patch.object(heartbeat_buffer, '_ensure_flusher'):
+            for device in devices:
+                heartbeat_buffer.record(device.pk, '10.0.0.1')
+        self.assertEqual(generation(DEVICES), before)
+        self.assertEqual(heartbeat_buffer.flush(), 3)
+        self.assertEqual(generation(DEVICES), before + 1)
+        self.assertEqual(set(ESP8266Device.objects.values_list('ip_address', flat=True)), {'10.0.0.1'})
+        self.assertFalse(LiveEvent.objects.exists())  # No dashboard is listening
+
+
+@override_settings(FEEDER_DEVICE_CACHE_CHECK_INTERVAL=0)
+class DeviceResolverTests(FeederTestCase):
+    def test_presence_updates_keep_cached_devices(self):
+        device = self.create_device()
+        device_resolver.get('feeder-1')
+        bump_generation(DEVICES)  # As a heartbeat flush or stale sweep does
+        with self.assertNumQueries(1):  # The registry check only
+            self.assertEqual(device_resolver.get('feeder-1'), device)
+
+    def test_device_renamed_by_another_process_is_dropped(self):
+        device = self.create_device()
+        device_resolver.get('feeder-1')
+        # Another process renames without this process's signals
+        ESP8266Device.objects.filter(pk=device.pk).update(device_id='feeder-9')
+        counters.bump([REGISTRY_COUNTER])
+        self.assertIsNone(device_resolver.get('feeder-1'))
+
+
+class AcknowledgementTests(FeederTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = self.create_device()
+        self.command = DeviceCommand.objects.create(
+            device=self.device, command_type='feed', parameters={'portion': 2}, status='sent'
+        )
+
+    def ack(self, status='completed', command_id=None):
+        return self.client.post('/api/esp8266/acknowledge/', {
+            'device_id': self.device.device_id,
+            'command_id': str(command_id or self.command.id),
+            'status': status,
+            'timestamp': 1,
+        }, content_type='application/json')
+
+    def test_repeated_ack_is_answered_without_a_second_transition(self):
+        first = self.ack()
+        self.assertEqual(first.json()['message'], 'Command acknowledged')
+        repeat = self.ack(status='failed')
+        self.assertEqual(repeat.status_code, 200)
+        self.assertEqual(repeat.json()['message'], 'Command already acknowledged')
+        self.command.refresh_from_db()
+        self.assertEqual(self.command.status, 'completed')
+        self.assertEqual(FeedingHistory.objects.filter(device=self.device).count(), 1)
+
+    def test_ack_for_another_devices_command_is_not_found(self):
+        other = self.create_device('feeder-2')
+        command = DeviceCommand.objects.create(device=other, command_type='feed', status='sent')
+        self.assertEqual(self.ack(command_id=command.id).status_code, 404)
+
+    def test_duplicate_acks_in_one_batch_apply_once(self):
+        ack = {'event': 'ack', 'device_id': self.device.device_id, 'command_id': str(self.command.id),
+               'status': 'completed', 'timestamp': 1}
+        response = self.client.post('/api/esp8266/batch/', [ack, ack], content_type='application/json')
+        self.assertEqual(response.json()['accepted'], [0, 1])
+        self.assertEqual(FeedingHistory.objects.filter(device=self.device).count(), 1)
+
+
+class FeedSchedulerTests(FeederTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = self.create_device()
+
+    def schedule_at(self, ago):
+        at = timezone.localtime() - ago
+        return FeedingSchedule.objects.create(time=at.time().replace(microsecond=0), portion=2)
+
+    def run_once(self):
+        call_command('run_feed_scheduler', '--once', stdout=StringIO())
+
+    def test_once_catches_up_a_schedule_that_never_fired(self):
+        schedule = self.schedule_at(datetime.timedelta(minutes=10))
+        self.run_once()
+        command = DeviceCommand.objects.get()
+        self.assertEqual(command.device, self.device)
+        self.assertEqual(command.parameters['portion'], 2)
+        schedule.refresh_from_db()
+        self.assertIsNotNone(schedule.last_fired_at)
+
+    def test_once_does_not_fire_the_same_occurrence_twice(self):
+        self.schedule_at(datetime.timedelta(minutes=10))
+        self.run_once()
+        self.run_once()
+        self.assertEqual(DeviceCommand.objects.count(), 1)
+
+    def test_once_skips_fires_older_than_the_catchup_window(self):
+        self.schedule_at(datetime.timedelta(hours=2))
+        call_command('run_feed_scheduler', '--once', '--catchup-window', '3600', stdout=StringIO())
+        self.assertFalse(DeviceCommand.objects.exists())
+
+    def test_commands_are_queued_like_enqueued_ones(self):
+        offline = self.create_device('feeder-2', ip_address=None)
+        self.schedule_at(datetime.timedelta(minutes=10))
+        self.run_once()
+        command = DeviceCommand.objects.get(device=self.device)
+        self.assertIsNotNone(command.next_attempt_at)  # The outbox pushes it
+        self.assertGreater(command.expires_at, timezone.now())
+        self.assertIsNone(DeviceCommand.objects.get(device=offline).next_attempt_at)
+
+    def test_commands_created_elsewhere_are_not_announced_again(self):
+        schedule = self.schedule_at(datetime.timedelta(minutes=10))
+        scheduler = FeedScheduler()
+        scheduler.load()
+        # The node that owned the device fired this occurrence already
+        occurrence = scheduler.next_fire_at()
+        DeviceCommand.objects.create(id=scheduled_command_id(schedule.pk, self.device.pk, occurrence),
+                                     device=self.device, command_type='feed')
+        with mock.patch.object(event_bus, 'listening', return_value=True):
+            self.assertEqual(scheduler.fire_due(), 0)
+        self.assertEqual(DeviceCommand.objects.count(), 1)
+        self.assertFalse(LiveEvent.objects.exists())
+
+
+class FeedingHistoryApiTests(FeederTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = self.create_device()
+        self.other = self.create_device('feeder-2')
+        start = timezone.now() - datetime.timedelta(days=1)
+        self.entries = [
+            FeedingHistory.objects.create(device=self.device, portion=1, feed_type='manual',
+                                          timestamp=start + datetime.timedelta(minutes=i // 2))
+            for i in range(7)  # Pairs share a timestamp, so pages must break ties by id
+        ]
+        self.entries.append(FeedingHistory.objects.create(device=self.other, portion=3, feed_type='scheduled',
+                                                          timestamp=start + datetime.timedelta(hours=2)))
+
+    def ids(self, **params):
+        return [entry['id'] for entry in self.client.get('/api/history/', params).json()['results']]
+
+    def test_pages_walk_the_whole_history_newest_first(self):
+        url, seen = '/api/history/?page_size=3', []
+        while url:
+            page = self.client.get(url).json()
+            self.assertLessEqual(len(page['results']), 3)
+            seen += [entry['id'] for entry in page['results']]
+            url = page['next']
+        expected = sorted(self.entries, key=lambda entry: (entry.timestamp, entry.pk), reverse=True)
+        self.assertEqual(seen, [entry.pk for entry in expected])
+
+    def test_filters(self):
+        self.assertEqual(self.ids(device=self.other.pk), [self.entries[-1].pk])
+        self.assertEqual(self.ids(device_id='feeder-2'), [self.entries[-1].pk])
+        self.assertEqual(self.ids(feed_type='scheduled'), [self.entries[-1].pk])
+        since = (self.entries[-1].timestamp - datetime.timedelta(minutes=1)).isoformat()
+        self.assertEqual(self.ids(since=since), [self.entries[-1].pk])
+        self.assertEqual(len(self.ids(until=since)), 7)
+
+    def test_invalid_cursor_is_not_found(self):
+        self.assertEqual(self.client.get('/api/history/', {'cursor': 'nonsense'}).status_code, 404)
+
+    def test_non_integer_device_is_a_field_error(self):
+        response = self.client.get('/api/history/', {'device': 'abc'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('device', response.json())
+
+    def test_impossible_datetime_is_a_field_error(self):
+        response = self.client.get('/api/history/', {'since': '2024-02-30T00:00:00'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('since', response.json())
+
+
+class ConsumptionSummaryApiTests(FeederTestCase):
+    def test_totals_follow_new_history(self):
+        device = self.create_device()
+        FeedingHistory.objects.create(device=device, portion=2, feed_type='manual')
+        FeedingHistory.objects.bulk_create([FeedingHistory(device=device, portion=3, feed_type='remote')])
+        results = self.client.get('/api/consumption/', {'device_id': 'feeder-1'}).json()['results']
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['total_portion'], 5)
+        self.assertEqual(results[0]['feed_count'], 2)
+
+    def test_impossible_date_is_rejected(self):
+        response = self.client.get('/api/consumption/', {'since': '2024-13-45'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['status'], 'error')
+
+    def test_valid_bounds_are_accepted(self):
+        response = self.client.get('/api/consumption/', {'since': '2024-01-01', 'until': '2024-02-01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'], [])
+
+    def test_rebuild_repairs_one_day_per_transaction(self):
+        device = self.create_device()
+        noon = timezone.localtime().replace(hour=12, minute=0, second=0, microsecond=0)
+        for days_ago, portion in ((3, 1), (3, 2), (2, 4)):
+            FeedingHistory.objects.create(device=device, portion=portion, feed_type='manual',
+                                          timestamp=noon - datetime.timedelta(days=days_ago))
+        DailyConsumption.objects.update(total_portion=99)
+        stale = DailyConsumption.objects.create(device=device, date=noon.date() - datetime.timedelta(days=1),
+                                                feed_type='manual', total_portion=5, feed_count=1)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(rebuild_rollups(), 2)
+        self.assertEqual(sum(query['sql'].startswith('SAVEPOINT') for query in queries), 3)
+        totals = DailyConsumption.objects.order_by('date').values_list('total_portion', 'feed_count')
+        self.assertEqual(list(totals), [(3, 2), (4, 1)])
+        self.assertFalse(DailyConsumption.objects.filter(pk=stale.pk).exists())
+
+
+class DispatchTests(FeederTestCase):
+    def listener(self):
+        """A socket that accepts connections and never answers."""
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(8)
+        self.addCleanup(server.close)
+        return server.getsockname()[1]
+
+    def closed_port(self):
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        return port
+
+    def test_read_timeout_is_failed_and_refused_is_unreachable(self):
+        silent = self.create_device('silent', ip_address='127.0.0.1', port=self.listener())
+        refused = self.create_device('refused', ip_address='127.0.0.1', port=self.closed_port())
+        jobs = [
+            (device, DeviceCommand.objects.create(device=device, command_type='feed', status='sent'), {})
+            for device in (silent, refused)
+        ]
+        results = {result.device.device_id: result for result in dispatch_motor_commands_sync(jobs, timeout=0.3)}
+        self.assertFalse(results['silent'].unreachable)
+        self.assertEqual(results['silent'].as_dict()['status'], 'failed')
+        self.assertTrue(results['refused'].unreachable)
+        self.assertEqual(results['refused'].as_dict()['status'], 'queued')
+
+    def test_dispatches_share_keep_alive_connections(self):
+        class MotorHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                self.server.connections += 1
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'{}')
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), MotorHandler)
+        server.daemon_threads = True
+        server.connections = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        device = self.create_device(ip_address='127.0.0.1', port=server.server_address[1])
+        for _ in range(2):
+            command = DeviceCommand.objects.create(device=device, command_type='feed', status='sent')
+            [result] = dispatch_motor_commands_sync([(device, command, {})])
+            self.assertTrue(result.delivered)
+        self.assertEqual(server.connections, 1)
+
+    def test_connect_failure_classification(self):
+        self.assertTrue(is_connect_failure(requests.exceptions.ConnectTimeout()))
+        self.assertTrue(is_connect_failure(requests.exceptions.ConnectionError('refused')))
+        self.assertFalse(is_connect_failure(requests.exceptions.ReadTimeout()))
+        aborted = requests.exceptions.ConnectionError(urllib3.exceptions.ProtocolError('Connection aborted.'))
+        self.assertFalse(is_connect_failure(aborted))
+
+
+class OutboxTests(FeederTestCase):
+    def setUp(self):
+        super().setUp()
+        self.device = self.create_device()
+        self.command = enqueue_command(self.device, 'feed', {'portion': 1, 'steps': 200})
+
+    def deliver(self, worker=None, **send):
+        with mock.patch('Feeder.outbox.send_motor_command', **send):
+            return (worker or OutboxWorker()).run_once()
+
+    @mock.patch('Feeder.push.push_registry.is_connected', return_value=True)
+    def test_manual_feed_keeps_its_motor_settings_for_a_connected_feeder(self, is_connected):
+        response = self.client.post('/feed_control/', {
+            'request_type': 'manual_feed', 'portion': 2, 'direction': 'counterclockwise', 'speed': 600,
+            'microstepping': '8',
+        }, headers={'X-Requested-With': 'XMLHttpRequest'})
+        self.assertTrue(response.json()['queued'])
+        command = DeviceCommand.objects.exclude(pk=self.command.pk).get()
+        self.assertEqual(command.parameters, {'portion': 2, 'steps': 400, 'direction': 'counterclockwise',
+                                              'speed': 600, 'microstepping': '8'})
+        self.assertIsNotNone(command.next_attempt_at)
+
+    def test_connect_failure_is_retried_with_backoff(self):
+        self.assertEqual(self.deliver(side_effect=requests.exceptions.ConnectionError('refused')), 1)
+        self.command.refresh_from_db()
+        self.assertEqual(self.command.status, 'pending')
+        self.assertEqual(self.command.attempts, 1)
+        self.assertGreater(self.command.next_attempt_at, timezone.now())
+        self.assertIn('refused', self.command.last_error)
+        # Not due yet, so nothing is claimed
+        self.assertEqual(self.deliver(side_effect=AssertionError('not due')), 0)
+
+    def test_read_timeout_is_not_retried(self):
+        with self.assertLogs('Feeder.outbox', 'WARNING'):
+            self.deliver(side_effect=requests.exceptions.ReadTimeout('no answer'))
+        self.command.refresh_from_db()
+        self.assertEqual(self.command.status, 'failed')
+
+    def test_gives_up_after_max_attempts(self):
+        with self.assertLogs('Feeder.outbox', 'WARNING'):
+            self.deliver(OutboxWorker(max_attempts=1), side_effect=requests.exceptions.ConnectionError('refused'))
+        self.command.refresh_from_db()
+        self.assertEqual(self.command.status, 'failed')
+        self.assertTrue(self.command.last_error.startswith('Gave up after 1 attempts'))
+
+    def test_delivery_completes_the_command_and_logs_events(self):
+        with mock.patch.object(event_bus, 'listening', return_value=True):
+            self.deliver(return_value=mock.Mock(status_code=200))
+        self.command.refresh_from_db()
+        self.assertEqual(self.command.status, 'completed')
+        self.assertEqual(FeedingHistory.objects.get().feed_type, 'remote')
+        statuses = [event.data['status'] for event in LiveEvent.objects.filter(kind='command').order_by('id')]
+        self.assertEqual(statuses[-2:], ['sent', 'completed'])
+
+    def test_no_events_are_logged_without_listeners(self):
+        self.deliver(return_value=mock.Mock(status_code=200))
+        self.assertFalse(LiveEvent.objects.exists())
+
+    def test_expired_command_is_failed_without_a_push(self):
+        DeviceCommand.objects.filter(pk=self.command.pk).update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        self.deliver(side_effect=AssertionError('expired commands are not pushed'))
+        self.command.refresh_from_db()
+        self.assertEqual(self.command.status, 'failed')
+        self.assertEqual(self.command.last_error, 'Expired before delivery')
+
+    def test_enqueue_bumps_the_shared_command_version(self):
+        version = counters.read(f'commands:{self.device.pk}')
+        enqueue_command(self.device, 'feed', {'portion': 1})
+        self.assertGreater(counters.read(f'commands:{self.device.pk}'), version)
+
+
+class ThrottleTests(FeederTestCase):
+    def test_bucket_allows_a_burst_then_refills(self):
+        limiter = TokenBucketLimiter(rates={'test': '2/s'})
+        with mock.patch('Feeder.throttle.time.monotonic', return_value=100.0):
+            self.assertEqual(limiter.acquire('test', 'a'), 0)
+            self.assertEqual(limiter.acquire('test', 'a'), 0)
+            self.assertAlmostEqual(limiter.acquire('test', 'a'), 0.5)
+            self.assertEqual(limiter.acquire('test', 'b'), 0)
+        with mock.patch('Feeder.throttle.time.monotonic', return_value=100.5):
+            self.assertEqual(limiter.acquire('test', 'a'), 0)
+
+    def test_idle_buckets_are_swept(self):
+        limiter = TokenBucketLimiter(rates={'test': '2/s'}, sweep_interval=3600)
+        with mock.patch('Feeder.throttle.time.monotonic', return_value=100.0):
+            limiter.acquire('test', 'a')
+        self.assertEqual(limiter.sweep(now=101.0), 1)
+        self.assertEqual(limiter.stats()['buckets'], 0)
+
+    @override_settings(FEEDER_THROTTLE_RATES={'commands': '2/min'})
+    def test_command_polls_are_throttled_per_device(self):
+        for device_id in ('feeder-1', 'feeder-2'):
+            self.create_device(device_id)
+        poll = lambda device_id: self.client.get('/api/esp8266/commands/', {'device_id': device_id})
+        self.assertEqual([poll('feeder-1').status_code for _ in range(3)], [200, 200, 429])
+        self.assertIn('Retry-After', poll('feeder-1'))
+        self.assertEqual(poll('feeder-2').status_code, 200)
+
+
+class ClusterTests(FeederTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        membership = FileMembership(directory)
+        membership.announce('b', 'http://b.example:8000')
+        self.cluster = Cluster(node_id='a', url='http://a.example:8000', membership=membership)
+        self.cluster.refresh()
+        for target in ('Feeder.cluster.cluster', 'Feeder.views.cluster'):
+            patcher = mock.patch(target, self.cluster)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        devices = [self.create_device(f'feeder-{i}') for i in range(20)]
+        self.mine = [device for device in devices if self.cluster.owns(device.device_id)]
+        self.theirs = [device for device in devices if not self.cluster.owns(device.device_id)]
+
+    def test_adding_a_node_moves_only_its_share(self):
+        keys = [f'feeder-{i}' for i in range(2000)]
+        before, after = HashRing(['a', 'b', 'c']), HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if before.owner(key) != after.owner(key)]
+        self.assertTrue(all(after.owner(key) == 'd' for key in moved))
+        self.assertLess(len(moved), len(keys) * 0.4)
+
+    def test_other_nodes_device_is_redirected(self):
+        response = self.client.get('/api/esp8266/commands/', {'device_id': self.theirs[0].device_id})
+        self.assertEqual(response.status_code, 307)
+        self.assertTrue(response['Location'].startswith('http://b.example:8000/api/esp8266/commands/'))
+        self.assertTrue(response['Location'].endswith('routed=1'))
+        routed = self.client.get('/api/esp8266/commands/', {'device_id': self.theirs[0].device_id, 'routed': 1})
+        self.assertEqual(routed.status_code, 200)
+        own = self.client.get('/api/esp8266/commands/', {'device_id': self.mine[0].device_id})
+        self.assertEqual(own.status_code, 200)
+
+    def test_mixed_batch_rejects_only_other_nodes_events(self):
+        feed = lambda device: {'event': 'feed', 'device_id': device.device_id, 'portion': 1, 'type': 'manual',
+                               'timestamp': 1}
+        response = self.client.post('/api/esp8266/batch/', [feed(self.mine[0]), feed(self.theirs[0])],
+                                    content_type='application/json')
+        body = response.json()
+        self.assertEqual(body['accepted'], [0])
+        self.assertEqual([entry['index'] for entry in body['rejected']], [1])
+        self.assertEqual(FeedingHistory.objects.get().device, self.mine[0])
+
+    def test_owned_devices_are_rescanned_only_for_registry_changes(self):
+        owned = self.cluster.owned_device_pks()
+        bump_generation(DEVICES)  # As every heartbeat flush does
+        with self.assertNumQueries(1):  # The registry check, no rescan
+            self.assertEqual(self.cluster.owned_device_pks(), owned)
+        new = self.create_device('feeder-new')
+        expected = owned | {new.pk} if self.cluster.owns(new.device_id) else owned
+        self.assertEqual(self.cluster.owned_device_pks(), expected)
+
+    def test_single_device_batch_is_redirected(self):
+        event = {'event': 'feed', 'device_id': self.theirs[0].device_id, 'portion': 1, 'type': 'manual',
+                 'timestamp': 1}
+        response = self.client.post('/api/esp8266/batch/', [event], content_type='application/json')
+        self.assertEqual(response.status_code, 307)
@@ -0,0 +1,246 @@
+"""In-memory token-bucket throttling per device and per client.
+
+A feeder stuck in a reboot or retry loop can send heartbeats or command
+polls as fast as its Wi-Fi allows, and a script can do the same to the
+control API. Each endpoint class (a *scope*) therefore has a rate in
+``FEEDER_THROTTLE_RATES``, such as ``'60/min'``. The rate is a bucket that
+holds that many requests and refills evenly over the period, so short
+bursts pass and a sustained flood is cut to the rate. A request that
+finds the bucket empty gets ``429 Too Many Requests`` with a
+``Retry-After`` header.
+
+Firmware endpoints are keyed by ``device_id`` and fall back to the client
+address when the request names no device. The control endpoints are keyed
+by user (when logged in) or client address, the async ones by address.
+Each bucket is two numbers. A bucket left idle long enough to refill
+completely is evicted, because a fresh bucket is identical.
+
+DRF views use the throttle classes below with ``@throttle_classes``. The
+plain views use ``@throttle(scope)``, and ``firmware_endpoint`` checks its
+scope after validation. State is per process, like the device cache.
+"""
+import math
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from rest_framework.exceptions import Throttled
+from rest_framework.response import Response
+from rest_framework.throttling import BaseThrottle
+
+HEARTBEAT = 'heartbeat'
+COMMANDS = 'commands'
+FIRMWARE = 'firmware'
+CONTROL = 'control'
+
+# The firmware heartbeats every 10 s and polls every 5 s; these leave room
+# for reconnect bursts and sped-up load tests while stopping tight loops
+DEFAULT_RATES = {
+    HEARTBEAT: '60/min',
+    COMMANDS: '120/min',
+    FIRMWARE: '120/min',
+    CONTROL: '30/min',
+}
+DEFAULT_SWEEP_INTERVAL = 60  # seconds between idle-bucket sweeps
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """Return ``(capacity, tokens per second)`` for ``'<n>/<period>'``, or None when disabled.
+
+    Periods are read by their first letter, as in DRF: ``s``, ``m``, ``h``
+    or ``d``.
+    """
+    if not rate:
+        return None
+    count, period = rate.split('/')
+    capacity = int(count)
+    if capacity <= 0:
+        return None
+    return capacity, capacity / PERIODS[period.strip()[0].lower()]
+
+
+class TokenBucketLimiter:
+    """Token buckets keyed by ``(scope, key)``."""
+
+    def __init__(self, rates=None, sweep_interval=None):
+        self._rates = rates
+        self._sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._buckets = {}  # (scope, key) -> [tokens, monotonic time of last update]
+        self._parsed = {}   # rate string -> parse_rate() result
+        self._last_sweep = time.monotonic()
+        self.allowed = defaultdict(int)    # scope -> requests let through
+        self.throttled = defaultdict(int)  # scope -> requests refused
+        self.evicted = 0
+
+    def rate(self, scope):
+        """Return ``(capacity, tokens per second)`` for ``scope``, or None if it is not throttled."""
+        rates = self._rates if self._rates is not None else getattr(settings, 'FEEDER_THROTTLE_RATES', {})
+        rate = rates.get(scope, DEFAULT_RATES.get(scope))
+        if rate not in self._parsed:
+            self._parsed[rate] = parse_rate(rate)
+        return self._parsed[rate]
+
+    @property
+    def sweep_interval(self):
+        if self._sweep_interval is not None:
+            return self._sweep_interval
+        return getattr(settings, 'FEEDER_THROTTLE_SWEEP_INTERVAL', DEFAULT_SWEEP_INTERVAL)
+
+    def acquire(self, scope, key):
+        """Take a token; returns 0 if the request may proceed, else seconds until it may."""
+        rate = self.rate(scope)
+        if rate is None:
+            return 0
+        capacity, refill = rate
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get((scope, key))
+            if bucket is None:
+                bucket = self._buckets[(scope, key)] = [capacity, now]
+            else:
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * refill)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.allowed[scope] += 1
+                wait = 0
+            else:
+                self.throttled[scope] += 1
+                wait = (1 - bucket[0]) / refill
+            sweep = now - self._last_sweep >= self.sweep_interval
+        if sweep:
+            self.sweep(now)
+        return wait
+
+    def sweep(self, now=None):
+        """Drop buckets that have refilled completely; returns how many."""
+        now = now if now is not None else time.monotonic()
+        with self._lock:
+            self._last_sweep = now
+            idle = []
+            for (scope, key), (tokens, updated_at) in self._buckets.items():
+                rate = self.rate(scope)
+                if rate is None or tokens + (now - updated_at) * rate[1] >= rate[0]:
+                    idle.append((scope, key))
+            for bucket_key in idle:
+                del self._buckets[bucket_key]
+            self.evicted += len(idle)
+        return len(idle)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'buckets': len(self._buckets),
+                'allowed': dict(self.allowed),
+                'throttled': dict(self.throttled),
+                'evicted': self.evicted,
+            }
+
+
+request_limiter = TokenBucketLimiter()
+
+
+def address_ident(request):
+    """The client address, as DRF identifies it (``X-Forwarded-For`` with ``NUM_PROXIES``)."""
+    return f'addr:{BaseThrottle().get_ident(request)}'
+
+
+def client_ident(request):
+    """The logged-in user, or else the client address."""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    return address_ident(request)
+
+
+def device_ident(request):
+    """The ``device_id`` the request names, or else the client."""
+    device_id = request.GET.get('device_id')
+    if not device_id:
+        data = getattr(request, 'data', None)
+        if isinstance(data, dict) and isinstance(data.get('device_id'), str):
+            device_id = data['device_id']
+    return f'device:{device_id}' if device_id else client_ident(request)
+
+
+def throttled_response(wait):
+    """The 429 response DRF's exception handler builds for ``Throttled(wait)``."""
+    exc = Throttled(wait)
+    return Response({'detail': exc.detail}, status=exc.status_code, headers={'Retry-After': '%d' % exc.wait})
+
+
+def throttle(scope, key=client_ident, methods=None):
+    """Throttle a plain Django view, sync or async, per ``key(request)``.
+
+    With ``methods`` only those request methods count against the bucket.
+    For async views ``key`` runs on the event loop, so it must not touch
+    the database; use ``address_ident`` rather than the session user.
+    """
+    def check(request):
+        if methods is not None and request.method not in methods:
+            return None
+        wait = request_limiter.acquire(scope, key(request))
+        if not wait:
+            return None
+        retry_after = max(math.ceil(wait), 1)
+        return JsonResponse({
+            'status': 'error',
+            'message': f'Too many requests; retry in {retry_after}s'
+        }, status=429, headers={'Retry-After': str(retry_after)})
+
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def async_view(request, *args, **kwargs):
+                return check(request) or await view(request, *args, **kwargs)
+            return async_view
+
+        @wraps(view)
+        def sync_view(request, *args, **kwargs):
+            return check(request) or view(request, *args, **kwargs)
+        return sync_view
+    return decorator
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """DRF throttle drawing on ``request_limiter`` for ``scope``, keyed per client."""
+
+    scope = None
+
+    def get_key(self, request):
+        return client_ident(request)
+
+    def allow_request(self, request, view):
+        self.wait_time = request_limiter.acquire(self.scope, self.get_key(request))
+        return not self.wait_time
+
+    def wait(self):
+        return self.wait_time
+
+
+class DeviceThrottle(TokenBucketThrottle):
+    def get_key(self, request):
+        return device_ident(request)
+
+
+class CommandPollThrottle(DeviceThrottle):
+    scope = COMMANDS
+
+
+class FirmwareThrottle(DeviceThrottle):
+    scope = FIRMWARE
+
+
+class ControlThrottle(TokenBucketThrottle):
+    scope = CONTROL
@@ -5,6 +5,7 @@ from rest_framework.routers import DefaultRouter
 # Create a router for REST API viewsets
 router = DefaultRouter()
 router.register(r'api/schedules', views.FeedingScheduleViewSet)
+router.register(r'api/history', views.FeedingHistoryViewSet)
 
 urlpatterns = [
     path('', views.home, name='home'),
@@ -13,15 +14,25 @@ urlpatterns = [
     path('motor_control/', views.motor_control_page, name='motor_control_page'),
     path('history/', views.history, name='history'),
     path('bmi/', views.bmi, name='bmi'),
+    path('export/<str:name>/', views.export_data, name='export_data'),
+    path('metrics', views.metrics_endpoint, name='metrics'),
     # REST API endpoints
     path('api/motor/', views.motor_control_api, name='motor_control_api'),
+    path('api/feed/bulk/', views.feed_bulk, name='feed_bulk'),
+    path('api/consumption/', views.consumption_summary_api, name='consumption_summary'),
+    path('api/events/', views.events_stream, name='events_stream'),
+    # Async counterparts served natively under ASGI (Petfeeder/asgi.py)
+    path('api/motor/async/', views.motor_control_async, name='motor_control_async'),
+    path('api/feed/async/', views.feed_async, name='feed_async'),
     
     # ESP8266 API endpoints for firmware communication
     path('api/esp8266/', views.esp8266_api, name='esp8266_api'),
     path('api/esp8266/heartbeat/', views.esp8266_heartbeat, name='esp8266_heartbeat'),
+    path('api/esp8266/heartbeat/stats/', views.esp8266_heartbeat_stats, name='esp8266_heartbeat_stats'),
     path('api/esp8266/feed/', views.esp8266_feed_notification, name='esp8266_feed_notification'),
     path('api/esp8266/commands/', views.esp8266_commands, name='esp8266_commands'),
     path('api/esp8266/acknowledge/', views.esp8266_acknowledge_command, name='esp8266_acknowledge_command'),
+    path('api/esp8266/batch/', views.esp8266_batch, name='esp8266_batch'),
     
     path('', include(router.urls)),
     # path('send_notification/', views.send_notification, name='send_notification'),
@@ -1,20 +1,60 @@
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
 from .models import FeedingSchedule, ESP8266Device, FeedingHistory, DeviceCommand
 import datetime
+import json
+import time
 import requests
 from rest_framework import viewsets, status
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, throttle_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 from .serializers import (FeedingScheduleSerializer, MotorControlSerializer, ESP8266DeviceSerializer,
                           FeedingHistorySerializer, DeviceCommandSerializer, DeviceRegistrationSerializer,
-                          HeartbeatSerializer, FeedNotificationSerializer, CommandAcknowledgmentSerializer)
+                          BulkFeedSerializer)
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Value, When
+from django.core.handlers.asgi import ASGIRequest
+from asgiref.sync import sync_to_async
+from .cluster import cluster, misrouted
+from .commands import (acknowledge_command, claim_for_delivery, command_batch_size, command_etag, command_version, format_command,
+                       is_drained, long_poll_timeout, notify_commands_queued, wait_for_commands)
+from .device_client import device_address, send_motor_command, send_motor_command_async
+from .devices import get_device
+from .dispatch import STEPS_PER_PORTION, dispatch_motor_commands_sync, select_devices
+from .events import EVENT_KINDS, Subscription, astream, publish_command_status, stream
+from .health import device_breaker, feeder_device
+from .heartbeat import heartbeat_buffer
+from .metrics import metrics
+from .fastpath import acknowledgment_validator, feed_notification_validator, firmware_endpoint, heartbeat_validator
+from .export import EXPORTS, FORMATS as EXPORT_FORMATS, parse_bound, stream_export
+from .ingest import ingest_events
+from .listcache import DEVICES, SCHEDULES, bump_generation, cached_list, not_modified
+from .outbox import enqueue_command
+from .pagination import KeysetPagination
+from .rollups import PERIODS as CONSUMPTION_PERIODS, consumption_summary
+from .throttle import (CONTROL, HEARTBEAT, CommandPollThrottle, ControlThrottle, FirmwareThrottle, address_ident,
+                       throttle)
+from .wire import firmware_wire_format
+
+QUEUED_FEED_MESSAGE = 'The feeder is not reachable right now. The feed was queued and runs when it next checks in.'
+SENDING_FEED_MESSAGE = 'Feed command queued and being sent to the feeder.'
+
+def feed_queued_message(device):
+    """Tell the user whether an outbox feed goes out now or waits for the device."""
+    if device.is_active and device.ip_address and not device_breaker.is_open(device_address(device)):
+        return SENDING_FEED_MESSAGE
+    return QUEUED_FEED_MESSAGE
 
 def home(request):
     """View function for the home page."""
     return render(request, 'app/home.html')
 
+@throttle(CONTROL, methods=['POST'])
 def feed_control(request):
     """View function for the feed control page."""
     if request.method == 'POST':
@@ -29,65 +69,23 @@ def feed_control(request):
             try:
                 portion = int(request.POST.get('portion', 5))
                 # Get the ESP8266 device
-                device = ESP8266Device.objects.filter(is_active=True).first()
+                device = feeder_device()
                 
-                if device and device.ip_address:
-                    try:
-                        # Calculate steps based on portion size (adjust as needed)
-                        steps = portion * 200  # Example: 200 steps per portion
-                        
-                        # Create a command in the database
-                        command = DeviceCommand.objects.create(
-                            device=device,
-                            command_type='feed',
-                            parameters={'portion': portion, 'steps': steps},
-                            status='pending'
-                        )
-                        
-                        # Construct the URL for the ESP8266 device
-                        url = f"http://{device.ip_address}:{device.port}/motor"
-                        
-                        # Get motor control parameters from the request
-                        direction = request.POST.get('direction', 'clockwise')
-                        speed = int(request.POST.get('speed', 1000))
-                        microstepping = request.POST.get('microstepping', '16')
-                        
-                        # Prepare the data to send to the ESP8266
-                        data = {
-                            'steps': steps,
-                            'direction': direction,
-                            'speed': speed,
-                            'microstepping': microstepping
-                        }
-                        
-                        # Send the request to the ESP8266
-                        response = requests.post(url, json=data, timeout=5)
-                        
-                        if response.status_code == 200:
-                            # Update the last connected timestamp
-                            device.last_connected = timezone.now()
-                            device.save()
-                            
-                            # Update command status
-                            command.status = 'completed'
-                            command.save()
-                            
-                            # Record the feeding in history
-                            FeedingHistory.objects.create(
-                                device=device,
-                                portion=portion,
-                                feed_type='remote'
-                            )
-                            
-                            response_data = {'status': 'success', 'message': 'Feed command sent successfully!'}
-                        else:
-                            # Update command status
-                            command.status = 'failed'
-                            command.save()
-                            response_data = {'status': 'error', 'message': f'Error: ESP8266 returned status code {response.status_code}'}
-                            
-                    except requests.exceptions.RequestException as e:
-                        response_data = {'status': 'error', 'message': f'Failed to connect to ESP8266: {str(e)}'}
+                if device:
+                    # Calculate steps based on portion size (adjust as needed)
+                    steps = portion * 200  # Example: 200 steps per portion
+                    parameters = {
+                        'portion': portion,
+                        'steps': steps,
+                        'direction': request.POST.get('direction', 'clockwise'),
+                        'speed': int(request.POST.get('speed', 1000)),
+                        'microstepping': request.POST.get('microstepping', '16')
+                    }
+                    
+                    # The outbox workers push it (retrying through Wi-Fi drops)
+                    # and the device can pull it meanwhile; nobody waits on the device here
+                    enqueue_command(device, 'feed', parameters)
+                    response_data = {'status': 'success', 'queued': True, 'message': feed_queued_message(device)}
                 else:
                     response_data = {'status': 'error', 'message': 'No active ESP8266 device configured. Please configure a device in the motor control page.'}
             except ValueError as e:
@@ -131,8 +129,17 @@ def feed_control(request):
     # Get all scheduled feedings for GET request
     schedules = FeedingSchedule.objects.all().order_by('time')
     if request.headers.get('Accept') == 'application/json':
-        schedule_data = [{'id': s.id, 'time': s.time.strftime('%H:%M'), 'portion': s.portion} for s in schedules]
-        return JsonResponse({'status': 'success', 'schedules': schedule_data})
+        etag = not_modified(request, SCHEDULES, 'feed_control')
+        if etag:
+            response = HttpResponse(status=304)
+            response['ETag'] = etag
+            return response
+        schedule_data, etag = cached_list(SCHEDULES, 'feed_control', lambda: [
+            {'id': s.id, 'time': s.time.strftime('%H:%M'), 'portion': s.portion} for s in schedules
+        ])
+        response = JsonResponse({'status': 'success', 'schedules': schedule_data})
+        response['ETag'] = etag
+        return response
     return render(request, 'control/feed.html', {'schedules': schedules})
 
 ss = FeedingScheduleSerializer
@@ -145,6 +152,7 @@ def control_motor(request):
     return JsonResponse({'status': 'error', 'message': 'Invalid request method'})
 
 @api_view(['POST'])
+@throttle_classes([ControlThrottle])
 def motor_control_api(request):
     """REST API endpoint for controlling the stepper motor with microstepping."""
     serializer = MotorControlSerializer(data=request.data)
@@ -156,13 +164,14 @@ def motor_control_api(request):
         microstepping = serializer.validated_data.get('microstepping', '16')
         
         # Get the ESP8266 device (assuming there's at least one configured)
-        device = ESP8266Device.objects.filter(is_active=True).first()
+        device = feeder_device()
         
         if device and device.ip_address:
+            if not device_breaker.allow(device_address(device)):
+                # Raw motor moves cannot be queued (the firmware only pulls feed
+                # commands), so fail fast instead of waiting out a timeout
+                return _device_unavailable_response(device)
             try:
-                # Construct the URL for the ESP8266 device
-                url = f"http://{device.ip_address}:{device.port}/motor"
-                
                 # Prepare the data to send to the ESP8266
                 data = {
                     'steps': steps,
@@ -172,12 +181,11 @@ def motor_control_api(request):
                 }
                 
                 # Send the request to the ESP8266
-                response = requests.post(url, json=data, timeout=5)
+                response = send_motor_command(device, data, timeout=5)
                 
                 if response.status_code == 200:
-                    # Update the last connected timestamp
-                    device.last_connected = timezone.now()
-                    device.save()
+                    # Update the last connected timestamp; a presence write, not a registry change
+                    ESP8266Device.objects.filter(pk=device.pk).update(last_connected=timezone.now())
                     
                     return Response({
                         'status': 'success',
@@ -204,6 +212,220 @@ def motor_control_api(request):
     else:
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['POST'])
+@throttle_classes([ControlThrottle])
+def feed_bulk(request):
+    """REST API endpoint for feeding many devices at once.
+    
+    Devices are picked by selector (all active, explicit device_ids, name
+    pattern). One feed command per device is written in a single bulk insert
+    and pushed to the devices concurrently. Devices that cannot be reached
+    keep their command pending for pull delivery via esp8266_commands.
+    """
+    serializer = BulkFeedSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    params = serializer.validated_data
+    
+    max_devices = getattr(settings, 'FEEDER_BULK_FEED_MAX_DEVICES', 1000)
+    devices = list(select_devices(params['all_active'], params.get('device_ids'), params.get('name_pattern'))[:max_devices + 1])
+    if not devices:
+        return Response({
+            'status': 'error',
+            'message': 'No devices matched the selector'
+        }, status=status.HTTP_404_NOT_FOUND)
+    if len(devices) > max_devices:
+        return Response({
+            'status': 'error',
+            'message': f'Selector matched more than {max_devices} devices'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    
+    started = time.perf_counter()
+    portion = params['portion']
+    steps = portion * STEPS_PER_PORTION
+    motor_data = {
+        'steps': steps,
+        'direction': params['direction'],
+        'speed': params['speed'],
+        'microstepping': params['microstepping']
+    }
+    
+    # Commands pushed over HTTP start as 'sent' so a concurrent poll cannot
+    # claim and execute them a second time
+    direct = [bool(device.ip_address) for device in devices]
+    with transaction.atomic():
+        commands = DeviceCommand.objects.bulk_create([
+            DeviceCommand(
+                device=device,
+                command_type='feed',
+                parameters={'portion': portion, 'steps': steps},
+                status='sent' if is_direct else 'pending'
+            )
+            for device, is_direct in zip(devices, direct)
+        ])
+        # Devices without an address pick their command up on the next poll
+        queued = [device.pk for device, is_direct in zip(devices, direct) if not is_direct]
+        if queued:
+            notify_commands_queued(queued)
+    jobs = [(device, command, motor_data) for device, command, is_direct in zip(devices, commands, direct) if is_direct]
+    results = dispatch_motor_commands_sync(jobs) if jobs else []
+    
+    now = timezone.now()
+    completed = [r for r in results if r.delivered]
+    failed = [r for r in results if not r.delivered and not r.unreachable]
+    unreachable = [r for r in results if r.unreachable]
+    if completed:
+        DeviceCommand.objects.filter(id__in=[r.command.id for r in completed]).update(status='completed', updated_at=now)
+        ESP8266Device.objects.filter(pk__in=[r.device.pk for r in completed]).update(last_connected=now)
+        bump_generation(DEVICES)
+        FeedingHistory.objects.bulk_create([
+            FeedingHistory(device=r.device, portion=portion, feed_type='remote') for r in completed
+        ])
+        publish_command_status([r.command for r in completed], 'completed')
+    if failed:
+        # Includes read timeouts: the device may have fed, so the command is not requeued
+        DeviceCommand.objects.filter(id__in=[r.command.id for r in failed]).update(
+            status='failed', updated_at=now,
+            last_error=Case(*(When(id=r.command.id, then=Value((r.error or '')[:255])) for r in failed)),
+        )
+        publish_command_status([r.command for r in failed], 'failed')
+    if unreachable:
+        # Unreachable devices pick their command up on the next poll
+        with transaction.atomic():
+            DeviceCommand.objects.filter(id__in=[r.command.id for r in unreachable]).update(status='pending', updated_at=now)
+            notify_commands_queued(r.device.pk for r in unreachable)
+        publish_command_status([r.command for r in unreachable], 'pending')
+        queued += [r.device.pk for r in unreachable]
+    
+    result_list = [r.as_dict() for r in results] + [
+        {
+            'device_id': device.device_id,
+            'name': device.name,
+            'command_id': str(command.id),
+            'status': 'queued',
+            'http_status': None,
+            'latency_ms': None,
+            'error': 'Device has no IP address'
+        }
+        for device, command, is_direct in zip(devices, commands, direct) if not is_direct
+    ]
+    return Response({
+        'status': 'success',
+        'summary': {
+            'devices': len(devices),
+            'completed': len(completed),
+            'failed': len(failed),
+            'queued': len(queued),
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+        },
+        'results': result_list
+    })
+
+def _device_unavailable_response(device, response_class=Response):
+    """503 for a device whose circuit breaker is open, with a Retry-After hint."""
+    retry_after = max(int(device_breaker.retry_after(device_address(device))), 1)
+    return response_class({
+        'status': 'error',
+        'message': f'ESP8266 {device.name} is unreachable; retry in {retry_after}s'
+    }, status=503, headers={'Retry-After': str(retry_after)})
+
+def _read_json_body(request):
+    """Decode a JSON request body for the plain (non-DRF) async views."""
+    try:
+        return json.loads(request.body or b'{}')
+    except ValueError:
+        return None
+
+@csrf_exempt
+@throttle(CONTROL, key=address_ident)
+async def motor_control_async(request):
+    """Async API endpoint for controlling the stepper motor.
+    
+    Same contract as motor_control_api, but served natively under ASGI: the
+    call to the ESP8266 goes through the pooled async client, so a slow
+    feeder does not hold a worker thread.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method'}, status=405)
+    payload = _read_json_body(request)
+    if payload is None:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON body'}, status=400)
+    
+    serializer = MotorControlSerializer(data=payload)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=400)
+    
+    device = await ESP8266Device.objects.filter(is_active=True).afirst()
+    if not device or not device.ip_address:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'No active ESP8266 device configured'
+        }, status=404)
+    if not device_breaker.allow(device_address(device)):
+        return _device_unavailable_response(device, JsonResponse)
+    
+    data = {
+        'steps': serializer.validated_data['steps'],
+        'direction': serializer.validated_data['direction'],
+        'speed': serializer.validated_data.get('speed', 1000),
+        'microstepping': serializer.validated_data.get('microstepping', '16')
+    }
+    try:
+        response = await send_motor_command_async(device, data, timeout=5)
+    except requests.exceptions.RequestException as e:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'Failed to connect to ESP8266: {str(e)}'
+        }, status=503)
+    
+    if response.status_code != 200:
+        return JsonResponse({
+            'status': 'error',
+            'message': f'ESP8266 returned status code {response.status_code}',
+            'esp_response': response.text
+        }, status=502)
+    
+    await ESP8266Device.objects.filter(pk=device.pk).aupdate(last_connected=timezone.now())
+    await sync_to_async(bump_generation)(DEVICES)
+    return JsonResponse({
+        'status': 'success',
+        'message': 'Command sent to ESP8266 successfully',
+        'esp_response': response.json()
+    })
+
+@csrf_exempt
+@throttle(CONTROL, key=address_ident)
+async def feed_async(request):
+    """Async API endpoint for a manual feed, the ASGI counterpart of feed_control."""
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'Invalid request method'}, status=405)
+    payload = _read_json_body(request)
+    if payload is None:
+        return JsonResponse({'status': 'error', 'message': 'Invalid JSON body'}, status=400)
+    try:
+        portion = int(payload.get('portion', 5))
+        speed = int(payload.get('speed', 1000))
+    except (TypeError, ValueError) as e:
+        return JsonResponse({'status': 'error', 'message': f'Invalid input: {str(e)}'}, status=400)
+    
+    device = await sync_to_async(feeder_device)()
+    if not device:
+        return JsonResponse({
+            'status': 'error',
+            'message': 'No active ESP8266 device configured. Please configure a device in the motor control page.'
+        }, status=404)
+    
+    steps = portion * 200  # Same 200 steps per portion as feed_control
+    parameters = {
+        'portion': portion,
+        'steps': steps,
+        'direction': payload.get('direction', 'clockwise'),
+        'speed': speed,
+        'microstepping': payload.get('microstepping', '16')
+    }
+    await sync_to_async(enqueue_command)(device, 'feed', parameters)
+    return JsonResponse({'status': 'success', 'queued': True, 'message': feed_queued_message(device)}, status=202)
+
 @api_view(['GET', 'POST'])
 def esp8266_config(request):
     """API endpoint for managing ESP8266 device configuration."""
@@ -251,10 +473,59 @@ class FeedingScheduleViewSet(viewsets.ModelViewSet):
     """ViewSet for viewing and editing FeedingSchedule instances."""
     queryset = FeedingSchedule.objects.all()
     serializer_class = FeedingScheduleSerializer
+    
+    def list(self, request, *args, **kwargs):
+        # Served from the generation cache; unchanged lists cost one counter read
+        etag = not_modified(request, SCHEDULES, 'list')
+        if etag:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        data, etag = cached_list(SCHEDULES, 'list', lambda: list(
+            self.get_serializer(self.filter_queryset(self.get_queryset()), many=True).data
+        ))
+        return Response(data, headers={'ETag': etag})
+
+class FeedingHistoryViewSet(viewsets.ReadOnlyModelViewSet):
+    """Read-only, keyset-paginated feeding history.
+    
+    Filters: device (pk), device_id, feed_type, since and until (ISO 8601
+    datetimes). Follow the "next" link to page through the full history.
+    """
+    queryset = FeedingHistory.objects.select_related('device').only(
+        'id', 'timestamp', 'portion', 'feed_type', 'device__id', 'device__name'
+    )
+    serializer_class = FeedingHistorySerializer
+    pagination_class = KeysetPagination
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        params = self.request.query_params
+        if params.get('device'):
+            try:
+                queryset = queryset.filter(device_id=int(params['device']))
+            except ValueError:
+                raise ValidationError({'device': ['A valid integer is required.']})
+        if params.get('device_id'):
+            queryset = queryset.filter(device__device_id=params['device_id'])
+        if params.get('feed_type'):
+            queryset = queryset.filter(feed_type=params['feed_type'])
+        for param, lookup in (('since', 'timestamp__gte'), ('until', 'timestamp__lt')):
+            if params.get(param):
+                try:
+                    value = parse_datetime(params[param])
+                except ValueError:  # Well formatted but impossible, e.g. February 30th
+                    value = None
+                if value is None:
+                    raise ValidationError({param: ['Enter a valid ISO 8601 datetime.']})
+                if timezone.is_naive(value):
+                    value = timezone.make_aware(value)
+                queryset = queryset.filter(**{lookup: value})
+        return queryset
+FEED_TYPE_LABELS = dict(FeedingHistory.FEED_TYPES)
+
 def history(request):
     """View function for the feeding history page."""
     # Fetch the feeding history from the database
-    history_entries = FeedingHistory.objects.all().order_by('-timestamp')[:20]  # Get the 20 most recent entries
+    history_entries = FeedingHistory.objects.only('id', 'timestamp', 'portion', 'feed_type').order_by('-timestamp', '-id')[:20]  # Get the 20 most recent entries
     
     # Format the history for display
     formatted_history = []
@@ -264,7 +535,7 @@ def history(request):
                 'date': entry.timestamp.strftime('%Y-%m-%d'),
                 'time': entry.timestamp.strftime('%H:%M'),
                 'portion': entry.portion,
-                'type': dict(FeedingHistory.FEED_TYPES).get(entry.feed_type, entry.feed_type)
+                'type': FEED_TYPE_LABELS.get(entry.feed_type, entry.feed_type)
             })
         except Exception as e:
             # Log the error but continue processing other entries
@@ -277,7 +548,71 @@ def history(request):
             'history': formatted_history
         })
     
-    return render(request, 'control/history.html', {'history': formatted_history})
+    # Daily totals for the last week come from the rollups, not the raw history
+    week_ago = timezone.localdate() - datetime.timedelta(days=6)
+    daily_totals = consumption_summary('day', since=week_ago)
+    
+    return render(request, 'control/history.html', {'history': formatted_history, 'daily_totals': daily_totals})
+
+@api_view(['GET'])
+def consumption_summary_api(request):
+    """REST API endpoint serving pre-aggregated feeding totals.
+    
+    Query parameters: period (day, week or month), device_id, since and
+    until (YYYY-MM-DD, until exclusive).
+    """
+    period = request.query_params.get('period', 'day')
+    if period not in CONSUMPTION_PERIODS:
+        return Response({
+            'status': 'error',
+            'message': f'period must be one of {", ".join(CONSUMPTION_PERIODS)}'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    bounds = {}
+    for param in ('since', 'until'):
+        value = request.query_params.get(param)
+        if value:
+            try:
+                bounds[param] = parse_date(value)
+            except ValueError:  # Well formatted but impossible, e.g. 2024-13-45
+                bounds[param] = None
+            if bounds[param] is None:
+                return Response({
+                    'status': 'error',
+                    'message': f'{param} must be a date (YYYY-MM-DD)'
+                }, status=status.HTTP_400_BAD_REQUEST)
+    
+    return Response({
+        'status': 'success',
+        'period': period,
+        'results': consumption_summary(period, request.query_params.get('device_id'), **bounds)
+    })
+
+def export_data(request, name):
+    """Stream feeding history or device commands as CSV or NDJSON.
+    
+    Query parameters: format (csv or ndjson), gzip=1, device_id, since, until.
+    """
+    if name not in EXPORTS:
+        raise Http404(f'Unknown export: {name}')
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        return JsonResponse({'status': 'error', 'message': f'Unsupported format: {fmt}'}, status=400)
+    try:
+        since = parse_bound(request.GET.get('since'))
+        until = parse_bound(request.GET.get('until'))
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    compress = request.GET.get('gzip') in ('1', 'true')
+    
+    chunks = stream_export(name, fmt, compress, device_id=request.GET.get('device_id'), since=since, until=until)
+    filename = f"{name}-{timezone.now():%Y%m%d%H%M%S}.{fmt}"
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    if compress:
+        filename += '.gz'
+        content_type = 'application/gzip'
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
 
 def bmi(request):
     """View function for the BMI calculator page."""
@@ -287,7 +622,9 @@ def motor_control_page(request):
     """View function for the motor control page."""
     return render(request, 'control/motor_control.html')
 
+@firmware_wire_format
 @api_view(['GET', 'POST'])
+@throttle_classes([FirmwareThrottle])
 def esp8266_api(request):
     """Main API endpoint for ESP8266 device registration."""
     if request.method == 'POST':
@@ -326,67 +663,146 @@ def esp8266_api(request):
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
     elif request.method == 'GET':
-        # List all registered devices
-        devices = ESP8266Device.objects.all()
-        serializer = ESP8266DeviceSerializer(devices, many=True)
-        return Response(serializer.data)
+        # List all registered devices; unchanged lists cost one counter read
+        etag = not_modified(request, DEVICES, 'all')
+        if etag:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        data, etag = cached_list(DEVICES, 'all', lambda: list(
+            ESP8266DeviceSerializer(heartbeat_buffer.overlay(ESP8266Device.objects.all()), many=True).data
+        ))
+        return Response(data, headers={'ETag': etag})
 
-@api_view(['POST'])
-def esp8266_heartbeat(request):
+@firmware_endpoint(heartbeat_validator, HEARTBEAT)
+def esp8266_heartbeat(data):
     """API endpoint for ESP8266 device heartbeat."""
-    serializer = HeartbeatSerializer(data=request.data)
-    if serializer.is_valid():
-        device_id = serializer.validated_data.get('device_id')
-        device = ESP8266Device.objects.filter(device_id=device_id).first()
+    device = get_device(data.get('device_id'))
+    
+    if device:
+        # Buffer the presence update; it is written in bulk on the next flush
+        heartbeat_buffer.record(device.pk, data.get('ip_address'))
         
-        if device:
-            # Update device IP address and last connected timestamp
-            device.ip_address = serializer.validated_data.get('ip_address')
-            device.last_connected = timezone.now()
-            device.is_active = True
-            device.save()
-            
-            return Response({
-                'status': 'success',
-                'message': 'Heartbeat received'
-            })
-        else:
-            return Response({
-                'status': 'error',
-                'message': 'Device not found'
-            }, status=status.HTTP_404_NOT_FOUND)
+        return Response({
+            'status': 'success',
+            'message': 'Heartbeat received'
+        })
     else:
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'status': 'error',
+            'message': 'Device not found'
+        }, status=status.HTTP_404_NOT_FOUND)
 
-@api_view(['POST'])
-def esp8266_feed_notification(request):
+def events_stream(request):
+    """Server-Sent Events stream of device, feeding history and command changes.
+
+    ``?types=history,command`` limits the event kinds and ``?device_id=``
+    limits the stream to one device. Reconnecting clients send
+    ``Last-Event-ID`` and receive what they missed.
+    """
+    kinds = [kind for kind in request.GET.get('types', '').split(',') if kind]
+    unknown = sorted(set(kinds) - set(EVENT_KINDS))
+    if unknown:
+        return JsonResponse({'status': 'error', 'message': f'Unknown event types: {", ".join(unknown)}'}, status=400)
+    device_pk = None
+    if request.GET.get('device_id'):
+        device = get_device(request.GET['device_id'])
+        if device is None:
+            return JsonResponse({'status': 'error', 'message': 'Device not found'}, status=404)
+        device_pk = device.pk
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    subscription = Subscription(kinds, device_pk)
+    # Under ASGI the stream waits on the event loop instead of holding a thread
+    body = astream if isinstance(request, ASGIRequest) else stream
+    response = StreamingHttpResponse(body(subscription, last_event_id), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Keep nginx from buffering the stream
+    return response
+
+def metrics_endpoint(request):
+    """Prometheus scrape endpoint with request, database and device-call metrics."""
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api_view(['GET'])
+def esp8266_heartbeat_stats(request):
+    """API endpoint reporting how many heartbeat writes were coalesced."""
+    return Response(heartbeat_buffer.stats())
+
+@firmware_endpoint(feed_notification_validator)
+def esp8266_feed_notification(data):
     """API endpoint for ESP8266 device feed notification."""
-    serializer = FeedNotificationSerializer(data=request.data)
-    if serializer.is_valid():
-        device_id = serializer.validated_data.get('device_id')
-        device = ESP8266Device.objects.filter(device_id=device_id).first()
+    device = get_device(data.get('device_id'))
+    
+    if device:
+        # Record the feeding in history
+        FeedingHistory.objects.create(
+            device=device,
+            portion=data.get('portion', 1),
+            feed_type=data.get('type', 'manual')
+        )
         
-        if device:
-            # Record the feeding in history
-            FeedingHistory.objects.create(
-                device=device,
-                portion=serializer.validated_data.get('portion', 1),
-                feed_type=serializer.validated_data.get('type', 'manual')
-            )
-            
-            return Response({
-                'status': 'success',
-                'message': 'Feed notification recorded'
-            })
-        else:
-            return Response({
-                'status': 'error',
-                'message': 'Device not found'
-            }, status=status.HTTP_404_NOT_FOUND)
+        return Response({
+            'status': 'success',
+            'message': 'Feed notification recorded'
+        })
     else:
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'status': 'error',
+            'message': 'Device not found'
+        }, status=status.HTTP_404_NOT_FOUND)
 
+@firmware_wire_format
+@api_view(['POST'])
+@throttle_classes([FirmwareThrottle])
+def esp8266_batch(request):
+    """API endpoint for ESP8266 devices replaying buffered events in one request.
+    
+    Accepts a list of events (or {"events": [...]}) where each event carries
+    an "event" kind of feed, heartbeat or ack plus the fields of the matching
+    single-event endpoint. Valid events are stored in one transaction; the
+    response lists which indexes were accepted and why others were rejected.
+    """
+    events = request.data.get('events') if isinstance(request.data, dict) else request.data
+    if not isinstance(events, list):
+        return Response({
+            'status': 'error',
+            'message': 'Expected a list of events'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    max_events = getattr(settings, 'FEEDER_BATCH_MAX_EVENTS', 500)
+    if len(events) > max_events:
+        return Response({
+            'status': 'error',
+            'message': f'A batch may contain at most {max_events} events'
+        }, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    
+    # In a cluster a device's events go to its owner node, which buffers its presence
+    named = {event['device_id'] for event in events
+             if isinstance(event, dict) and isinstance(event.get('device_id'), str)}
+    elsewhere = {device_id for device_id in named if misrouted(request, device_id) is not None}
+    if len(named) == 1 and elsewhere:
+        return misrouted(request, named.pop())
+    kept = [index for index, event in enumerate(events)
+            if not (isinstance(event, dict) and isinstance(event.get('device_id'), str)
+                    and event['device_id'] in elsewhere)]
+    accepted, rejected = ingest_events([events[index] for index in kept])
+    # Map indexes back to the request's when events were held back
+    accepted = [kept[index] for index in accepted]
+    rejected = {kept[index]: errors for index, errors in rejected.items()}
+    for index in set(range(len(events))).difference(kept):
+        owner = cluster.owner(events[index]['device_id'])
+        rejected[index] = {'device_id': [f"Served by node {owner}; send this device's events there"]}
+    return Response({
+        'status': 'partial' if rejected else 'success',
+        'accepted': accepted,
+        'rejected': [{'index': index, 'errors': rejected[index]} for index in sorted(rejected)]
+    })
+
+@firmware_wire_format
 @api_view(['GET'])
+@throttle_classes([CommandPollThrottle])
 def esp8266_commands(request):
     """API endpoint for ESP8266 device to check for pending commands."""
     device_id = request.query_params.get('device_id')
@@ -396,72 +812,69 @@ def esp8266_commands(request):
             'message': 'Device ID is required'
         }, status=status.HTTP_400_BAD_REQUEST)
     
-    device = ESP8266Device.objects.filter(device_id=device_id).first()
+    # In a cluster the device's owner node answers its polls
+    misroute = misrouted(request, device_id)
+    if misroute is not None:
+        return misroute
+    
+    device = get_device(device_id)
     if not device:
         return Response({
             'status': 'error',
             'message': 'Device not found'
         }, status=status.HTTP_404_NOT_FOUND)
     
-    # Get pending commands for this device
-    commands = DeviceCommand.objects.filter(device=device, status='pending')
+    try:
+        limit = min(int(request.query_params.get('limit', command_batch_size())), command_batch_size())
+        wait = min(float(request.query_params.get('wait', 0)), long_poll_timeout())
+    except ValueError:
+        return Response({
+            'status': 'error',
+            'message': 'limit and wait must be numbers'
+        }, status=status.HTTP_400_BAD_REQUEST)
+    limit = max(limit, 1)
+    
+    # Skip the database entirely while the device is known to have nothing pending
+    version = command_version(device.pk)
+    commands = [] if is_drained(device.pk, version) else claim_for_delivery(device, limit, version)
+    
+    # Long-poll: hold the request until a command is queued or the wait expires
+    if not commands and wait > 0 and wait_for_commands(device.pk, version, wait):
+        version = command_version(device.pk)
+        commands = claim_for_delivery(device, limit, version)
+    
+    etag = command_etag(device.pk, version)
+    if not commands and request.headers.get('If-None-Match') == etag:
+        return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
     
     # Format commands for the ESP8266
-    command_list = []
-    for command in commands:
-        command_list.append({
-            'id': str(command.id),
-            'type': command.command_type,
-            **command.parameters
-        })
-        
-        # Mark command as sent
-        command.status = 'sent'
-        command.save()
+    command_list = [format_command(command) for command in commands]
     
     return Response({
         'status': 'success',
         'commands': command_list
-    })
+    }, headers={'ETag': etag})
 
-@api_view(['POST'])
-def esp8266_acknowledge_command(request):
+@firmware_endpoint(acknowledgment_validator)
+def esp8266_acknowledge_command(data):
     """API endpoint for ESP8266 device to acknowledge command completion."""
-    serializer = CommandAcknowledgmentSerializer(data=request.data)
-    if serializer.is_valid():
-        device_id = serializer.validated_data.get('device_id')
-        command_id = serializer.validated_data.get('command_id')
-        command_status = serializer.validated_data.get('status')
-        
-        device = ESP8266Device.objects.filter(device_id=device_id).first()
-        if not device:
-            return Response({
-                'status': 'error',
-                'message': 'Device not found'
-            }, status=status.HTTP_404_NOT_FOUND)
-        
-        try:
-            command = DeviceCommand.objects.get(id=command_id, device=device)
-            command.status = 'completed' if command_status == 'completed' else 'failed'
-            command.save()
-            
-            # If this was a feed command that completed successfully, record it in history
-            if command.command_type == 'feed' and command_status == 'completed':
-                portion = command.parameters.get('portion', 1)
-                FeedingHistory.objects.create(
-                    device=device,
-                    portion=portion,
-                    feed_type='scheduled'
-                )
-            
-            return Response({
-                'status': 'success',
-                'message': 'Command acknowledged'
-            })
-        except DeviceCommand.DoesNotExist:
-            return Response({
-                'status': 'error',
-                'message': 'Command not found'
-            }, status=status.HTTP_404_NOT_FOUND)
-    else:
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
\ No newline at end of file
+    device = get_device(data.get('device_id'))
+    if not device:
+        return Response({
+            'status': 'error',
+            'message': 'Device not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    # Only a sent -> completed/failed transition writes anything; retried
+    # acks are answered after a single lookup
+    command, transitioned = acknowledge_command(device, data.get('command_id'), data.get('status'))
+    if command is None:
+        return Response({
+            'status': 'error',
+            'message': 'Command not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    
+    return Response({
+        'status': 'success',
+        'message': 'Command acknowledged' if transitioned else 'Command already acknowledged'
+    })
@@ -2,6 +2,9 @@
 ASGI config for Petfeeder project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Async views (e.g. ``Feeder.views.motor_control_async``) run natively on the
+server's event loop when served through this module. WebSocket connections
+go to the feeder push channel (``Feeder.push``) at ``/ws/esp8266/``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +16,36 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Petfeeder.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up: the push channel uses the ORM
+from Feeder.cluster import cluster  # noqa: E402
+from Feeder.device_client import close_async_pool  # noqa: E402
+from Feeder.heartbeat import heartbeat_buffer  # noqa: E402
+from Feeder.push import websocket_application  # noqa: E402
+
+# Join the feeder cluster when serving; a no-op unless FEEDER_CLUSTER_DIR is set
+cluster.start()
+# Sweep stale devices from startup, not only once the first heartbeat arrives
+heartbeat_buffer.start()
+
+
+async def lifespan(scope, receive, send):
+    """Close the feeder connection pool while the server's event loop still runs."""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close_async_pool()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        await websocket_application(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await lifespan(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
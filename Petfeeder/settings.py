@@ -44,6 +44,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'Feeder.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,13 +77,69 @@ WSGI_APPLICATION = 'Petfeeder.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
-
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+#
+# FEEDER_DB_PROFILE selects the database setup:
+#   development - plain SQLite file, Django defaults (the default)
+#   sqlite      - SQLite tuned for concurrent heartbeats and command polls:
+#                 WAL journal, synchronous=NORMAL, mmap/cache pragmas, busy
+#                 timeout, IMMEDIATE transactions and persistent connections
+#   postgres    - PostgreSQL with a psycopg connection pool
+#                 (requires: pip install "psycopg[binary,pool]")
+
+FEEDER_DB_PROFILE = os.environ.get('FEEDER_DB_PROFILE', 'development')
+
+if FEEDER_DB_PROFILE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'petfeeder'),
+            'USER': os.environ.get('POSTGRES_USER', 'petfeeder'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Connections come from the pool, so they must not also be persistent
+            'CONN_MAX_AGE': 0,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('FEEDER_DB_POOL_MIN', 2)),
+                    'max_size': int(os.environ.get('FEEDER_DB_POOL_MAX', 20)),
+                    'timeout': int(os.environ.get('FEEDER_DB_POOL_TIMEOUT', 10)),
+                },
+            },
+        }
+    }
+elif FEEDER_DB_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('FEEDER_SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            'CONN_MAX_AGE': int(os.environ.get('FEEDER_DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # Seconds a writer waits for the lock before "database is locked"
+                'timeout': int(os.environ.get('FEEDER_SQLITE_BUSY_TIMEOUT', 20)),
+                # Take the write lock at BEGIN so transactions never fail on lock upgrade
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA temp_store=MEMORY;'
+                    f"PRAGMA mmap_size={int(os.environ.get('FEEDER_SQLITE_MMAP_SIZE', 268435456))};"
+                    f"PRAGMA cache_size={int(os.environ.get('FEEDER_SQLITE_CACHE_KB', 65536)) * -1};"
+                ),
+            },
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
     }
-}
+
+# Attempts made by Feeder.db.retry_on_locked before a locked-database error is raised
+FEEDER_DB_WRITE_RETRIES = int(os.environ.get('FEEDER_DB_WRITE_RETRIES', 5))
 
 
 # Password validation
@@ -133,3 +190,101 @@ STATIC_ROOT = os.path.join(BASE_DIR, "staticfiles")
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+
+# Pet feeder runtime tuning
+
+# Seconds between bulk writes of buffered device heartbeats
+FEEDER_HEARTBEAT_FLUSH_INTERVAL = int(os.environ.get('FEEDER_HEARTBEAT_FLUSH_INTERVAL', 30))
+
+# Seconds a cached device_id -> device lookup stays valid in each process, and
+# how often each process checks the shared registry generation for devices
+# saved or deleted elsewhere
+FEEDER_DEVICE_CACHE_TTL = int(os.environ.get('FEEDER_DEVICE_CACHE_TTL', 60))
+FEEDER_DEVICE_CACHE_CHECK_INTERVAL = float(os.environ.get('FEEDER_DEVICE_CACHE_CHECK_INTERVAL', 1))
+
+# Maximum number of pending commands handed to a device per poll
+FEEDER_COMMAND_BATCH_SIZE = int(os.environ.get('FEEDER_COMMAND_BATCH_SIZE', 10))
+
+# Longest time, in seconds, a command poll with ?wait= is held open
+FEEDER_COMMAND_LONG_POLL_TIMEOUT = int(os.environ.get('FEEDER_COMMAND_LONG_POLL_TIMEOUT', 25))
+
+# Seconds a process trusts the command version it last read for a device.
+# Commands queued in the same process are seen at once; commands queued by
+# other processes reach a plain poll within this time, and a long-poll when
+# its wait runs out
+FEEDER_COMMAND_VERSION_MAX_AGE = int(os.environ.get('FEEDER_COMMAND_VERSION_MAX_AGE', 25))
+
+# Bulk feed: concurrent device requests in flight, and largest fleet per request
+FEEDER_DISPATCH_CONCURRENCY = int(os.environ.get('FEEDER_DISPATCH_CONCURRENCY', 50))
+FEEDER_BULK_FEED_MAX_DEVICES = int(os.environ.get('FEEDER_BULK_FEED_MAX_DEVICES', 1000))
+
+# Feeding scheduler: how late a missed fire may still be caught up, and how
+# often edited schedules are picked up (both in seconds)
+FEEDER_SCHEDULE_CATCHUP_WINDOW = int(os.environ.get('FEEDER_SCHEDULE_CATCHUP_WINDOW', 3600))
+FEEDER_SCHEDULE_SYNC_INTERVAL = int(os.environ.get('FEEDER_SCHEDULE_SYNC_INTERVAL', 30))
+
+# Largest number of events a device may replay in one batch request
+FEEDER_BATCH_MAX_EVENTS = int(os.environ.get('FEEDER_BATCH_MAX_EVENTS', 500))
+
+# Retention: days to keep finished commands and raw feeding history (older
+# history stays in the daily rollups), and rows deleted per transaction
+FEEDER_COMMAND_RETENTION_DAYS = int(os.environ.get('FEEDER_COMMAND_RETENTION_DAYS', 30))
+FEEDER_HISTORY_RETENTION_DAYS = int(os.environ.get('FEEDER_HISTORY_RETENTION_DAYS', 365))
+FEEDER_RETENTION_BATCH_SIZE = int(os.environ.get('FEEDER_RETENTION_BATCH_SIZE', 1000))
+
+# Requests slower than this many milliseconds are logged as warnings (0 disables)
+FEEDER_SLOW_REQUEST_MS = int(os.environ.get('FEEDER_SLOW_REQUEST_MS', 500))
+
+# Device health: seconds without a heartbeat before a device is marked
+# inactive, and connect failures / cooldown seconds for the circuit breaker
+FEEDER_DEVICE_STALE_AFTER = int(os.environ.get('FEEDER_DEVICE_STALE_AFTER', 90))
+FEEDER_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('FEEDER_BREAKER_FAILURE_THRESHOLD', 3))
+FEEDER_BREAKER_COOLDOWN = int(os.environ.get('FEEDER_BREAKER_COOLDOWN', 60))
+
+# Seconds between command checks on an idle push connection; commands queued
+# in the same process are pushed immediately
+FEEDER_PUSH_RECHECK_INTERVAL = int(os.environ.get('FEEDER_PUSH_RECHECK_INTERVAL', 5))
+
+# Live dashboard stream: events kept for Last-Event-ID replay, seconds a
+# stream stays open before the browser reconnects, and seconds between
+# reads of the shared event log
+FEEDER_EVENT_HISTORY = int(os.environ.get('FEEDER_EVENT_HISTORY', 500))
+FEEDER_SSE_MAX_DURATION = int(os.environ.get('FEEDER_SSE_MAX_DURATION', 300))
+FEEDER_EVENT_POLL_INTERVAL = float(os.environ.get('FEEDER_EVENT_POLL_INTERVAL', 1))
+
+# Seconds a cached device or schedule list payload is kept; writes
+# invalidate it immediately through the table's generation counter
+FEEDER_LIST_CACHE_TTL = int(os.environ.get('FEEDER_LIST_CACHE_TTL', 300))
+
+# Outbox: seconds a queued feed stays deliverable, push attempts before it
+# fails, retry backoff bounds (seconds), and how often idle workers look
+# for due commands
+FEEDER_COMMAND_TTL = int(os.environ.get('FEEDER_COMMAND_TTL', 600))
+FEEDER_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('FEEDER_OUTBOX_MAX_ATTEMPTS', 8))
+FEEDER_OUTBOX_BACKOFF_BASE = int(os.environ.get('FEEDER_OUTBOX_BACKOFF_BASE', 2))
+FEEDER_OUTBOX_BACKOFF_MAX = int(os.environ.get('FEEDER_OUTBOX_BACKOFF_MAX', 120))
+FEEDER_OUTBOX_POLL_INTERVAL = int(os.environ.get('FEEDER_OUTBOX_POLL_INTERVAL', 2))
+
+# Token-bucket throttling: "<requests>/<s|min|hour|day>" per device_id for
+# the firmware endpoints and per client for the control endpoints; an
+# empty rate turns a scope off. Idle buckets are swept this often (seconds)
+FEEDER_THROTTLE_RATES = {
+    'heartbeat': os.environ.get('FEEDER_THROTTLE_HEARTBEAT', '60/min'),
+    'commands': os.environ.get('FEEDER_THROTTLE_COMMANDS', '120/min'),
+    'firmware': os.environ.get('FEEDER_THROTTLE_FIRMWARE', '120/min'),
+    'control': os.environ.get('FEEDER_THROTTLE_CONTROL', '30/min'),
+}
+FEEDER_THROTTLE_SWEEP_INTERVAL = int(os.environ.get('FEEDER_THROTTLE_SWEEP_INTERVAL', 60))
+
+# Multi-node mode: a directory for the shared membership files turns it on.
+# Each node needs a unique id and the base URL feeders are redirected to
+# for the devices it owns. Membership is refreshed every interval (seconds)
+# and a node silent for the TTL is dropped from the ring; each node takes
+# REPLICAS points on the ring
+FEEDER_CLUSTER_DIR = os.environ.get('FEEDER_CLUSTER_DIR', '')
+FEEDER_NODE_ID = os.environ.get('FEEDER_NODE_ID', '')
+FEEDER_NODE_URL = os.environ.get('FEEDER_NODE_URL', '')
+FEEDER_CLUSTER_HEARTBEAT_INTERVAL = int(os.environ.get('FEEDER_CLUSTER_HEARTBEAT_INTERVAL', 5))
+FEEDER_CLUSTER_NODE_TTL = int(os.environ.get('FEEDER_CLUSTER_NODE_TTL', 15))
+FEEDER_CLUSTER_REPLICAS = int(os.environ.get('FEEDER_CLUSTER_REPLICAS', 100))
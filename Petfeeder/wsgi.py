@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'Petfeeder.settings')
 
 application = get_wsgi_application()
+
+# Join the feeder cluster when serving; a no-op unless FEEDER_CLUSTER_DIR is set
+from Feeder.cluster import cluster  # noqa: E402
+from Feeder.heartbeat import heartbeat_buffer  # noqa: E402
+
+cluster.start()
+# Sweep stale devices from startup, not only once the first heartbeat arrives
+heartbeat_buffer.start()